@@ -135,3 +135,109 @@ flx_hsi_gdf2 = prisma_gpp.load_hsi_db(sr='vnir', zonal=zonal, upw=upw)
 
 
 
+#%% Alternative: stage-caching pipeline runner
+# Stages are skipped if their inputs, parameters and upstream stages did not
+# change (state in out_dir/_pipeline). After e.g. one new scene or one changed
+# mask parameter row only the affected sites are cropped again. Stages that
+# only modify the HSICOS instance have a 'load' to restore it when skipped.
+from fmch.pipeline import Stage, Pipeline
+
+sr = 'vnir'
+pl = Pipeline(prisma_gpp.out_dir / '_pipeline', workers=4)
+zips = lambda: sorted(prisma_gpp.img_dir.glob('*.zip'))
+site_flux = lambda site: sorted(prisma_gpp.icos_dir.glob(f'ICOSETC_{site}_*.csv'))
+
+pl.add(Stage('crs_and_cropping', lambda: prisma_gpp.crs_and_cropping(
+    icos_l0, zip_path=prisma_gpp.img_dir, overwrite=False, save_csv=True),
+    inputs=zips(), params=icos_l0,
+    outputs=[prisma_gpp.out_dir / f'{prisma_gpp.sensor}_hsicos_crs_loc.csv'],
+    load=lambda: None, exclusive='img_db')) # crs_and_cropping resets site_index
+pl.add(Stage('hsi_qc', lambda crs_and_cropping: prisma_gpp.hsi_qc(
+    icos_l0, overwrite=False, save=True), deps=['crs_and_cropping']))
+# Downloads & PET run concurrently to the QC. They read site_index, which is
+# rebuilt whenever img_db or flx_loc are reassigned: all stages that modify or
+# read these share the lock 'img_db' and do not run concurrently.
+pl.add(Stage('icos_cds_get', lambda site: prisma_gpp.icos_cds_get([site], eobs=True),
+             keys=icos_l0, params={'eobs': True}, exclusive='img_db'))
+pl.add(Stage('icos_eobs_pet', lambda site, icos_cds_get: prisma_gpp.icos_eobs_pet([site]),
+             deps=['icos_cds_get'], keys=icos_l0,
+             outputs=lambda site: [prisma_gpp.icos_dir / site / f'eobs_vars_pet_{site}.nc'],
+             exclusive='img_db'))
+pl.add(Stage('update_img_db', lambda hsi_qc: prisma_gpp.update_img_db(
+    img_db_file, era_blh=None, save=True), deps=['hsi_qc'],
+    inputs=[wdirexp / 'data' / img_db_file],
+    load=lambda: prisma_gpp.update_img_db(img_db_file, era_blh=None, save=False),
+    exclusive='img_db'))
+# existing PPI crops are only matched to img_db again. img_db rows of a site
+# are part of the params, so new scenes of other sites do not cause reruns.
+site_imgs = lambda site, cols: prisma_gpp.img_db.loc[prisma_gpp.img_db.name == site, cols]
+ppi_get = lambda site, update_img_db=None: prisma_gpp.icos_ppi_get(
+    [site], dataset='VI', day_range=10)
+pl.add(Stage('icos_ppi_get', ppi_get, deps=['update_img_db'], fingerprint_deps=[],
+             keys=lambda update_img_db: update_img_db,
+             params=lambda site: site_imgs(site, ['dataTakeID', 'startdate']),
+             load=ppi_get, exclusive='img_db')) # icos_ppi_get updates img_db
+pl.add(Stage('hsi_geom_crop', lambda site, update_img_db, icos_ppi_get: prisma_gpp.hsi_geom_crop(
+    [site], mask_param_df, 'GPP_DT_VUT_50', sr=sr, zonal=zonal, upw=upw)[0],
+    deps=['update_img_db', 'icos_ppi_get'], fingerprint_deps=['icos_ppi_get'],
+    keys=lambda update_img_db, icos_ppi_get: update_img_db,
+    params=lambda site: (mask_param_df[mask_param_df.name == site], sr, zonal, upw,
+                         site_imgs(site, ['dataTakeID', 'ppi_file'])),
+    inputs=lambda site: site_flux(site) + sorted(
+        prisma_gpp.img_dir.glob(f'*_{site}_6km_crop.tif')),
+    exclusive='img_db')) # hsi_geom_crop updates img_db
+
+def add_covars(hsi_geom_crop, icos_eobs_pet):
+    flx_hsi_gdf = pd.concat(hsi_geom_crop.values()).reset_index(drop=True)
+    mp_cor = mask_param_df[(mask_param_df.name + mask_param_df.dataTakeID)\
+                           .isin(flx_hsi_gdf.name + flx_hsi_gdf.dataTakeID)]
+    return prisma_gpp.hsi_add_spei_ppi(flx_hsi_gdf, mp_cor, dimred=False, zonal=zonal,
+                                       rm_missing=True, rm_sites=['IT-Lsn'], save=True)
+pl.add(Stage('hsi_add_spei_ppi', add_covars, deps=['hsi_geom_crop', 'icos_eobs_pet'],
+             inputs=[prisma_gpp.icos_dir / s / f'eobs_spei_{s}.csv' for s in icos_l0])) # SPEI from R
+
+
+# (1) DR branch. DR itself runs in 02_hsi_gpp_dimred_main.py (other environ-
+# ment) on the output of hsi_dimred_prep; the DR files found in out_dir are
+# backtransformed & cropped, new DR files are processed in the next run.
+def gdf_prep(update_img_db):
+    flx_geom_gdf, _ = prisma_gpp.hsi_gdf_prep(update_img_db, 'GPP_DT_VUT_50', upw=upw, zonal=zonal)
+    return flx_geom_gdf, prisma_gpp._nna_icos # NA count is required by dimred_geom_crop
+pl.add(Stage('hsi_gdf_prep', gdf_prep, deps=['update_img_db'],
+             params=('GPP_DT_VUT_50', zonal, upw),
+             inputs=[f for site in icos_l0 for f in site_flux(site)],
+             exclusive='img_db'))
+
+def add_covars_dr(hsi_gdf_prep, icos_ppi_get, icos_eobs_pet):
+    return prisma_gpp.hsi_add_spei_ppi(hsi_gdf_prep[0], mask_param_df, dimred=True, zonal=zonal,
+                                       rm_missing=True, rm_sites=['IT-Lsn'], save=True)
+pl.add(Stage('hsi_add_spei_ppi_dr', add_covars_dr,
+             deps=['hsi_gdf_prep', 'icos_ppi_get', 'icos_eobs_pet'], params=mask_param_df,
+             inputs=[prisma_gpp.icos_dir / s / f'eobs_spei_{s}.csv' for s in icos_l0],
+             load=lambda: prisma_gpp.load_pre_dimred_db(zonal=zonal, upw=upw)))
+
+dr_in = prisma_gpp.out_dir / 'DR_hsi_transp_{}_{}_{}.h5'.format(
+    prisma_gpp.sensor, 'bg' if zonal else 'ff', 'upw' if upw else 'ref')
+def dimred_prep(hsi_add_spei_ppi_dr):
+    prisma_gpp.hsi_dimred_prep(*hsi_add_spei_ppi_dr, save_plot=False) # saved as .h5
+pl.add(Stage('hsi_dimred_prep', dimred_prep, deps=['hsi_add_spei_ppi_dr'],
+             outputs=[dr_in] + [prisma_gpp.out_dir / f'DR_hsi_valid_{x}.json'
+                                for x in ['rows', 'cols']],
+             load=lambda: None))
+
+def dimred_crop(fn, hsi_gdf_prep, hsi_add_spei_ppi_dr, hsi_dimred_prep):
+    prisma_gpp._nna_icos = hsi_gdf_prep[1]
+    prisma_gpp.dimred_backtransform(fn, hsi_add_spei_ppi_dr[0])
+    return prisma_gpp.dimred_geom_crop(fn, *hsi_add_spei_ppi_dr, save=True)[0]
+pl.add(Stage('dimred_geom_crop', dimred_crop,
+             deps=['hsi_gdf_prep', 'hsi_add_spei_ppi_dr', 'hsi_dimred_prep'],
+             keys=lambda **deps: [fn for fn in dr_files if (prisma_gpp.out_dir / fn).exists()],
+             inputs=lambda fn: [prisma_gpp.out_dir / fn],
+             exclusive='img_db')) # dimred_geom_crop sets flx_comp_gdf
+
+# Branches (1) and (2) both set the processing info of prisma_gpp and are
+# therefore run separately
+res = pl.run(['hsi_add_spei_ppi']) # (2)
+flx_hsi_gdf2, mask_param_df2 = res['hsi_add_spei_ppi']
+res_dr = pl.run(['dimred_geom_crop']) # (1)
+flx_comp_gdfs = res_dr['dimred_geom_crop']
@@ -0,0 +1,419 @@
+# Authors: Floris Hermanns
+# License: BSD 3 Clause
+"""
+FFP benchmarks and validation against stored reference outputs.
+
+    make_cases(): Grid of stability regimes, measurement heights and nx /
+        domain sizes for single footprints (FFP) and climatologies (FFP_clim)
+    make_reference(): Run the reference implementations and store contours,
+        peak locations and field integrals (.npz)
+    run_benchmark(): Time, trace and validate (alternative) footprint
+        implementations against the stored reference
+
+Optimized footprint paths are accepted if all metrics are within TOLERANCES,
+e.g.
+
+    python -m fmch.ffp_bench --make-reference ffp_ref.npz
+    python -m fmch.ffp_bench --reference ffp_ref.npz \\
+        --impls FFP FFP_batch FFPLookup FFP_clim FFP_clim_f32 --out ffp_bench.json
+
+The reference should be created with a trusted version of ffp.py (e.g. the
+original Kljun port) before the code under test is changed.
+"""
+import numpy as np
+import json
+import time
+import platform
+import tracemalloc
+import cProfile
+import argparse
+import datetime as dt
+from pathlib import Path
+from shapely.geometry import Polygon
+
+from fmch import ffp
+
+__all__ = ["make_cases", "make_reference", "run_benchmark", "compare",
+           "IMPLEMENTATIONS", "REGIMES", "TOLERANCES"]
+
+# Micrometeorological conditions of the stability regimes
+REGIMES = {
+    'convective': {'ol': -30., 'h': 1500., 'sigmav': 0.9, 'ustar': 0.35, 'umean': 2.5},
+    'neutral': {'ol': 1e5, 'h': 1000., 'sigmav': 0.6, 'ustar': 0.5, 'umean': 5.},
+    'stable': {'ol': 150., 'h': 300., 'sigmav': 0.4, 'ustar': 0.2, 'umean': 2.},
+    }
+HEIGHTS = [5., 20., 50.]
+NX = [600, 1000, 2000]
+# FFP_clim domains: (half width [m], cell size [m])
+DOMAINS = [(250., 1.), (1000., 4.)]
+RS = [0.3, 0.5, 0.8]
+
+# Accepted deviations from the reference: minimum polygon IoU of all contours,
+# relative errors of the peak location and the field integral
+TOLERANCES = {'iou': 0.99, 'peak_rel': 0.02, 'integral_rel': 1e-3}
+
+
+def _single_batch(**kwargs):
+    res = ffp.FFP_batch(fields=True, **kwargs)
+    return {'x_ci_max': res['x_ci_max'][0], 'rs': res['rs'], 'xr': res['xr'][0],
+            'yr': res['yr'][0], 'x_2d': res['x_2d'][0], 'y_2d': res['y_2d'][0],
+            'f_2d': res['f_2d'][0]}
+
+
+def _single_lookup(rs, nx=1000, **kwargs):
+    res = ffp.FFPLookup(rs=rs, nx=nx).footprints(**kwargs)
+    xr = [x[np.isfinite(x)] if np.isfinite(x).any() else None for x in res['xr'][0]]
+    yr = [y[np.isfinite(y)] if np.isfinite(y).any() else None for y in res['yr'][0]]
+    return {'x_ci_max': res['x_ci_max'][0], 'rs': res['rs'], 'xr': xr, 'yr': yr}
+
+
+# implementation name -> (case kind, function(**case kwargs) returning an FFP-like dict)
+IMPLEMENTATIONS = {
+    'FFP': ('single', lambda **kw: ffp.FFP(**kw)),
+    'FFP_batch': ('single', _single_batch),
+    'FFPLookup': ('single', _single_lookup),
+    'FFP_clim': ('clim', lambda **kw: ffp.FFP_clim(verbosity=0, **kw)),
+    'FFP_clim_f32': ('clim', lambda **kw: ffp.FFP_clim(verbosity=0, dtype=np.float32, **kw)),
+    'FFP_clim_w4': ('clim', lambda **kw: ffp.FFP_clim(verbosity=0, workers=4, **kw)),
+    }
+# reference implementation per case kind
+REFERENCE = {'single': 'FFP', 'clim': 'FFP_clim'}
+
+
+def make_cases(regimes=None, heights=HEIGHTS, nxs=NX, domains=DOMAINS,
+               n_steps=48, seed=42):
+    '''
+    Builds the benchmark cases: single footprints for all regimes, heights
+    and nx, and climatologies of n_steps timestamps (random wind directions,
+    inputs varying by +-20% around the regime, seeded per case) for all
+    regimes, heights and domains.
+
+    Args:
+        regimes (list of strings, optional): Keys of REGIMES. All by default.
+        heights (list of floats): Measurement heights zm [m].
+        nxs (list of ints): Grid sizes of the scaled footprint (FFP).
+        domains (list of tuples): (half width, cell size) of FFP_clim domains.
+        n_steps (int): Number of timestamps of the climatologies.
+        seed (int): Seed for the random inputs of the climatologies.
+
+    Returns:
+        cases (dict): Case name -> {'kind': 'single' / 'clim', 'kwargs': dict}
+    '''
+    if regimes is None:
+        regimes = list(REGIMES.keys())
+    cases = {}
+    for regime in regimes:
+        met = REGIMES[regime]
+        for zm in heights:
+            for nx in nxs:
+                cases[f'single_{regime}_zm{zm:g}_nx{nx}'] = {
+                    'kind': 'single', 'kwargs': dict(zm=zm, rs=RS, nx=nx, **met)}
+            for half, cell in domains:
+                # inputs of a case do not depend on the other cases
+                rng = np.random.default_rng(
+                    [seed, list(REGIMES).index(regime), int(zm*100), int(half*100)])
+                ts = {k: (v * rng.uniform(0.8, 1.2, n_steps)).tolist() for k, v in met.items()}
+                ts['wind_dir'] = rng.uniform(0., 360., n_steps).tolist()
+                cases[f'clim_{regime}_zm{zm:g}_d{half:g}'] = {
+                    'kind': 'clim', 'kwargs': dict(
+                        zm=zm, domain=[-half, half, -half, half], dx=cell, dy=cell,
+                        rs=RS, **ts)}
+    return cases
+
+
+def _field(out):
+    f = out.get('f_2d', out.get('fclim_2d'))
+    if f is None:
+        return None, None, None
+    return np.asarray(out['x_2d']), np.asarray(out['y_2d']), np.asarray(f)
+
+
+def _summary(out):
+    '''
+    Quantities compared between implementations: contours per r (None if
+    missing), x_ci_max, location of the 2D footprint peak and the integral
+    of the 2D footprint.
+    '''
+    smry = {'xr': [], 'yr': [], 'x_ci_max': out.get('x_ci_max'), 'peak': None,
+            'integral': None}
+    xrs = out.get('xr') or [None]*len(RS)
+    yrs = out.get('yr') or [None]*len(RS)
+    for xr, yr in zip(xrs, yrs):
+        if xr is None or yr is None or len(xr) < 3:
+            smry['xr'].append(None)
+            smry['yr'].append(None)
+        else:
+            smry['xr'].append(np.asarray(xr, dtype=float))
+            smry['yr'].append(np.asarray(yr, dtype=float))
+
+    x, y, f = _field(out)
+    if f is not None:
+        k = np.nanargmax(f)
+        smry['peak'] = np.array([x.flat[k], y.flat[k]])
+        # cell area from the grid vectors (grids may be rotated)
+        cell = abs((x[1, 0] - x[0, 0]) * (y[0, 1] - y[0, 0]) -
+                   (x[0, 1] - x[0, 0]) * (y[1, 0] - y[0, 0]))
+        smry['integral'] = float(np.nansum(f) * cell)
+    return smry
+
+
+def _iou(x1, y1, x2, y2):
+    if x1 is None and x2 is None:
+        return 1.
+    if x1 is None or x2 is None:
+        return 0.
+    p1 = Polygon(zip(x1, y1)).buffer(0)
+    p2 = Polygon(zip(x2, y2)).buffer(0)
+    union = p1.union(p2).area
+    return p1.intersection(p2).area / union if union > 0 else 1.
+
+
+def compare(smry, ref):
+    '''
+    Compares the summary of an implementation to the reference summary.
+
+    Returns:
+        metrics (dict): 'iou' (minimum polygon IoU of all contours),
+            'peak_rel' (largest relative error of x_ci_max and of the 2D peak
+            location, relative to the distance of the reference peak from
+            the tower) and 'integral_rel' (relative error of the field
+            integral). Metrics that cannot be computed are None.
+    '''
+    metrics = {'iou': None, 'peak_rel': None, 'integral_rel': None}
+    if len(smry['xr']) > 0 and len(ref['xr']) > 0:
+        metrics['iou'] = min(_iou(x1, y1, x2, y2) for x1, y1, x2, y2 in zip(
+            smry['xr'], smry['yr'], ref['xr'], ref['yr']))
+
+    perr = []
+    if smry['x_ci_max'] is not None and ref['x_ci_max'] is not None:
+        perr.append(abs(smry['x_ci_max'] - ref['x_ci_max']) / abs(ref['x_ci_max']))
+    if smry['peak'] is not None and ref['peak'] is not None:
+        dist = max(np.hypot(*ref['peak']), 1e-9)
+        perr.append(np.hypot(*(smry['peak'] - ref['peak'])) / dist)
+    if len(perr) > 0:
+        metrics['peak_rel'] = float(max(perr))
+
+    if smry['integral'] is not None and ref['integral'] is not None:
+        metrics['integral_rel'] = abs(smry['integral'] - ref['integral']) / ref['integral']
+    return metrics
+
+
+def _save_reference(refs, out_file, meta):
+    arrs = {'meta': np.array(json.dumps(meta))}
+    for case, smry in refs.items():
+        for key in ['x_ci_max', 'peak', 'integral']:
+            if smry[key] is not None:
+                arrs[f'{case}|{key}'] = np.asarray(smry[key], dtype=float)
+        for j, (xr, yr) in enumerate(zip(smry['xr'], smry['yr'])):
+            if xr is not None:
+                arrs[f'{case}|xr{j}'] = xr
+                arrs[f'{case}|yr{j}'] = yr
+    np.savez_compressed(out_file, **arrs)
+
+
+def load_reference(ref_file):
+    '''
+    Loads reference summaries written by make_reference.
+
+    Returns:
+        refs (dict): Case name -> summary (see compare)
+        meta (dict): Metadata of the reference run, incl. the cases
+    '''
+    refs = {}
+    with np.load(ref_file) as data:
+        meta = json.loads(str(data['meta']))
+        for case in meta['cases']:
+            smry = {'xr': [], 'yr': []}
+            for key in ['x_ci_max', 'peak', 'integral']:
+                val = data.get(f'{case}|{key}')
+                smry[key] = None if val is None else (val if val.ndim else float(val))
+            for j in range(len(meta['rs'])):
+                smry['xr'].append(data.get(f'{case}|xr{j}'))
+                smry['yr'].append(data.get(f'{case}|yr{j}'))
+            refs[case] = smry
+    return refs, meta
+
+
+def _run_single(func, kwargs, memory=False, profile=None):
+    '''
+    Runs one footprint calculation. Returns wall time [s], peak memory [MB]
+    (None if not traced) and the output.
+    '''
+    if memory:
+        tracemalloc.start()
+    prof = cProfile.Profile() if profile is not None else None
+
+    t0 = time.perf_counter()
+    if prof is not None:
+        prof.enable()
+    out = func(**kwargs)
+    if prof is not None:
+        prof.disable()
+    t1 = time.perf_counter()
+
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1] / 1024**2
+        tracemalloc.stop()
+    if prof is not None:
+        prof.dump_stats(str(profile))
+
+    return t1 - t0, peak, out
+
+
+def _meta(cases, seed):
+    return {'created': dt.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'seed': seed, 'rs': RS, 'cases': list(cases.keys())}
+
+
+def make_reference(out_file, cases=None, seed=42):
+    '''
+    Runs the reference implementations (REFERENCE) for all cases and stores
+    their contours, peak locations and field integrals.
+
+    Args:
+        out_file (string / pathlib.Path): Output .npz file.
+        cases (dict, optional): Cases as returned by make_cases. All
+            default cases if None.
+        seed (int): Seed for make_cases.
+
+    Returns:
+        refs (dict): Case name -> summary.
+    '''
+    if cases is None:
+        cases = make_cases(seed=seed)
+    refs = {}
+    for case, spec in cases.items():
+        func = IMPLEMENTATIONS[REFERENCE[spec['kind']]][1]
+        refs[case] = _summary(func(**spec['kwargs']))
+    _save_reference(refs, out_file, _meta(cases, seed))
+    return refs
+
+
+def run_benchmark(impls=None, ref_file=None, cases=None, repeat=3, memory=True,
+                  profile_dir=None, out_file=None, seed=42, tolerances=TOLERANCES):
+    '''
+    Times all implementations for all cases of their kind and validates the
+    results against the reference. Wall time is the minimum over repeat
+    runs; peak memory is traced in one extra run (tracemalloc slows down
+    allocations).
+
+    Args:
+        impls (list of strings, optional): Keys of IMPLEMENTATIONS. All by
+            default.
+        ref_file (string / pathlib.Path, optional): Reference from
+            make_reference. If None, the reference implementations of the
+            current code are run (only meaningful for timing).
+        cases (dict, optional): Cases as returned by make_cases. Defaults to
+            the cases stored in the reference.
+        repeat (int): Number of timed runs per case.
+        memory (bool): If true, trace peak memory in a separate run.
+        profile_dir (string / pathlib.Path, optional): If given, a cProfile
+            .prof file is written for the first run of each case.
+        out_file (string / pathlib.Path, optional): JSON output file.
+        seed (int): Seed for make_cases.
+        tolerances (dict): Accepted deviations, see TOLERANCES.
+
+    Returns:
+        results (list of dicts): One entry per implementation & case with
+            status 'pass', 'fail' (metrics outside tolerances) or 'error'.
+    '''
+    if impls is None:
+        impls = list(IMPLEMENTATIONS.keys())
+    if ref_file is not None:
+        refs, ref_meta = load_reference(ref_file)
+        if cases is None:
+            cases = {k: v for k, v in make_cases(seed=ref_meta['seed']).items()
+                     if k in refs}
+    else:
+        if cases is None:
+            cases = make_cases(seed=seed)
+        refs = {case: _summary(IMPLEMENTATIONS[REFERENCE[spec['kind']]][1](**spec['kwargs']))
+                for case, spec in cases.items()}
+    if profile_dir is not None:
+        profile_dir = Path(profile_dir)
+        profile_dir.mkdir(parents=True, exist_ok=True)
+
+    results = []
+    for impl in impls:
+        kind, func = IMPLEMENTATIONS[impl]
+        for case, spec in cases.items():
+            if spec['kind'] != kind:
+                continue
+            res = {'impl': impl, 'case': case, 'repeat': repeat, 'time_s': None,
+                   'times_s': [], 'peak_mem_mb': None, 'iou': None,
+                   'peak_rel': None, 'integral_rel': None, 'status': 'pass',
+                   'error': None}
+            try:
+                for r in range(repeat):
+                    prof = None
+                    if profile_dir is not None and r == 0:
+                        prof = profile_dir / f'{impl}_{case}.prof'
+                    t, _, out = _run_single(func, spec['kwargs'], profile=prof)
+                    res['times_s'].append(t)
+                res['time_s'] = min(res['times_s'])
+                res.update(compare(_summary(out), refs[case]))
+                if memory:
+                    _, res['peak_mem_mb'], _ = _run_single(func, spec['kwargs'], memory=True)
+                ok = [(res['iou'] is None or res['iou'] >= tolerances['iou']),
+                      (res['peak_rel'] is None or res['peak_rel'] <= tolerances['peak_rel']),
+                      (res['integral_rel'] is None or
+                       res['integral_rel'] <= tolerances['integral_rel'])]
+                if not all(ok):
+                    res['status'] = 'fail'
+            except Exception as e:
+                if tracemalloc.is_tracing():
+                    tracemalloc.stop()
+                res['status'] = 'error'
+                res['error'] = f'{type(e).__name__}: {e}'
+            results.append(res)
+            print('{impl:>13s} {case:<32s} time={time_s} s  mem={peak_mem_mb} MB  '
+                  'iou={iou}  peak_rel={peak_rel}  integral_rel={integral_rel}  '
+                  '{status}'.format(**res))
+
+    if out_file is not None:
+        meta = _meta(cases, seed)
+        meta.update({'reference': None if ref_file is None else str(ref_file),
+                     'tolerances': tolerances})
+        with open(out_file, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=4)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark and validate FFP '
+                                     'footprint implementations.')
+    parser.add_argument('--make-reference', default=None, metavar='NPZ',
+                        help='Create a reference file and exit.')
+    parser.add_argument('--reference', default=None, metavar='NPZ')
+    parser.add_argument('--impls', nargs='+', choices=list(IMPLEMENTATIONS.keys()),
+                        default=None)
+    parser.add_argument('--regimes', nargs='+', choices=list(REGIMES.keys()),
+                        default=None)
+    parser.add_argument('--heights', nargs='+', type=float, default=HEIGHTS)
+    parser.add_argument('--nx', nargs='+', type=int, default=NX)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true')
+    parser.add_argument('--profile-dir', default=None)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--out', default='ffp_bench.json')
+    args = parser.parse_args(argv)
+
+    cases = make_cases(regimes=args.regimes, heights=args.heights, nxs=args.nx,
+                       seed=args.seed)
+    if args.make_reference is not None:
+        make_reference(args.make_reference, cases=cases, seed=args.seed)
+        return
+    if args.reference is not None:
+        refs, _ = load_reference(args.reference)
+        cases = {k: v for k, v in cases.items() if k in refs}
+    run_benchmark(impls=args.impls, ref_file=args.reference, cases=cases,
+                  repeat=args.repeat, memory=not args.no_memory,
+                  profile_dir=args.profile_dir, out_file=args.out, seed=args.seed)
+
+if __name__ == "__main__":
+    main()
@@ -23,7 +23,7 @@ from tqdm import tqdm
 
 import pyeto
 import pyproj as proj
-from shapely.geometry import Polygon
+import shapely
 import rasterio as rio
 import rasterio.plot as riop
 import rasterio.mask as riom
@@ -32,7 +32,10 @@ import spectral.io.envi as envi
 from shapely import geometry
 from shapely.ops import transform as stransform
 from functools import reduce
-from fmch import ffp
+from concurrent.futures import ProcessPoolExecutor
+from fmch import ffp, profiling
+from fmch.icos_store import IcosSiteStore
+from fmch.site_index import SiteIndex
 from fmch.HSI2RGB import HSI2RGB
 from cv2 import medianBlur, filter2D
 from random import randint
@@ -70,6 +73,17 @@ logger.addHandler(file_handler)
 logger.addHandler(stdout_handler)
 logger.info('Running HSICOS module')
 
+# Relative 1-sigma uncertainty of PBLH in FFP ensembles if the boundary layer
+# height is substituted with ERA5 data (ICOS PBLH: ffp.FFP_INPUT_SD['h'])
+ERA5_PBLH_SD = 0.5
+
+# Defaults of multi-day flux aggregation windows (flux_windows arguments):
+# 'days': +-days around the acquisition date ('center') or length of fixed
+#     composites starting on Jan 1 ('composite', e.g. 8-day composites)
+# 'how': 'mean' or 'sum' of the valid half-hourly records
+# 'daytime': only records with PAR > 0 (or PAR NA) are aggregated
+FLUX_WINDOW_DEFAULTS = {'days': 0, 'kind': 'center', 'how': 'mean', 'daytime': False}
+
 def _build_icos_meta():
     '''
     Function to build a geodataframe containing metadata about a number of ICOS
@@ -208,6 +222,32 @@ def _build_icos_meta():
 def nearest(items, target):
     return min(items, key=lambda x: abs(x - target))
 
+def _height_history(dates, values):
+    '''
+    Sorted height history of an ICOS site. For repeated dates, the last
+    entry is kept.
+    
+    Args:
+        dates (array-like): Measurement / installation dates.
+        values (array-like): Heights (m).
+    Returns:
+        Tuple of numpy.ndarrays (dates as datetime64[D], heights as float)
+    '''
+    dates = np.asarray(pd.to_datetime(pd.Series(dates)).values, dtype='datetime64[D]')
+    values = np.asarray(values, dtype=float)
+    ok = ~np.isnat(dates)
+    # first occurrence in reversed order = last entry of each date
+    hdates, ix = np.unique(dates[ok][::-1], return_index=True)
+    return hdates, values[ok][::-1][ix]
+
+def _nearest_date_ix(hdates, dates):
+    '''
+    Indices of the nearest dates in the sorted array hdates (ties: earlier).
+    '''
+    hi = np.clip(np.searchsorted(hdates, dates), 0, len(hdates) - 1)
+    lo = np.clip(hi - 1, 0, None)
+    return np.where(np.abs(hdates[hi] - dates) < np.abs(dates - hdates[lo]), hi, lo)
+
 def _fnv(values, target):
     '''
     A convenience function that finds the index of a value in a list closest
@@ -256,6 +296,176 @@ def _local_mask(raster, transform, shapes, **kwargs):
             
     return output, out_trans
 
+def _weighted_nanmean(values, weights):
+    '''
+    Weighted means of pixel values, ignoring NaN pixels per column.
+    
+    Args:
+        values (numpy.ndarray): Pixel values with dim: [pixels, bands].
+        weights (scipy.sparse matrix): Pixel weights with dim: [n, pixels].
+    Returns:
+        numpy.ndarray of weighted means with dim: [n, bands]
+    '''
+    finite = np.isfinite(values)
+    num = weights.dot(np.where(finite, values, 0.))
+    den = weights.dot(finite.astype(float))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(den > 0, num / den, np.nan)
+
+def _member_spread(values, member_weights, valid):
+    '''
+    Standard deviation of weighted pixel means across the members of a
+    footprint ensemble (see ffp.FFP_ensemble), ignoring invalid members.
+    
+    Args:
+        values (numpy.ndarray): Pixel values with dim: [pixels, bands].
+        member_weights (scipy.sparse matrix): Pixel weights of the members
+            with dim: [members, pixels].
+        valid (numpy.ndarray): Boolean array of valid members.
+    Returns:
+        numpy.ndarray of standard deviations with dim: [bands]
+    '''
+    avgs = _weighted_nanmean(values, member_weights)[valid]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return np.nanstd(avgs, axis=0)
+
+def _window_reach(windows):
+    '''
+    Number of days before / after an acquisition date required by the flux
+    aggregation windows.
+    '''
+    reach = 0
+    for spec in (windows or {}).values():
+        spec = {**FLUX_WINDOW_DEFAULTS, **spec}
+        reach = max(reach, spec['days'] if spec['kind'] == 'center' else spec['days'] - 1)
+    return reach
+
+def _window_aggregates(records, variables, dates, windows):
+    '''
+    Aggregates half-hourly ICOS records over multi-day windows around the
+    acquisition dates. Daily sums and counts of valid records are computed
+    once (per daytime filter), all windows are derived from them with
+    rolling sums ('center') or block sums ('composite').
+    
+    Args:
+        records (pandas.DataFrame): Half-hourly records with columns
+            'TIMESTAMP_END', 'PAR' and variables (-9999 = NA).
+        variables (list of strings): Variables to be aggregated.
+        dates (array-like of datetime.date): Acquisition dates.
+        windows (dict): Window specifications {name: {'days': ..., 'kind':
+            ..., 'how': ..., 'daytime': ...}}, see FLUX_WINDOW_DEFAULTS.
+    Returns:
+        pandas.DataFrame with one row per date and columns '<var>_<name>'
+        (NaN if no valid record is in the window).
+    '''
+    specs = {name: {**FLUX_WINDOW_DEFAULTS, **spec} for name, spec in windows.items()}
+    for name, spec in specs.items():
+        if spec['kind'] not in ['center', 'composite'] or spec['how'] not in ['mean', 'sum']:
+            raise ValueError(f'Invalid flux window specification {name}: {spec}')
+    qdates = pd.DatetimeIndex(np.asarray(dates, dtype='datetime64[D]')).as_unit('ns')
+    vals = records[variables].astype(float).replace(-9999, np.nan)
+    days = pd.DatetimeIndex(records.TIMESTAMP_END.values.astype('datetime64[D]')).as_unit('ns')
+    daytime = ((records.PAR > 0) | (records.PAR == -9999)).values
+    reach = pd.Timedelta(days=_window_reach(windows))
+    if len(qdates) == 0:
+        return pd.DataFrame(columns=[f'{var}_{name}' for name in specs for var in variables],
+                            dtype=float)
+    # complete calendar around the acquisition dates (records outside do not
+    # enter any window), rolling windows are counted in days
+    calendar = pd.date_range(qdates.min() - reach, qdates.max() + reach, freq='D', unit='ns')
+    
+    daily = {}
+    for dt_only in {spec['daytime'] for spec in specs.values()}:
+        sel = daytime if dt_only else np.ones(len(vals), dtype=bool)
+        grouped = vals[sel].groupby(days[sel])
+        daily[dt_only] = (grouped.sum().reindex(calendar, fill_value=0.),
+                          grouped.count().reindex(calendar, fill_value=0))
+    
+    out = {}
+    for name, spec in specs.items():
+        dsum, dcount = daily[spec['daytime']]
+        if spec['kind'] == 'center':
+            w = 2*spec['days'] + 1
+            wsum = dsum.rolling(w, center=True, min_periods=1).sum()
+            wcount = dcount.rolling(w, center=True, min_periods=1).sum()
+        else:
+            block = calendar.year * 1000 + (calendar.dayofyear - 1) // spec['days']
+            wsum = dsum.groupby(block).transform('sum')
+            wcount = dcount.groupby(block).transform('sum')
+        wsum, wcount = wsum.reindex(qdates), wcount.reindex(qdates)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            agg = wsum / wcount if spec['how'] == 'mean' else wsum.where(wcount > 0)
+        for var in variables:
+            out[f'{var}_{name}'] = agg[var].values
+    return pd.DataFrame(out)
+
+def _match_records(records, times, tolerance = pd.Timedelta('15min'),
+                   on = 'TIMESTAMP_END'):
+    '''
+    Matches acquisition times to the nearest half-hourly ICOS record within
+    tolerance (single merge_asof on the sorted record timestamps).
+    
+    Args:
+        records (pandas.DataFrame): ICOS records with timestamp column 'on'.
+        times (pandas.Series): Acquisition times (ICOS time zone).
+        tolerance (pandas.Timedelta, optional): Maximum time difference.
+        on (string, optional): Timestamp column of records.
+    Returns:
+        pandas.DataFrame with one row per acquisition (order of times) and
+        the columns of records plus 'icos_missing' (True if no record was
+        found, the timestamp is then set to the acquisition time).
+    '''
+    recs = records.dropna(subset=[on]).sort_values(on, kind='stable')
+    acq = pd.DataFrame({'_acq': pd.to_datetime(np.asarray(times)).astype(recs[on].dtype),
+                        '_pos': np.arange(len(times))})
+    matched = pd.merge_asof(acq.sort_values('_acq', kind='stable'), recs,
+                            left_on='_acq', right_on=on, direction='nearest',
+                            tolerance=tolerance)
+    matched = matched.sort_values('_pos').reset_index(drop=True)
+    matched['icos_missing'] = matched[on].isna()
+    matched[on] = matched[on].fillna(matched._acq)
+    return matched.drop(columns=['_acq', '_pos'])
+
+def _footprint_polygons(xrs, yrs, x0, y0):
+    '''
+    Builds footprint polygons in bulk from contour coordinates relative to
+    the tower (one ragged shapely 2 coordinate array for all contours).
+    
+    Args:
+        xrs, yrs (list of numpy.ndarray): Contour coordinates per footprint.
+        x0, y0 (float): Tower location in the CRS of the polygons.
+    Returns:
+        numpy.ndarray of shapely Polygons (coordinates rounded to cm)
+    '''
+    if len(xrs) == 0:
+        return np.array([], dtype=object)
+    coords = np.column_stack([np.concatenate(xrs) + x0, np.concatenate(yrs) + y0])
+    ix = np.repeat(np.arange(len(xrs)), [len(x) for x in xrs])
+    return shapely.polygons(shapely.linearrings(np.round(coords, 2), indices=ix))
+
+def _reproject_geoms(geoms, transformer, tolerance = 0.):
+    '''
+    Reprojects geometries in bulk: the coordinates of all geometries are
+    transformed with a single pyproj call. Optionally, the reprojected
+    geometries are simplified.
+    
+    Args:
+        geoms (iterable of shapely geometries): Geometries (None allowed).
+        transformer (pyproj.Transformer): Transformer with always_xy=True.
+        tolerance (float, optional): Simplification tolerance in units of
+            the target CRS, e.g. a fraction of the pixel size. No
+            simplification if 0.
+    Returns:
+        numpy.ndarray of shapely geometries
+    '''
+    geoms = np.array(list(geoms), dtype=object)
+    out = shapely.transform(geoms, lambda c: np.column_stack(
+        transformer.transform(c[:, 0], c[:, 1])))
+    if tolerance > 0:
+        out = shapely.simplify(out, tolerance, preserve_topology=True)
+    return out
+
 def desis_crop(path, mask, indexes = None):
     '''
     Reads DESIS GeoTiffs and crops using rasterio.mask methods (argument
@@ -283,9 +493,10 @@ def desis_crop(path, mask, indexes = None):
     crs_utm = proj.CRS.from_epsg(epsg)
     transf = proj.Transformer.from_crs(crs_lam, crs_utm, always_xy=True)
     utm_mask = stransform(transf.transform, mask)
-    with rio.open(path, driver='GTiff') as src:
+    with profiling.timer('crop') as t, rio.open(path, driver='GTiff') as src:
         raw_cube, out_trans = riom.mask(src, shapes=[utm_mask], all_touched=True,
                                         crop=True, indexes=indexes_rio)
+        t.add(bytes=raw_cube.nbytes, pixels=raw_cube.shape[-1] * raw_cube.shape[-2])
     if raw_cube.ndim == 2:
         out_ext = riop.plotting_extent(raw_cube, out_trans)
         temp = raw_cube.T
@@ -319,7 +530,7 @@ def prisma_crop(path, mask, indexes = None, swir = False):
         swir (bool, optional): If true, bands in the 1000-2500 nm range are
             imported and concatenated with the VNIR cube.
     '''
-    with ZipFile(path) as zf:
+    with profiling.timer('zip_decode') as t, ZipFile(path) as zf:
         for file in zf.namelist():
             if not file.endswith('.he5'): # optional filtering by filetype
                 logger.error('{}: Zip doesnt contain .he5 file.'.format(path))
@@ -347,6 +558,7 @@ def prisma_crop(path, mask, indexes = None, swir = False):
                         swir_raw = h5f['/HDFEOS/SWATHS/PRS_L2D_HCO/Data Fields/SWIR_Cube'][:]
                         smax_sw = h5f.attrs['L2ScaleSwirMax']
                         smin_sw = h5f.attrs['L2ScaleSwirMin']
+        t.add(bytes=vnir_raw.nbytes + (swir_raw.nbytes if swir == True else 0))
                     
     rows0,_,cols0 = np.shape(vnir_raw)
     geo['xsize'] = (geo['xmax']-geo['xmin'])/cols0
@@ -386,8 +598,10 @@ def prisma_crop(path, mask, indexes = None, swir = False):
     transf = proj.Transformer.from_crs(crs_lam, crs_utm, always_xy=True)
     utm_mask = stransform(transf.transform, mask)
     # In rio.Affine: last value is ymax, not ymin!
-    ff_cube, out_trans = _local_mask(full_cube, src_trans, [utm_mask], crop=True,
-                                    all_touched=True, indexes=indexes_rio)
+    with profiling.timer('crop') as t:
+        ff_cube, out_trans = _local_mask(full_cube, src_trans, [utm_mask], crop=True,
+                                        all_touched=True, indexes=indexes_rio)
+        t.add(pixels=ff_cube.shape[-1] * ff_cube.shape[-2])
     out_ext = riop.plotting_extent(ff_cube, out_trans)
     na_val = 0
     
@@ -396,7 +610,8 @@ def prisma_crop(path, mask, indexes = None, swir = False):
 
 class HSICOS():
     
-    def __init__(self, img_csv, wdir = wdir0, do_mkdir = False, out_dir = False, era_blh = []):
+    def __init__(self, img_csv, wdir = wdir0, do_mkdir = False, out_dir = False, era_blh = [],
+                 icos_cache = False, icos_store = None):
         '''
         Args:
             wdir (string): The directory where BSQ files and the GeoPackage
@@ -417,9 +632,29 @@ class HSICOS():
             out_dir (string, optional): Set a custom name for the working
                 folder, e.g. to continue previously produced results. If
                 unused, a generic output directory name will be used.
+            icos_cache (bool or string, optional): If true or a directory,
+                ICOS L2 half-hourly CSVs are converted once to Parquet (see
+                icos_ingest, default directory: 'data/fluxes/_parquet') and
+                only required columns & dates are read. Requires pyarrow.
+            icos_store (fmch.icos_store.IcosSiteStore, optional): Store of
+                parsed ICOS L2 data, e.g. shared by several HSICOS instances.
+                Supersedes icos_cache. By default, a new store is created.
         '''
         self._wdir = Path(wdir)
+        self._flx_loc = None
         self.icos_dir = self._wdir / 'data' / 'fluxes'
+        if icos_cache == True:
+            self.icos_cache = self.icos_dir / '_parquet'
+        elif icos_cache:
+            self.icos_cache = Path(icos_cache)
+        else:
+            self.icos_cache = None
+        if icos_store is None:
+            icos_store = IcosSiteStore(self.icos_dir, cache_dir=self.icos_cache)
+        else:
+            self.icos_cache = icos_store.cache_dir
+        self.icos_store = icos_store # every ICOS file is parsed once per process
+        self._img_updates = None # img_db status updates of workers, see _set_img_status
         self._df_icos = '%Y%m%d%H%M'
         self._df = '%Y-%m-%d %H:%M:%S'
         
@@ -485,16 +720,44 @@ class HSICOS():
         ppif_list = [x.name for x in list(ppi_dir.glob('*VI_PPI*.tif'))]
         
         for fname in ppif_list:
-            self.img_db.loc[(self.img_db.name == fname[-25:-19]) &
-                            (self.img_db.dataTakeID == fname[-18:-4]), 'ppi_file'] = fname
+            self.site_index.set_img(fname[-25:-19], fname[-18:-4], 'ppi_file', fname)
         logger.info('S2 PPI images locally available for {} data takes.'\
                     .format(len(self.img_db.loc[self.img_db.ppi_file != '', :])))
+
+    @property
+    def img_db(self):
+        return self._img_db
+
+    @img_db.setter
+    def img_db(self, img_db):
+        self._img_db = img_db
+        self._site_index = None # rebuilt on next access
+
+    @property
+    def flx_loc(self):
+        return self._flx_loc
+
+    @flx_loc.setter
+    def flx_loc(self, flx_loc):
+        self._flx_loc = flx_loc
+        self._site_index = None
+
+    @property
+    def site_index(self):
+        '''
+        Keyed index of img_db, icos_db and flx_loc (see fmch.site_index).
+        Rebuilt automatically when img_db or flx_loc are reassigned.
+        '''
+        if self._site_index is None:
+            self._site_index = SiteIndex(self._img_db, self.icos_db, self._flx_loc)
+        return self._site_index
         
 
         
     
 ### QUALITY CHECKS ############################################################
 
+    @profiling.profiled
     def crs_and_cropping(self, icos_list, zip_path = None, date = None,
                         overwrite = False, save_csv = False):
         '''
@@ -531,10 +794,9 @@ class HSICOS():
         lats = [0]*len(icos_list)
         for j, site in enumerate(icos_list):
             if date:
-                datelist = self.img_db.loc[(self.img_db.name == site) &
-                                           (self.img_db.date == date), 'startdate'].dt.date
+                datelist = self.img_db.loc[self.site_index.rows(site, date), 'startdate'].dt.date
             else:
-                datelist = self.img_db.loc[self.img_db.name == site, 'startdate'].dt.date
+                datelist = self.img_db.loc[self.site_index.rows(site), 'startdate'].dt.date
             dtakes = self.img_db.loc[datelist.index, 'dataTakeID']
             
             if self.sensor == 'DESIS':
@@ -556,9 +818,9 @@ class HSICOS():
             
             # 1) Load flux locations
             epsg_tower_loc = self._crs_calc(site)
-            flx_loc = self.icos_db.loc[self.icos_db.name == site, 'geometry'].to_crs(3035)
-            lons[j] = self.icos_db.loc[self.icos_db.name == site, 'geometry'].item().x
-            lats[j] = self.icos_db.loc[self.icos_db.name == site, 'geometry'].item().y
+            flx_loc = self.site_index.geom(site, 3035)
+            lons[j] = self.site_index.geom(site).item().x
+            lats[j] = self.site_index.geom(site).item().y
             flx_roi_crop = flx_loc.buffer(3000) # lambert -> buffer in meters
             box_geom_crop = geometry.box(*flx_roi_crop.total_bounds)
             
@@ -682,7 +944,7 @@ class HSICOS():
         Helper function for retrieval of ICOS site geographic coordinates from
         database and calculation of matching UTM CRS for transformations.
         '''
-        lon = self.icos_db.loc[self.icos_db.name == site, 'geometry'].item().x
+        lon = self.site_index.geom(site).item().x
         if lon >= -12 and lon < -6:
             crs = 32629
         elif lon >= -6 and lon < 0:
@@ -702,6 +964,7 @@ class HSICOS():
                              'usual range for ICOS sites in Europe.')
         return crs
 
+    @profiling.profiled
     def hsi_qc(self, icos_list, clip_dist = [1.0, 2.0], date = None,
                overwrite = False, save = False):
         '''
@@ -734,16 +997,13 @@ class HSICOS():
 
         for j,site in enumerate(icos_list):
             if date == None:
-                datelist = self.img_db.loc[
-                    self.img_db.name == site, 'startdate'].dt.date
+                datelist = self.img_db.loc[self.site_index.rows(site), 'startdate'].dt.date
             else:
                 try:
                     dt.datetime.strptime(date, '%Y-%m-%d')
                 except ValueError:
                     raise ValueError('Incorrect date format, should be YYYY-MM-DD')
-                datelist = self.img_db.loc[(self.img_db.name == site) & \
-                                           (self.img_db.date == date),
-                                           'startdate'].dt.date
+                datelist = self.img_db.loc[self.site_index.rows(site, date), 'startdate'].dt.date
             dtakes = self.img_db.loc[datelist.index, 'dataTakeID']
             filestatus = [0]*len(datelist)
             filemissing = [-99]*len(datelist)
@@ -762,9 +1022,9 @@ class HSICOS():
                 logger.warning('No images found for site {}.'.format(site))
                 continue # early end of iteration if no data found 
             
-            epsg = self.flx_loc.loc[self.flx_loc.name == site, 'sensorcrs'].item()
+            epsg = self.site_index.epsg(site)
             crs_utm = proj.CRS.from_epsg(epsg)
-            flx_loc = self.icos_db.loc[self.icos_db.name == site, 'geometry'].to_crs(crs_utm)
+            flx_loc = self.site_index.geom(site, crs_utm)
             
             flx_roi = flx_loc.buffer(max(clip_dist)*1000)
             box_geom = geometry.box(*flx_roi.total_bounds)
@@ -915,24 +1175,15 @@ class HSICOS():
         cols = ['TIMESTAMP_START', 'TIMESTAMP_END', 'USTAR', 'V_SIGMA', 'MO_LENGTH', 'PBLH', 'WS', 'WD']
         l2_var_count = [0] * len(site_list)
         for i, site in enumerate(site_list):
-            icos_exp = self.icos_dir / ('ICOSETC_' + site + '_FLUXES_INTERIM_L2.csv')
-            if icos_exp.exists(): # Create file name template for single ICOS site
-                icos_v = 'ICOSETC_' + site + '_{}_INTERIM_L2.csv'
-            else:
-                icos_v = 'ICOSETC_' + site + '_{}_L2.csv'
-                
-            flx_hh = pd.read_csv(self.icos_dir / icos_v.format('FLUXES'),
-                                 date_format=self._df_icos, nrows=0,
-                                 parse_dates=cols[:2],
-                                 usecols=lambda x: x in cols)
+            header = self.icos_store.header(self.icos_store.icos_file(site, 'FLUXES'))
             tvar = cols[2:]
-            if pd.Series(tvar).isin(flx_hh.columns[2:]).all():
+            if pd.Series(tvar).isin(header).all():
                 l2_var_count[i] = 6
                 logger.info('{}: Full L2 vars'.format(site))
-            elif pd.Series(tvar[0:4]).isin(flx_hh.columns[2:]).all():
+            elif pd.Series(tvar[0:4]).isin(header).all():
                 l2_var_count[i] = 4
                 logger.info('{}: Only missing WS, WD'.format(site))
-            elif pd.Series(tvar[0:3]).isin(flx_hh.columns[2:]).all():
+            elif pd.Series(tvar[0:3]).isin(header).all():
                 l2_var_count[i] = 3
                 logger.info('{}: Missing PBLH and/or WS, WD -> era_blh site!'.format(site))
             else:
@@ -959,6 +1210,7 @@ class HSICOS():
 
 #### COPERNICUS CDS/WEKEO FUNCTIONS ###########################################
 
+    @profiling.profiled
     def icos_cds_get(self, icos_list, eobs = False, version = '27.0e',
                      ts = True, suffix = None):
         '''
@@ -986,7 +1238,7 @@ class HSICOS():
 
         for i,site in enumerate(icos_list):
             c = cdsapi.Client()
-            flx_loc = self.icos_db.loc[self.icos_db.name == site, 'geometry']
+            flx_loc = self.site_index.geom(site)
             if (not 30 < flx_loc.y.item() < 70) or not (-15 < flx_loc.x.item() < 45):
                 raise ValueError('Coordinates for {} are out of '.format(site) +
                                  'the usual range for ICOS sites in Europe.' +
@@ -1005,18 +1257,18 @@ class HSICOS():
                     'area': [ext.maxy, ext.minx, ext.miny, ext.maxx],
                     }
             else:
-                epsg = self.flx_loc.loc[self.flx_loc.name == site, 'sensorcrs'].item()
+                epsg = self.site_index.epsg(site)
                 crs_utm = proj.CRS.from_epsg(epsg)
                 flx_loc = flx_loc.to_crs(crs_utm)
                 ext = flx_loc.buffer(100, cap_style=3).bounds.squeeze(axis=0)
                 if ts == True:
-                    datelist = self.img_db.loc[self.img_db.name == site,
+                    datelist = self.img_db.loc[self.site_index.rows(site),
                                                'startdate'].dt.strftime('%Y-%m-%d %H:%M').tolist()
                 else:
                     datelist = [dt.datetime.date(x).isoformat() for x in self.img_db['startdate']]
                     # round to 1h to match corresp. ERA5 time slices
-                    times = self.img_db.loc[self.img_db.name == site,
-                                       'startdate'].dt.round('1h').dt.time.unique()
+                    times = self.img_db.loc[self.site_index.rows(site),
+                                            'startdate'].dt.round('1h').dt.time.unique()
                     timelist = [x.strftime('%H:%M') for x in times]
                     timelist.sort()
                 
@@ -1040,11 +1292,15 @@ class HSICOS():
             cdspath = self.icos_dir / site
             cdspath.mkdir(parents=True, exist_ok=True)
             if eobs:
-                request.download(cdspath / 'e-obs_meteo_large.zip')
+                fpath = cdspath / 'e-obs_meteo_large.zip'
             else:
-                request.download(cdspath / ('era5_pblh_' + suffix + '.nc'))
+                fpath = cdspath / ('era5_pblh_' + suffix + '.nc')
+            with profiling.timer('download', site=site) as t:
+                request.download(fpath)
+                t.add(bytes=fpath.stat().st_size if profiling.enabled() else 0)
         return
 
+    @profiling.profiled
     def icos_eobs_pet(self, icos_list, overwrite = False):
         '''
         Extracts E-OBS precipitation and temperature data for ICOS site(s).
@@ -1084,7 +1340,7 @@ class HSICOS():
                                'Last DOY is not 365 but {}'.format(eobs_tg_t[-1]))
             eobs_tg_times = pd.to_datetime(datasets0[0].time.values)
             
-            flx_loc = self.icos_db.loc[self.icos_db.name == site, 'geometry']
+            flx_loc = self.site_index.geom(site)
             lat_flx = flx_loc.y.item()
             lon_flx = flx_loc.x.item()
             lat_r = pyeto.deg2rad(lat_flx)  # Convert latitude to radians
@@ -1177,7 +1433,7 @@ class HSICOS():
         era5 = xr.open_dataset(self.icos_dir / icos_site / nc_name)
         
         era5_times = pd.to_datetime(era5.blh.time.values)
-        img_db_site = self.img_db[self.img_db.name == icos_site]
+        img_db_site = self.img_db.loc[self.site_index.rows(icos_site)]
         pblh = [0]*len(img_db_site)
         for i,idate in enumerate(img_db_site.startdate.dt.round('1h')):
             ts = nearest(era5_times, idate)
@@ -1194,6 +1450,7 @@ class HSICOS():
             raise ValueError('NaN value detected in ERA5 derived PBLH values.')
         return pblh
 
+    @profiling.profiled
     def update_img_db(self, img_csv, era_blh = None, nc_name = None, save = False): #only docstring yet corrected for spyder help window formatting
         '''
         Update 'img_db' data frame after manual modifications have been made
@@ -1260,7 +1517,7 @@ class HSICOS():
             self.img_db['era_pblh'] = 0
             for site in self._era_blh:
                 pblh_values = self._icos_era5_pblh(site, nc_name = nc_name)
-                self.img_db.loc[self.img_db.name == site, 'era_pblh'] = pblh_values
+                self.img_db.loc[self.site_index.rows(site), 'era_pblh'] = pblh_values
         else:
             self._era_blh = []
             
@@ -1276,6 +1533,29 @@ class HSICOS():
 
 ### ICOS FUNCTIONS ############################################################
 
+    def icos_ingest(self, icos_list, force = False):
+        '''
+        Converts the half-hourly ICOS L2 CSVs (FLUXNET_HH, FLUXES, METEO) of
+        the given sites to the Parquet cache (self.icos_cache). Files are
+        only converted again if their modification time or size changed.
+        Otherwise, conversion happens on first use in _load_icos_subset.
+        
+        Args:
+            icos_list (string or list of strings): Abbreviation of the ICOS
+                site(s).
+            force (bool, optional): If true, all caches are rebuilt.
+        '''
+        from fmch.icos_cache import ingest_icos_csv
+        if self.icos_cache is None:
+            raise ValueError('No ICOS cache directory set (HSICOS(..., icos_cache=True)).')
+        if isinstance(icos_list, str):
+            icos_list = [icos_list]
+        for site in (pbar := tqdm(icos_list)):
+            pbar.set_description(f'Ingesting {site}')
+            for fpath in sorted(self.icos_dir.glob(f'ICOSETC_{site}_*.csv')):
+                if any(x in fpath.name for x in ['_FLUXNET_HH_', '_FLUXES_', '_METEO_']):
+                    ingest_icos_csv(fpath, self.icos_cache, force=force)
+
     def _ppfd_check(self, site_list):
         '''
         A helper function to find out which ICOS station data does not include
@@ -1286,28 +1566,15 @@ class HSICOS():
         '''
         no_ppfd = []
         no_rad = []
-        cols = ['TIMESTAMP_START', 'TIMESTAMP_END', 'PPFD_IN', 'SW_IN_F']
         for i, site in enumerate(site_list):
-            flux_exp = self.icos_dir / 'ICOSETC_{}_FLUXNET_HH_INTERIM_L2.csv'.format(site)
-            if flux_exp.exists(): # Create file name template for single ICOS site
-                pass
-            else:
-                flux_exp = self.icos_dir / 'ICOSETC_{}_FLUXNET_HH_L2.csv'.format(site)
-                if flux_exp.exists():
-                    pass
-                else:
-                    try:
-                        flux_exp = next(self.icos_dir.glob('FLX_{}_FLUXNET*.csv'.format(site)))
-                    except StopIteration:
-                        raise RuntimeError('{}: No FLUXNET csv found.'.format(site))
-                
-            flx_gpp = pd.read_csv(flux_exp, date_format=self._df_icos,
-                                  nrows=0, parse_dates=cols[:2],
-                                  usecols=lambda x: x in cols)
+            flux_exp = self.icos_store.fluxnet_file(site)
+            if flux_exp is None:
+                raise RuntimeError('{}: No FLUXNET csv found.'.format(site))
+            header = self.icos_store.header(flux_exp)
             tvar = ['PPFD_IN', 'SW_IN_F']
-            if ~pd.Series(tvar[0]).isin(flx_gpp.columns).all(): # if PPFD not in columns
+            if ~pd.Series(tvar[0]).isin(header).all(): # if PPFD not in columns
                 no_ppfd.append(site)
-            elif ~pd.Series(tvar).isin(flx_gpp.columns).all(): # if neither variable is in columns
+            elif ~pd.Series(tvar).isin(header).all(): # if neither variable is in columns
                 no_rad.append(site)
         if len(no_ppfd) > 0:
             logger.info('ICOS site(s) {} dont have PPFD '.format(no_ppfd) +
@@ -1370,8 +1637,100 @@ class HSICOS():
         return flx_anc_w, D_hdates, D_avg
     
 
+    def _height_tables(self, icos_site, icos_v, igbp_class):
+        '''
+        Canopy height (ANCILLARY) and EC sensor height (INST) histories of an
+        ICOS site, memoized in self.icos_store. Returns a dict with the
+        sorted measurement / installation dates and heights ('D_dates',
+        'D_vals', 'Z_dates', 'Z_vals', see _height_history), the flags for
+        averaged (D_avg) and default (D_default) canopy heights and the
+        constant canopy height D (None if height varies with time).
+        '''
+        return self.icos_store.memo(
+            ('heights', icos_site),
+            lambda: self._build_height_tables(icos_site, icos_v, igbp_class))
+
+    def _build_height_tables(self, icos_site, icos_v, igbp_class):
+        flx_anc_w, D_hdates = None, None
+        D_avg, D_default, D = False, False, None
+        # Import 75th percentile of canopy height
+        flx_anc = self.icos_store.table(self.icos_dir / icos_v.format('ANCILLARY'),
+                                        encoding = 'unicode_escape')
+        if igbp_class in ['DBF', 'ENF', 'EBF', 'MF']:
+            if flx_anc.VARIABLE_GROUP.isin(['GRP_TREE_HEIGHT']).any():
+                flx_anc_w = flx_anc[flx_anc.VARIABLE_GROUP == 'GRP_TREE_HEIGHT'] \
+                    .pivot(index='GROUP_ID', columns='VARIABLE', values='DATAVALUE')
+                # Serach for 75th perc. where HEIGHTC_SPP is NaN (to get value for whole stand)
+                D_gid0 = flx_anc_w.loc[(flx_anc_w.HEIGHTC_STATISTIC == '75th Percentile')
+                                       & flx_anc_w.HEIGHTC_SPP.isnull() , :].index
+                try:
+                    D_hdates = pd.to_datetime(flx_anc_w.loc[
+                        flx_anc_w.index.isin(D_gid0), 'HEIGHTC_DATE_START']).dt.date
+                    if D_hdates.isnull().any():
+                        logger.error('{}: Inconsistent variable names detected in ICOS metadata. Workaround might cause problems.'.format(icos_site))
+                        nix = D_hdates[D_hdates.isnull()].index.values
+                        D_hdates[nix] = pd.to_datetime(flx_anc_w.loc[
+                            flx_anc_w.index.isin(nix), 'HEIGHTC_DATE']).dt.date
+                except KeyError:
+                    D_hdates = pd.to_datetime(flx_anc_w.loc[
+                        flx_anc_w.index.isin(D_gid0), 'HEIGHTC_DATE']).dt.date
+
+            elif flx_anc.VARIABLE_GROUP.isin(['GRP_HEIGHTC']).any(): # Sonderfall DE-Hai
+                flx_anc_w, D_hdates, D_avg = self._icos_height_aux(flx_anc, icos_site)
+            else:
+                raise KeyError('Ancillary file for ICOS site {} '.format(icos_site) +
+                               'holds no data about vegetation height.')
+        
+        elif igbp_class in ['CRO', 'GRA', 'OSH', 'CSH', 'SAV', 'WSA']:
+            flx_anc_w, D_hdates, D_avg = self._icos_height_aux(flx_anc, icos_site)
+            
+        elif igbp_class == 'WET':
+            D_default = True
+            logger.info('Using default value for canopy height for wetland' +
+                        ' site {} (D = 0.1m)'.format(icos_site))
+            D = 0.1 # default low vegetation height for bogs as no height is reported
+        
+        #elif igbp_class in ['OSH', 'CSH']:
+        #    D_default = True
+        #    logger.info('Using default value for canopy height for' +
+        #                ' shrubland site {} (D = 1.5m)'.format(icos_site))
+        #    D = 1.5
+        # Might add more classes, e.g. ES-Cnd is a WSA (woody savanna) site but ICOS L2 data are not available yet
+        if D_avg == True:
+            D = flx_anc_w.loc[D_hdates.index, 'HEIGHTC'].astype(float).mean()
+            
+        # Import sensor height
+        flx_ins = self.icos_store.table(self.icos_dir / icos_v.format('INST'),
+                                        on_bad_lines='skip')
+            
+        flx_ins_w = flx_ins[flx_ins.VARIABLE_GROUP == 'GRP_INSTOM'] \
+            .pivot(index='GROUP_ID', columns='VARIABLE', values='DATAVALUE')
+    
+        # Filter for EC sensor installation IDs and extract dates
+        if len(flx_ins_w.loc[flx_ins_w.INSTOM_MODEL.str.contains('LI-COR'), 'INSTOM_HEIGHT']) > 0:
+            senstr = 'LI-COR'
+        elif len(flx_ins_w.loc[flx_ins_w.INSTOM_MODEL.str.contains('Campbell EC'), 'INSTOM_HEIGHT']) > 0:
+            senstr = 'Campbell EC'
+        else:
+            raise KeyError('Unknown EC sensor model. Please check your ICOS ' +
+                           'instrument metadata.')
+        Z_gid0 = flx_ins_w.loc[flx_ins_w.INSTOM_MODEL.str.contains(senstr) & \
+                               (flx_ins_w.INSTOM_TYPE == 'Installation') , :].index        
+        Z_hdates0 = pd.to_datetime(flx_ins_w.loc[flx_ins_w.index.isin(Z_gid0), 'INSTOM_DATE']).dt.date
+        Z_dates, Z_vals = _height_history(
+            Z_hdates0.values, flx_ins_w.loc[Z_hdates0.index, 'INSTOM_HEIGHT'])
+        if D_hdates is None:
+            D_dates, D_vals = np.array([], dtype='datetime64[D]'), np.array([])
+        else:
+            D_dates, D_vals = _height_history(
+                D_hdates.values, flx_anc_w.loc[D_hdates.index, 'HEIGHTC'])
+        return {'D_avg': D_avg, 'D_default': D_default, 'D': D,
+                'D_dates': D_dates, 'D_vals': D_vals,
+                'Z_dates': Z_dates, 'Z_vals': Z_vals}
+
+
     def _load_icos_subset(self, icos_site, datelist, fluxvars, aggregate = 'na',
-                          ppfd_missing = [], zonal = False):
+                          ppfd_missing = [], zonal = False, flux_windows = None):
         '''
         Reads a number of ICOS level 2 CSV files (FLUXES, FLUXNET_HH,
         ANCILLARY, INST, if applicable METEO) to extract information on meteo-
@@ -1395,33 +1754,30 @@ class HSICOS():
             zonal (bool, optional): If true, no footprints will be calculated
                 and the import of ICOS data will be restricted to fluxes only
                 (no meteorological variables required).
+            flux_windows (dict, optional): Multi-day aggregation windows of
+                all flux variables {name: spec} (see FLUX_WINDOW_DEFAULTS),
+                added as columns '<var>_<name>' and to the returned fluxvars.
         '''
         timelist = self.img_db.loc[datelist.index, 'icostime']
         datetimes = pd.to_datetime(datelist.astype(str) + " " + timelist.astype(str))
-        D_avg = False
-        D_default = False
-        ZM = [-9999]*len(datelist)
-        missd = [pd.Timestamp('19000101 00:00:00')] # return dummy
         
         dc = ['TIMESTAMP_START', 'TIMESTAMP_END']
         cols_gpp = dc + fluxvars
-        flux_exp = self.icos_dir / ('ICOSETC_' + icos_site + '_FLUXNET_HH_INTERIM_L2.csv')
-        if flux_exp.exists(): # Create file name template for single ICOS site
-            icos_v = 'ICOSETC_' + icos_site + '_{}_INTERIM_L2.csv'
+        flux_exp = self.icos_store.icos_file(icos_site, 'FLUXNET_HH')
+        if flux_exp is not None: # Create file name template for single ICOS site
+            icos_v = flux_exp.name.replace('FLUXNET_HH', '{}')
         else:
-            flux_exp = self.icos_dir / 'ICOSETC_{}_FLUXNET_HH_L2.csv'.format(icos_site)
-            if flux_exp.exists():
-                icos_v = 'ICOSETC_' + icos_site + '_{}_L2.csv'
-            else:
-                flux_exp = next(self.icos_dir.glob('FLX_{}_FLUXNET*.csv'.format(icos_site)))
-                if zonal == False:
-                    raise RuntimeError('''{}: Site data only available in FLUXNET
-                                       format but zonal is False. Calculation of
-                                       FFs is only possible for data in ICOS format.''')
+            flux_exp = self.icos_store.fluxnet_file(icos_site)
+            if flux_exp is None:
+                raise RuntimeError('{}: No FLUXNET csv found.'.format(icos_site))
+            elif zonal == False:
+                raise RuntimeError('''{}: Site data only available in FLUXNET
+                                   format but zonal is False. Calculation of
+                                   FFs is only possible for data in ICOS format.''')
             
         # Import GPP percentiles from ensemble (daytime & nighttime)
-        flx_gpp = pd.read_csv(flux_exp, date_format=self._df_icos,
-                              parse_dates=dc, usecols=lambda x: x in cols_gpp)
+        flx_gpp = self.icos_store.hh(flux_exp, cols_gpp, datelist,
+                                     window=_window_reach(flux_windows))
     
         # Reference date to deal with missing flux data
         # not so elegant... maybe sort unsuitable imagery out before?
@@ -1433,15 +1789,13 @@ class HSICOS():
         # SW_IN is always added to the output data frame. PPFD_IN is converted to
         # PAR if available.
         if icos_site not in ppfd_missing:
-            flx_gpp_temp0 = flx_gpp.loc[flx_gpp.TIMESTAMP_END.dt.date.isin(datelist),
-                                       cols_gpp[1:]]
+            flx_gpp_temp0 = flx_gpp.loc[:, cols_gpp[1:]] # records of datelist (& windows) only
             flx_gpp_temp0['PAR'] = flx_gpp_temp0.PPFD_IN / 4.57
             flx_gpp_temp0.drop('PPFD_IN', axis=1, inplace=True)
             fluxvars = [x for x in fluxvars if x != 'PPFD_IN'] + ['PAR']
         else: # If PPFD not available, it's estimated from SW_IN instead.
             fluxvars = [x for x in fluxvars if x != 'PPFD_IN']
-            flx_gpp_temp0 = flx_gpp.loc[flx_gpp.TIMESTAMP_END.dt.date.isin(datelist),
-                                       ['TIMESTAMP_END'] + fluxvars]
+            flx_gpp_temp0 = flx_gpp.loc[:, ['TIMESTAMP_END'] + fluxvars]
             flx_gpp_temp0['PAR'] = flx_gpp_temp0.SW_IN_F * 0.47 # average PAR/SI ratio
             fluxvars = fluxvars + ['PAR']
         '''ICOS PPFD 400-700 nm: http://archive.sciendo.com/INTAG/intag.2017.32.issue-4/intag-2017-0049/intag-2017-0049.pdf
@@ -1458,10 +1812,16 @@ class HSICOS():
                 (flx_gpp_temp0.PAR == -9999) & (flx_gpp_temp0.SW_IN_F > 0)].index
             flx_gpp_temp0.loc[correct_rows, 'PAR'] = flx_gpp_temp0.loc[correct_rows, 'SW_IN_F'] * 0.47
             
+        # multi-day windows of all flux variables (one pass over daily sums)
+        if flux_windows:
+            flx_win = _window_aggregates(flx_gpp_temp0, fluxvars, datelist.values,
+                                         flux_windows)
+        
         # to exclude invalid values from potential aggregation
         exclude_rows = flx_gpp_temp0[(flx_gpp_temp0.loc[:,fluxvars[:9]] == -9999).any(axis=1)].index
-        # 'time's in timelist are already tz:CET! -> reduce to 1 row per HSI
-        flx_gpp_temp = flx_gpp_temp0.loc[flx_gpp_temp0.TIMESTAMP_END.isin(datetimes), :]
+        # 'time's in timelist are already tz:CET! -> 1 row per HSI, acquisitions
+        # without ICOS record are flagged in column 'icos_missing'
+        flx_gpp_temp = _match_records(flx_gpp_temp0, datetimes)
         
         # only certain flux columns (fluxvars[:9]) are aggregated, QC columns and radiation fluxes are excluded (unaggregated PAR required for UPW transformation)
         if aggregate == 'mean': # for mean, night values have to be dropped for GPP
@@ -1479,180 +1839,98 @@ class HSICOS():
             fluxvars[:9] = ['{}_sum'.format(x) for x in fluxvars[:9]]
 
         if aggregate != 'na':
+            # daily aggregates of the acquisition dates replace the half-hourly values
             flx_gpp_aggr.columns = fluxvars[:9]
-            # join aggregated fluxes with unaggregated columns and add timestamp
-            flx_gpp_aggr = pd.merge(flx_gpp_aggr, flx_gpp_temp[fluxvars[9:]], how='left',
-                                    left_index=True, right_on=flx_gpp_temp.TIMESTAMP_END.dt.date)
-            flx_gpp_aggr.insert(0, 'TIMESTAMP_END', flx_gpp_temp.TIMESTAMP_END.values)
-            flx_gpp_temp = flx_gpp_aggr.drop('key_0', axis=1)
-        # add missing dates back in
-        if len(datelist) > flx_gpp_temp.shape[0]:
-            ds1 = set(datetimes.tolist())
-            ds2 = set(flx_gpp_temp.TIMESTAMP_END)
-            missd = list(ds1.difference(ds2))
-            add = pd.DataFrame(np.full((len(missd), len(fluxvars)+1), -9999))
-            add.columns = [dc[1]] + fluxvars
-            add.iloc[:, 0] = missd
-            flx_gpp_temp = pd.concat([flx_gpp_temp, add], axis=0)
-            flx_gpp_temp.sort_values(by=dc[1], inplace=True)
-            logger.debug('date(s) missing in flx_gpp_temp: {}'.format(missd))
-            logger.debug('added NA row(s): {}'.format(add))
+            flx_gpp_aggr = flx_gpp_aggr.reindex(datelist.values).reset_index(drop=True)
+            flx_gpp_temp = pd.concat([flx_gpp_temp[['TIMESTAMP_END']], flx_gpp_aggr,
+                                      flx_gpp_temp[fluxvars[9:] + ['icos_missing']]], axis=1)
+        if flux_windows:
+            flx_gpp_temp = pd.concat([flx_gpp_temp, flx_win], axis=1)
+            fluxvars = fluxvars + flx_win.columns.tolist()
+        if flx_gpp_temp.icos_missing.any():
+            logger.debug('{}: acquisition(s) without ICOS record: {}'.format(
+                icos_site, flx_gpp_temp.loc[flx_gpp_temp.icos_missing, 'TIMESTAMP_END'].tolist()))
 
         if zonal: # Only insert TS and return before FF calc.
-            icos_subset = flx_gpp_temp.reset_index(drop=True)
-            return icos_subset, ZM, fluxvars, missd
+            icos_subset = flx_gpp_temp.replace(np.nan, -9999)
+            return icos_subset, [-9999]*len(datelist), fluxvars
         
         cols_flx = ['USTAR', 'V_SIGMA', 'MO_LENGTH', 'PBLH', 'WS', 'WD']
         cols = dc + cols_flx
-        igbp_class = self.icos_db.loc[self.icos_db.name == icos_site, 'ecosystem'].item()
+        igbp_class = self.site_index.icos(icos_site, 'ecosystem')
         # Import micrometeo. data and NEE
-        flx = pd.read_csv(self.icos_dir / icos_v.format('FLUXES'),
-                          date_format=self._df_icos,
-                          parse_dates=dc, usecols=lambda x: x in cols)
-        
-        # Import 75th percentile of canopy height
-        flx_anc = pd.read_csv(self.icos_dir / icos_v.format('ANCILLARY'),
-                              encoding = 'unicode_escape')
-        if igbp_class in ['DBF', 'ENF', 'EBF', 'MF']:
-            if flx_anc.VARIABLE_GROUP.isin(['GRP_TREE_HEIGHT']).any():
-                flx_anc_w = flx_anc[flx_anc.VARIABLE_GROUP == 'GRP_TREE_HEIGHT'] \
-                    .pivot(index='GROUP_ID', columns='VARIABLE', values='DATAVALUE')
-                # Serach for 75th perc. where HEIGHTC_SPP is NaN (to get value for whole stand)
-                D_gid0 = flx_anc_w.loc[(flx_anc_w.HEIGHTC_STATISTIC == '75th Percentile')
-                                       & flx_anc_w.HEIGHTC_SPP.isnull() , :].index
-                try:
-                    D_hdates = pd.to_datetime(flx_anc_w.loc[
-                        flx_anc_w.index.isin(D_gid0), 'HEIGHTC_DATE_START']).dt.date
-                    if D_hdates.isnull().any():
-                        logger.error('{}: Inconsistent variable names detected in ICOS metadata. Workaround might cause problems.'.format(icos_site))
-                        nix = D_hdates[D_hdates.isnull()].index.values
-                        D_hdates[nix] = pd.to_datetime(flx_anc_w.loc[
-                            flx_anc_w.index.isin(nix), 'HEIGHTC_DATE']).dt.date
-                except KeyError:
-                    D_hdates = pd.to_datetime(flx_anc_w.loc[
-                        flx_anc_w.index.isin(D_gid0), 'HEIGHTC_DATE']).dt.date
-
-            elif flx_anc.VARIABLE_GROUP.isin(['GRP_HEIGHTC']).any(): # Sonderfall DE-Hai
-                flx_anc_w, D_hdates, D_avg = self._icos_height_aux(flx_anc, icos_site)
-            else:
-                raise KeyError('Ancillary file for ICOS site {} '.format(icos_site) +
-                               'holds no data about vegetation height.')
-        
-        elif igbp_class in ['CRO', 'GRA', 'OSH', 'CSH', 'SAV', 'WSA']:
-            flx_anc_w, D_hdates, D_avg = self._icos_height_aux(flx_anc, icos_site)
-            
-        elif igbp_class == 'WET':
-            D_default = True
-            logger.info('Using default value for canopy height for wetland' +
-                        ' site {} (D = 0.1m)'.format(icos_site))
-            D = 0.1 # default low vegetation height for bogs as no height is reported
-        
-        #elif igbp_class in ['OSH', 'CSH']:
-        #    D_default = True
-        #    logger.info('Using default value for canopy height for' +
-        #                ' shrubland site {} (D = 1.5m)'.format(icos_site))
-        #    D = 1.5
-        # Might add more classes, e.g. ES-Cnd is a WSA (woody savanna) site but ICOS L2 data are not available yet
-        if D_avg == True:
-            D = flx_anc_w.loc[D_hdates.index, 'HEIGHTC'].astype(float).mean()
-            
-        # Import sensor height
-        flx_ins = pd.read_csv(self.icos_dir / icos_v.format('INST'), on_bad_lines='skip')
-            
-        flx_ins_w = flx_ins[flx_ins.VARIABLE_GROUP == 'GRP_INSTOM'] \
-            .pivot(index='GROUP_ID', columns='VARIABLE', values='DATAVALUE')
-    
-        # Filter for EC sensor installation IDs and extract dates
-        if len(flx_ins_w.loc[flx_ins_w.INSTOM_MODEL.str.contains('LI-COR'), 'INSTOM_HEIGHT']) > 0:
-            senstr = 'LI-COR'
-        elif len(flx_ins_w.loc[flx_ins_w.INSTOM_MODEL.str.contains('Campbell EC'), 'INSTOM_HEIGHT']) > 0:
-            senstr = 'Campbell EC'
+        flx = self.icos_store.hh(self.icos_dir / icos_v.format('FLUXES'), cols, datelist)
+        
+        # Canopy & sensor height histories (parsed once per site)
+        ht = self._height_tables(icos_site, icos_v, igbp_class)
+        # Canopy height from the measurement closest to the image acq. date,
+        # sensor height from the last installation before acq. date (or the
+        # first installation if the image was taken before).
+        idates = np.asarray(datelist.values, dtype='datetime64[D]')
+        if ht['D_avg'] or ht['D_default']:
+            D = np.full(len(idates), ht['D'])
         else:
-            raise KeyError('Unknown EC sensor model. Please check your ICOS ' +
-                           'instrument metadata.')
-        Z_gid0 = flx_ins_w.loc[flx_ins_w.INSTOM_MODEL.str.contains(senstr) & \
-                               (flx_ins_w.INSTOM_TYPE == 'Installation') , :].index        
-        Z_hdates0 = pd.to_datetime(flx_ins_w.loc[flx_ins_w.index.isin(Z_gid0), 'INSTOM_DATE']).dt.date
-        # Swap index and gid values and truncate installation dates after image acq. date.
-        Z_hdates = pd.Series(Z_hdates0.index.values, index=Z_hdates0).sort_index() # truncate requires sorted index
-        # now I want to compare the entries to get height meas. from a date closest
-        # to image acq. date (for canopy height) or the last entry before acq.
-        # date (for sensor height).    
-        for i, idate in enumerate(datelist):
-            if idate in [x.date() for x in missd]:
-                continue
-            else:
-                if (D_avg == True) | (D_default == True):
-                    pass
-                else:
-                    D_gid = D_hdates[D_hdates == nearest(D_hdates.values, idate)].index[-1] # Find nearest date and in case of multiple entries, choose last
-                    D = flx_anc_w.loc[flx_anc_w.index == D_gid, 'HEIGHTC'].astype(float).item()
-                try:
-                    Z_gid = Z_hdates.truncate(after=idate)[-1] # Use last valid installation date.
-                except IndexError: # if image date is before official installation date, use first installation date
-                    Z_gid = Z_hdates[0]
-                Z = flx_ins_w.loc[flx_ins_w.index == Z_gid, 'INSTOM_HEIGHT'].astype(float).item()
-                if D > Z:
-                    raise ValueError('Canopy height D > sensor height Z. Please check your ICOS ancillary metadata.')
-                ZM[i] = Z-D
-        
-        # Reduce DF to dates of interest (all records for days of interest) and concatenate
+            D = ht['D_vals'][_nearest_date_ix(ht['D_dates'], idates)]
+        Z = ht['Z_vals'][np.clip(np.searchsorted(ht['Z_dates'], idates, side='right') - 1,
+                                 0, None)]
+        valid = ~flx_gpp_temp.icos_missing.values
+        if (D > Z)[valid].any():
+            raise ValueError('Canopy height D > sensor height Z. Please check your ICOS ancillary metadata.')
+        ZM = np.where(valid, Z - D, -9999).tolist()
+        
+        # Match micromet. records to the acquisitions and concatenate
         if icos_site in self._era_blh:
-            flx0 = flx.loc[flx.TIMESTAMP_END.dt.date.isin(datelist),
-                           ['TIMESTAMP_END'] + cols_flx[:3]]
-            flx_met0 = pd.read_csv(self.icos_dir / icos_v.format('METEO'),
-                                   date_format=self._df_icos, parse_dates=dc)
-            flx_met = flx_met0.loc[flx_met0.TIMESTAMP_END.dt.date.isin(datelist),
-                                   cols_flx[4:]]
-            flx_temp = pd.concat([flx0.reset_index(drop=True),
-                                  flx_met.reset_index(drop=True)], axis=1)
+            flx0 = _match_records(flx, datetimes)[cols_flx[:3]]
+            flx_met0 = self.icos_store.hh(self.icos_dir / icos_v.format('METEO'),
+                                          dc + cols_flx[4:], datelist)
+            flx_met = _match_records(flx_met0, datetimes)[cols_flx[4:]]
+            flx_temp = pd.concat([flx0, flx_met], axis=1)
         else:
-            flx_temp = flx.loc[flx.TIMESTAMP_END.dt.date.isin(datelist),
-                               cols[1:]]
+            flx_temp = _match_records(flx, datetimes)[cols_flx]
         # flx_temp is not aggregated as micromet. data is only required for FF modeling
-        icos_subset = pd.merge(flx_gpp_temp.reset_index(drop=True),
-                               flx_temp.reset_index(drop=True),
-                               how='left', on='TIMESTAMP_END')
+        icos_subset = pd.concat([flx_gpp_temp, flx_temp], axis=1)
         icos_subset.replace(np.nan, -9999, inplace=True)
         # Final ICOS subset only contains 1 row per HSI
-        return icos_subset, ZM, fluxvars, missd
+        return icos_subset, ZM, fluxvars
 
 
 ### FF & CROPPING FUNCTIONS ###################################################
     
     def _model_geoms(self, icos_site, datelist, icos_subset, response, ZM,
-                     fluxvars, missd, zonal = False, upw = False):
+                     fluxvars, zonal = False, upw = False, ff_weights = False):
         '''
         Calculates geometries matching the timestamps of hyperspectral imagery
         in 'img_db' (either flux footprints or buffers). Uses the external
-        'FFP' function from the flux footprint modeling module from Kljun et al.
+        'FFP_batch' function from the flux footprint modeling module from Kljun et al.
+        (all footprints of a site in a single call).
         
         Args:
             icos_site (string): Abbreviation of the ICOS site.
             datelist (pandas.Series): Dates of available imagery for the
                 selected ICOS site.
-            icos_subset (pandas.DataFrame): Subset of ICOS L2 data cut to the
-                dates of interest (single site!). Contains fluxes and if
-                necessary micrometeorological variables for FF modeling.
+            icos_subset (pandas.DataFrame): ICOS L2 records matched to the
+                acquisitions in datelist (single site!, one row per acqui-
+                sition). Contains fluxes, if necessary micrometeorological
+                variables for FF modeling and the flag 'icos_missing'.
             ZM (list): Differences between observation & vegetation height.
             fluxvars (list of strings): ICOS variable names of ecosystem fluxes
                 (CO2, radiation, ...) to be imported.
-            missd (list of pd.Timestamps): dates from datelist for which ICOS
-                data is completely missing.
             zonal (bool, optional): If true, zonal statistics (buffer value
                 depending on ecosystem) will be calculated instead of FFs.
+            ff_weights (bool, optional): If true, the FFP inputs are added to
+                the output (columns 'ff_zm', 'ff_ws', ..., and 'ff_era5' if
+                PBLH is taken from ERA5) so that pixels can be weighted by the
+                footprint in _crop_data_2_geoms.
         '''
         timelist = self.img_db.loc[datelist.index, 'icostime']
         dtakes = self.img_db.loc[datelist.index, 'dataTakeID']
-        ff_params = [0]*len(datelist)
         
         # Project to Lambert Azimuthal Equal Area (LAEA) for collection of european geometries in a single gdf
         crs_lam = proj.CRS.from_epsg('3035')
-        flx_loc = self.icos_db.loc[self.icos_db.name == icos_site,
-                                   'geometry'].to_crs(crs_lam)
+        flx_loc = self.site_index.geom(icos_site, crs_lam)
         
         if zonal:
-            ecosystem = self.icos_db.loc[self.icos_db.name == icos_site, 'ecosystem'].item()
+            ecosystem = self.site_index.icos(icos_site, 'ecosystem')
             if ecosystem in ['MF', 'DBF', 'EBF', 'ENF']:
                 zr = 80
             elif ecosystem in ['SAV', 'WSA']:
@@ -1671,40 +1949,54 @@ class HSICOS():
         else:
             geoms = [None]*len(datelist)
             checkvar = ['WS', 'PBLH', 'MO_LENGTH', 'V_SIGMA', 'USTAR', 'WD', response]
+        ff_ix = [] # acquisitions with complete FFP inputs
         
         #transformer = proj.Transformer.from_crs(4326, crs_utm, always_xy=True)
         #x, y = transformer.transform(lon, lat)
-        for i,date in enumerate(datelist):
-            ff_params[i] = icos_subset.loc[
-                icos_subset.TIMESTAMP_END.dt.date == date, :].squeeze(axis=0) # squeeze creates series instead of 1D DF
-            if icos_site in self._era_blh:
-                pblh = pd.Series([self.img_db.loc[datelist.index[i],
-                                              'era_pblh']], index=['PBLH'])
-                ff_params[i] = ff_params[i].append(pblh)
-            # In case of Nodata values in ICOS data, no FF can be calculated
-            check9999 = ff_params[i][checkvar].isin([-9999]).any()
-            checkdate = (date in [x.date() for x in missd])
-            if check9999 | checkdate:
-                self.img_db.loc[(self.img_db.name == icos_site) &
-                                (self.img_db.dataTakeID == dtakes.iloc[i]),
-                                'clouds'] = 'icos_na'
-                logger.debug('{}: No ICOS data available for {} image {} from {}.'\
-                             .format(icos_site, self.sensor, dtakes.iloc[i],
-                                       datelist.iloc[i]))
-                #ff_params[i] = pd.Series(data=[0]*len(fluxvars), index=fluxvars) # probably unneeded
-            # Estimate 80th (and 50th) percentile of flux footprint with Kljun model
-            if zonal:
-                continue
-            else:
-                ff = ffp.FFP(zm=ZM[i], umean=ff_params[i].WS, h=ff_params[i].PBLH,
-                                 ol=ff_params[i].MO_LENGTH, sigmav=ff_params[i].V_SIGMA,
-                                 ustar=ff_params[i].USTAR, wind_dir=ff_params[i].WD,
-                                 rs=[50., 80.], fig=0)
-            
-                # Compute FF coordinates & create geometry. Uses 80% FF contribution area (index 1)
-                xs = [round(xoff + flx_loc.x.item(), 2) for xoff in ff['xr'][1]]
-                ys = [round(yoff + flx_loc.y.item(), 2) for yoff in ff['yr'][1]]
-                geoms[i] = Polygon(zip(xs, ys))
+        ff_params = icos_subset.reset_index(drop=True)
+        if icos_site in self._era_blh:
+            ff_params['PBLH'] = self.img_db.loc[datelist.index, 'era_pblh'].values
+        # In case of Nodata values in ICOS data, no FF can be calculated
+        icos_na = ff_params[checkvar].isin([-9999]).any(axis=1) | ff_params.icos_missing
+        for i in np.flatnonzero(icos_na):
+            self._set_img_status(icos_site, dtakes.iloc[i], 'icos_na')
+            logger.debug('{}: No ICOS data available for {} image {} from {}.'\
+                         .format(icos_site, self.sensor, dtakes.iloc[i],
+                                   datelist.iloc[i]))
+        if not zonal:
+            ff_ix.extend(np.flatnonzero(~icos_na).tolist())
+
+        # Estimate 80th (and 50th) percentile of flux footprints of all valid
+        # acquisitions with Kljun model in a single batch
+        ff_cols = pd.DataFrame(np.nan, index=range(len(datelist)),
+                               columns=['ff_' + v.lower() for v in ['ZM'] + checkvar[:-1]])
+        if len(ff_ix) > 0:
+            ff_in = ff_params.loc[ff_ix, checkvar[:-1]].astype(float)
+            ff_cols.iloc[ff_ix, 0] = [ZM[i] for i in ff_ix]
+            ff_cols.iloc[ff_ix, 1:] = ff_in.values
+            ff_cols['ff_era5'] = icos_site in self._era_blh
+            with profiling.timer('ffp'):
+                ff = ffp.FFP_batch(zm=[ZM[i] for i in ff_ix], umean=ff_in.WS.values,
+                                   h=ff_in.PBLH.values, ol=ff_in.MO_LENGTH.values,
+                                   sigmav=ff_in.V_SIGMA.values, ustar=ff_in.USTAR.values,
+                                   wind_dir=ff_in.WD.values, rs=[50., 80.])
+            ff_ok = []
+            for j, i in enumerate(ff_ix):
+                # Uses 80% FF contribution area (index 1)
+                if not ff['valid'][j] or ff['xr'][j][1] is None:
+                    self._set_img_status(icos_site, dtakes.iloc[i], 'icos_na')
+                    logger.debug('{}: No FF for {} image {} from {} (FFP code {}).'\
+                                 .format(icos_site, self.sensor, dtakes.iloc[i],
+                                         datelist.iloc[i], ff['flag'][j]))
+                    continue
+                ff_ok.append((i, j))
+            # Compute FF coordinates & create geometries of all acquisitions at once
+            with profiling.timer('contour'):
+                polys = _footprint_polygons([ff['xr'][j][1] for _, j in ff_ok],
+                                            [ff['yr'][j][1] for _, j in ff_ok],
+                                            flx_loc.x.item(), flx_loc.y.item())
+            for (i, _), poly in zip(ff_ok, polys):
+                geoms[i] = poly
         
         # Prepare DF for merging with geoinformation.
         img_df = self.img_db.loc[datelist.index,
@@ -1714,12 +2006,10 @@ class HSICOS():
         geom_gdf = gpd.GeoDataFrame(data=img_df, geometry=gpd.GeoSeries(
             geoms, crs=crs_lam))
         # Add data about GPP, NEE
-        flx_list = [0]*len(timelist)
-        for i,pset in enumerate(ff_params):
-            flx_list[i] = pset.loc[fluxvars]
-
-        flx_df = pd.concat(flx_list, axis=1).T.reset_index(drop=True)
+        flx_df = ff_params[fluxvars]
         flx_geom_gdf = pd.concat([geom_gdf, flx_df], axis=1)
+        if ff_weights and not zonal:
+            flx_geom_gdf = pd.concat([flx_geom_gdf, ff_cols], axis=1)
         
         ix = flx_geom_gdf.columns.get_loc(fluxvars[0]) # get index of first prod variable
         flx_geom_gdf.iloc[:, ix:ix+len(fluxvars)] = flx_geom_gdf.iloc[
@@ -1762,7 +2052,8 @@ class HSICOS():
         return flx_geom_gdf, ql_flag, nna
     
     def _crop_data_2_geoms(self, icos_site, flx_geom_gdf, mask_params, dimred = None,
-                           sr = 'vnir', upw = False, save_plot = False):
+                           sr = 'vnir', upw = False, save_plot = False, ff_members = 0,
+                           simplify = 0., variants = None, cube_cache = None):
         '''
         Crops HSI / dimension-reduced HSI to geometries of interest and averages
         resulting pixels per band. Cropped imagery can be saved as GeoTIFF.
@@ -1792,7 +2083,33 @@ class HSICOS():
                 data resulting in 400-700 nm upwelling radiation (UPW).
             save_plot (bool, optional): If true, ICOS site surroundings will be
                 plotted with the geometry superimposed and saved.
+            ff_members (int, optional): If > 0 and FFP inputs are present in
+                flx_geom_gdf, pixels are weighted with the mean footprint of
+                an ensemble of ff_members perturbed FFP inputs (ffp.FFP_ensemble)
+                and the spread of the member averages is added (columns
+                '<band>_sd', 'NIRvP_sd' and 'ff_valid_frac').
+            simplify (float, optional): If > 0, geometries are simplified
+                after reprojection with a tolerance of simplify * pixel size
+                (e.g. 0.25). Reduces the cost of cropping to high-vertex
+                footprint contours.
+            variants (list of tuples, optional): (sr, upw) combinations that
+                are derived from a single pass over the imagery: pixels are
+                read, masked and averaged over the full spectral range once,
+                band slices and PAR multiplication are applied to the
+                averages. If given, sr and upw are ignored and a dict
+                {(sr, upw): (flx_hsi_gdf, cube_list)} is returned. Not
+                applicable to DR imagery.
+            cube_cache (dict, optional): Read and masked image cubes per data
+                take, e.g. shared between footprints and buffers of the same
+                images (see hsi_geom_crop_variants).
         '''
+        single = variants is None
+        if single:
+            variants = [(sr, upw)]
+        elif dimred != None:
+            raise ValueError('variants are not applicable to DR imagery.')
+        if cube_cache is None:
+            cube_cache = {}
         # this datelist is updated after step 2 of the cropping procedure
         if len(flx_geom_gdf) != len(mask_params):
             logger.debug(f'{icos_site}: GEOM_GDF & MP EQUAL?!\n'
@@ -1808,23 +2125,17 @@ class HSICOS():
         if dimred == None:
             data_dir = self.img_dir
             nm_min = 400
-            if sr == 'vis':
-                nm_max = 700
-            elif sr == 'vnir':
-                nm_max = 1000
-            elif sr == 'vswir':
-                nm_max = 2500
+            nm_max = {'vis': 700, 'vnir': 1000, 'vswir': 2500}
             flx_geom_gdf['NIRvP'] = np.nan
         else:
             data_dir = self.img_dir / f'DR_{dimred}_imgs'
         
         img_paths = [list((data_dir).glob(f'*{dt}_{icos_site}_6km_crop.tif')) for dt in dtakes]
         
-        epsg = self.flx_loc.loc[self.flx_loc.name == icos_site, 'sensorcrs'].item()
+        epsg = self.site_index.epsg(icos_site)
         crs_utm = proj.CRS.from_epsg(epsg)
         # Local UTM coordinates used for cropping, modeled geoms are in LAEA
-        flx_loc = self.icos_db.loc[self.icos_db.name == icos_site,
-                                   'geometry'].to_crs(crs_utm)
+        flx_loc = self.site_index.geom(icos_site, crs_utm)
         flx_roi_plot = flx_loc.buffer(500)
         box_geom_plot = geometry.box(*flx_roi_plot.total_bounds)
         
@@ -1835,6 +2146,7 @@ class HSICOS():
         wlss = [0]*len(datelist)
         itrans = [0]*len(datelist)
         bounds = [0]*len(datelist)
+        cube_rgbs = [None]*len(datelist)
     
         for i,path in enumerate(img_paths):
             # imagery must exist and ID must be unique
@@ -1842,50 +2154,87 @@ class HSICOS():
                 raise ValueError(f'The cropped {self.sensor} image with dataTakeID {dtakes.iloc[i]} could not be found.')
             elif len(path) > 1:
                 raise ValueError(f'dataTakeID {dtakes.iloc[i]} not unique. Please investigate.')
-            with rio.open(path[0]) as src:
-                cubes[i] = src.read()
+            # Images are read & masked once, e.g. for footprints and buffers
+            key = (dtakes.iloc[i], None if dimred != None else mask_params.iloc[i].to_json())
+            if key not in cube_cache:
+                with profiling.timer('img_read', dtake=dtakes.iloc[i]) as t, rio.open(path[0]) as src:
+                    cube = np.einsum('kli->lik', src.read())
+                    wls = [float(w) for w in list(src.descriptions)] if dimred == None else 0
+                    meta = (src.meta['transform'], src.bounds, src.nodata) # for plotting & cropping
+                    t.add(bytes=cube.nbytes, pixels=cube.shape[0] * cube.shape[1])
+                cube_rgb = None
+                # NA handling not necessary anymore: Done at the end of self._model_geoms
+                # Non-vegetation px masking for direct aggregation of HSI (DR case treated differently)
                 if dimred == None:
-                    wlss[i] = [float(w) for w in list(src.descriptions)]
-                itrans[i] = src.meta['transform'] # for plotting & cropping
-                bounds[i] = src.bounds
-                na_val = src.nodata
-        cubes = [np.einsum('kli->lik', c) for c in cubes]
-        exts = [riop.plotting_extent(c, itrans[i]) for i,c in enumerate(cubes)]
-        
+                    with profiling.timer('mask', dtake=dtakes.iloc[i],
+                                         pixels=cube.shape[0] * cube.shape[1]):
+                        veg_mask, cube_rgb = self._mask_px(
+                            mask_param=mask_params.iloc[i], cube=cube, wls=wls,
+                            row=flx_geom_gdf.iloc[i], loc=flx_loc,
+                            ext=riop.plotting_extent(cube, meta[0]))
+                        cube[veg_mask, :] = np.nan
+                cube_cache[key] = (cube, wls) + meta + (cube_rgb,)
+            else:
+                profiling.count('img_cache_hit', dtake=dtakes.iloc[i])
+            cubes[i], wlss[i], itrans[i], bounds[i], na_val, cube_rgbs[i] = cube_cache[key]
+        # Reproject all geometries of the site at once (all images share the pixel size)
+        with profiling.timer('reproject'):
+            utm_polys = _reproject_geoms(flx_geom_gdf.loc[datelist.index, 'geometry'],
+                                         transf, simplify * abs(itrans[0][0]))
+        
+        # Pixels are averaged over the full spectral range, spectral ranges
+        # of the variants are band slices of the averages
         if dimred == None:
             wl_min = _fnv(wlss[0], nm_min)
-            wl_max = _fnv(wlss[0], nm_max) + 1
-            nbands = len(wlss[0][wl_min:wl_max])
-            logger.debug(f'initial band length: {len(wlss[0])}, sr_min + index: '
-                         f'{nm_min}-{wl_min}, sr_max + index: {nm_max}-{wl_max}, reduced band length: {nbands}')
-
-        cube_list = [0]*len(datelist)
-        geom_px_avgs = [0]*len(datelist)
+            band_ix = {v_sr: slice(wl_min, _fnv(wlss[0], nm_max[v_sr]) + 1)
+                       for v_sr, _ in variants}
+            for v_sr, ix in band_ix.items():
+                logger.debug(f'initial band length: {len(wlss[0])}, sr_min + index: '
+                             f'{nm_min}-{wl_min}, sr_max + index: {nm_max[v_sr]}-{ix.stop}, '
+                             f'reduced band length: {len(wlss[0][ix])}')
+        else:
+            band_ix = {v_sr: slice(None) for v_sr, _ in variants}
+
+        cube_lists = {v: [0]*len(datelist) for v in variants}
+        geom_px_avgs = {v: [0]*len(datelist) for v in variants}
+        geom_px_sds = {v: [0]*len(datelist) for v in variants}
+        nirvps = {v: np.full(len(datelist), np.nan) for v in variants}
+        nirvp_sds = {v: np.full(len(datelist), np.nan) for v in variants}
+        hsi_na = {v: np.full(len(datelist), False) for v in variants}
         if np.isnan(na_val):
             na_len = lambda x: len(x[np.isnan(x)])
         else:
             na_len = lambda x: len(x[x == na_val])
+        # Weight all image pixels by the footprint instead of averaging the
+        # pixels within the footprint polygon (FFP inputs from _model_geoms)
+        ff_weights = 'ff_zm' in flx_geom_gdf.columns
+        ff_ens = ff_weights and ff_members > 0
+
+        def prep_cube(cube):
+            if not np.isnan(na_val):
+                cube[cube == na_val] = np.nan
+            if dimred == None: # might otherwise cause problems for DR with negative resulting coef values
+                cube[cube < 0] = np.nan
+            return cube
+
+        def nirvp_px(cube, i):
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', category=RuntimeWarning)
+                nir = np.nanmean(cube[..., _fnv(wlss[i], 800):_fnv(wlss[i], 850)+1], axis=-1)
+                red = np.nanmean(cube[..., _fnv(wlss[i], 600):_fnv(wlss[i], 650)+1], axis=-1)
+            ndvi = (nir - red) / (nir + red)
+            return ndvi * nir
         
         for i,path in enumerate(img_paths):
-            # NA handling not necessary anymore: Done at the end of self._model_geoms
-            # Non-vegetation px masking for direct aggregation of HSI (DR case treated differently)
-            if dimred == None:
-                row = flx_geom_gdf.iloc[i]
-                mp = mask_params.iloc[i]
-                #logger.debug(f'{icos_site}_{dtakes.iloc[i]}: _mask_px args:\n'
-                #             f'ix:{i}\n row: {row}\n mask_param:{mp}')
-                veg_mask, cube_rgb = self._mask_px(mask_param=mp, cube=cubes[i], wls=wlss[i],
-                                                   row=row, loc=flx_loc, ext=exts[i])
-                for band in range(0, len(wlss[i])):
-                    cubes[i][veg_mask, band] = np.nan
-            
             lam_poly = flx_geom_gdf.loc[i, 'geometry']
             logger.debug(f'LAEA poly coords: {lam_poly.bounds}')
-            utm_poly = stransform(transf.transform, lam_poly)
+            utm_poly = utm_polys[i]
             logger.debug(f'UTM poly coords: {utm_poly.bounds}')
             logger.debug(f'UTM raster bounds: {bounds[i]}')
-            geom_cube, otrans = _local_mask(cubes[i], itrans[i], [utm_poly],
-                                            crop=True, all_touched=True, nodata=na_val)
+            with profiling.timer('crop', dtake=dtakes.iloc[i]) as t:
+                geom_cube, otrans = _local_mask(cubes[i], itrans[i], [utm_poly],
+                                                crop=True, all_touched=True, nodata=na_val)
+                t.add(pixels=geom_cube.shape[0] * geom_cube.shape[1])
             # TODO: values>1 should also be removed (total amount of pixels is very small)
             #describe(temp, axis=None)
             if (na_len(geom_cube) / geom_cube.size) > 0.05:
@@ -1897,37 +2246,86 @@ class HSICOS():
                              f'{round((len(geom_cube[geom_cube < 0]) / geom_cube.size)*100, 2)}%'
                              ' of regular pixels have < 0 values. Negative reflectance values are converted to NaN.')
             
-            if not np.isnan(na_val):
-                geom_cube[geom_cube == na_val] = np.nan
-            if dimred == None: # might otherwise cause problems for DR with negative resulting coef values
-                geom_cube[geom_cube < 0] = np.nan
-                geom_cube = geom_cube[:, :, wl_min:wl_max] # Crop dimensions according to chosen spectral range
-                if upw == True: # HSI are cropped to 400-700 nm and multiplied with PAR
-                    par = flx_geom_gdf.loc[i, 'PAR']
-                    geom_cube = geom_cube * par
-                with warnings.catch_warnings():
-                    warnings.simplefilter('ignore', category=RuntimeWarning)
-                    nir = np.nanmean(geom_cube[:, :, _fnv(wlss[i], 800):
-                                               _fnv(wlss[i], 850)+1], axis=2)
-                    red = np.nanmean(geom_cube[:, :, _fnv(wlss[i], 600):
-                                               _fnv(wlss[i], 650)+1], axis=2)
-                ndvi = (nir - red) / (nir + red)
+            geom_cube = prep_cube(geom_cube)
+            if ff_weights:
+                # Weighted mean of all pixels of the image with footprint weights
+                row = flx_geom_gdf.loc[i]
+                ff_in = dict(zm=row.ff_zm, umean=row.ff_ws, h=row.ff_pblh,
+                             ol=row.ff_mo_length, sigmav=row.ff_v_sigma,
+                             ustar=row.ff_ustar, wind_dir=row.ff_wd)
+                tower_xy = (flx_loc.x.item(), flx_loc.y.item())
+                if ff_ens:
+                    # Probability weighted footprint of all valid members
+                    sd = {'h': ERA5_PBLH_SD} if row.get('ff_era5', False) else None
+                    # seed independent of site & row order of the observation
+                    seed = np.random.SeedSequence(list(f'{icos_site}_{dtakes.iloc[i]}'.encode()))
+                    with profiling.timer('ff_weights', dtake=dtakes.iloc[i]):
+                        ffw = ffp.FFP_ensemble(
+                            n_members=ff_members, sd=sd, seed=seed, transform=itrans[i],
+                            shape=cubes[i].shape[:2], tower_xy=tower_xy,
+                            contours=False, **ff_in)
+                    flx_geom_gdf.loc[i, 'ff_valid_frac'] = ffw['valid_frac'][0]
+                    ffw['coverage'] = [np.mean(ffw['coverage'][ffw['valid']])
+                                       if ffw['valid'].any() else 0.]
+                else:
+                    with profiling.timer('ff_weights', dtake=dtakes.iloc[i]):
+                        ffw = ffp.FFP_raster_weights(
+                            itrans[i], cubes[i].shape[:2], tower_xy, **ff_in)
+                if ffw['coverage'][0] < 0.9:
+                    logger.debug(f'{icos_site}_{dtakes.iloc[i]}: Only '
+                                 f'{round(ffw["coverage"][0]*100, 1)}% of the footprint within image.')
+                # only pixels with nonzero weight (fancy indexing copies cubes[i])
+                cols = np.unique(ffw['weights'].indices)
+                px_cube = prep_cube(cubes[i].reshape(-1, cubes[i].shape[2])[cols])
+                ffw['weights'] = ffw['weights'][:, cols]
+                if ff_ens:
+                    ffw['member_weights'] = ffw['member_weights'][:, cols]
+            else:
+                px_cube = geom_cube
+            with profiling.timer('zonal_mean', dtake=dtakes.iloc[i],
+                                 pixels=px_cube.size // px_cube.shape[-1]), \
+                    warnings.catch_warnings():
+                warnings.simplefilter('ignore', category=RuntimeWarning)
+                if ff_weights:
+                    px_avg = _weighted_nanmean(px_cube, ffw['weights'])[0]
+                    if ff_ens:
+                        px_sd = _member_spread(px_cube, ffw['member_weights'], ffw['valid'][0])
+                else:
+                    px_avg = np.nanmean(px_cube, axis=(1, 0))
+            if dimred == None:
                 # NIRvP = NIRv * PAR, band specs: Dechant et al. (2022) - NIRVP: A robust structural proxy for sun-induced chlorophyll fluorescence and photosynthesis across scales
                 # in practive for PRISMA: RED=[601, 646], NIR=[796, 849]
-                nirvp = (ndvi * nir) * flx_geom_gdf.loc[i, 'PAR']
-                flx_geom_gdf.loc[i, 'NIRvP'] = np.nanmean(nirvp)
-            with warnings.catch_warnings():
-                warnings.simplefilter('ignore', category=RuntimeWarning)
-                geom_px_avgs[i] = np.nanmean(geom_cube, axis=(1, 0))
-            if np.isnan(geom_px_avgs[i]).all():
-                flx_geom_gdf.loc[i, 'clouds'] = 'hsi_na'
+                par = flx_geom_gdf.loc[i, 'PAR']
+                nirv, nirv_sd = {}, {}
+                for v_sr, ix in band_ix.items():
+                    nirv_px = nirvp_px(px_cube[..., ix], i)
+                    if ff_weights:
+                        nirv[v_sr] = _weighted_nanmean(nirv_px[:, None], ffw['weights'])[0, 0]
+                        if ff_ens:
+                            nirv_sd[v_sr] = _member_spread(
+                                nirv_px[:, None], ffw['member_weights'], ffw['valid'][0])[0]
+                    else:
+                        with warnings.catch_warnings():
+                            warnings.simplefilter('ignore', category=RuntimeWarning)
+                            nirv[v_sr] = np.nanmean(nirv_px)
+            # Variants: band slice and (UPW) multiplication with PAR
+            for v in variants:
+                v_sr, v_upw = v
+                ix = band_ix[v_sr]
+                scale = flx_geom_gdf.loc[i, 'PAR'] if (v_upw and dimred == None) else 1.
+                geom_px_avgs[v][i] = px_avg[ix] * scale
+                if ff_ens:
+                    geom_px_sds[v][i] = px_sd[ix] * abs(scale)
+                if dimred == None:
+                    nirvps[v][i] = nirv[v_sr] * par * scale
+                    if ff_ens:
+                        nirvp_sds[v][i] = nirv_sd[v_sr] * abs(par * scale)
+                cube_lists[v][i] = geom_cube[..., ix] * scale if v_upw else geom_cube[..., ix]
+                hsi_na[v][i] = np.isnan(geom_px_avgs[v][i]).all()
+            if any(hsi_na[v][i] for v in variants):
                 # also update in img_db for consistency
-                self.img_db.loc[(self.img_db.name == icos_site) &
-                                (self.img_db.dataTakeID == dtakes.iloc[i]),
-                                'clouds'] = 'hsi_na'
+                self._set_img_status(icos_site, dtakes.iloc[i], 'hsi_na')
                 logger.warning(f'{icos_site}_{dtakes.iloc[i]}: Only NA pixels within geometry of interest.\n')
-
-            cube_list[i] = geom_cube
             
             if dimred != None:
                 continue
@@ -1936,7 +2334,7 @@ class HSICOS():
             
             # clip RGB to plotting extent
             cube_rgb_plot, otrans = _local_mask( #4 indices since 4th channel is used for NA masking
-                cube_rgb, itrans[i], [box_geom_plot], crop=True, indexes=[1,2,3,4])
+                cube_rgbs[i], itrans[i], [box_geom_plot], crop=True, indexes=[1,2,3,4])
             out_ext = riop.plotting_extent(cube_rgb_plot, otrans)
             patch1 = mpatches.Patch(fc='none', ec='crimson', lw=2, label='Flux ROI')
             patch2 = mpatches.Patch(fc='none', ec='turquoise', lw=2, label='Validation ROI')
@@ -1959,26 +2357,182 @@ class HSICOS():
             ax2.set_zorder(1)
             ax2.legend(handles=[patch1, patch2], loc='lower right', fontsize=14, # frame width variable is missing
                        facecolor='w', edgecolor='black', framealpha=1, borderpad=0.4)
-            if flx_geom_gdf.loc[i, 'clouds'] == 'hsi_na':
+            if hsi_na[variants[0]][i]:
                 ax.text(0.4, 0.6, 'NA pixel', size='30', c='xkcd:neon pink', transform=ax.transAxes)
             fig.savefig(self.img_dir / f'{img_paths[i][0].stem[:-8]}rgb_{self.ptype["mask"]}.png',
                         dpi=150, bbox_inches='tight')
             plt.close(fig)
-        # np arrays cannot be saved as a GPKG element. Therefore 1 column in GDF for each band.
-        if dimred == None:
-            sr_band_ix = [f'b{str(x).zfill(3)}' for x in range(1, nbands + 1)]
+        
+        results = {}
+        for v in variants:
+            v_gdf = flx_geom_gdf if single else flx_geom_gdf.copy()
+            if dimred == None:
+                v_gdf['NIRvP'] = nirvps[v]
+                if ff_ens:
+                    v_gdf['NIRvP_sd'] = nirvp_sds[v]
+            v_gdf.loc[hsi_na[v], 'clouds'] = 'hsi_na'
+            # np arrays cannot be saved as a GPKG element. Therefore 1 column in GDF for each band.
+            if dimred == None:
+                nbands = len(wlss[0][band_ix[v[0]]])
+                sr_band_ix = [f'b{str(x).zfill(3)}' for x in range(1, nbands + 1)]
+            else:
+                sr_band_ix = [f'comp{str(x).zfill(2)}' for x in range(1, cubes[0].shape[2] + 1)]
+            geom_avg_df = pd.DataFrame([
+                pd.Series(vals, index=sr_band_ix) for vals in geom_px_avgs[v]])
+            logger.debug(f'single geom_px_avgs: {geom_px_avgs[v][-1]}, band_cols in geom_avg_df: {sr_band_ix}')
+            logger.debug(f'cube shape after sr adjustment: {np.shape(cube_lists[v][-1])}')
+            if ff_ens:
+                geom_sd_df = pd.DataFrame([
+                    pd.Series(vals, index=[f'{b}_sd' for b in sr_band_ix]) for vals in geom_px_sds[v]])
+                geom_avg_df = pd.concat([geom_avg_df, geom_sd_df], axis=1)
+            results[v] = (pd.concat([v_gdf, geom_avg_df], axis=1), cube_lists[v])
+        
+        return results[variants[0]] if single else results
+
+    def _geom_crop_site(self, site, mask_params, response, date, sr, zonal, upw,
+                        aggr, save_plot, ff_weights, ff_members, simplify,
+                        fluxvars0, no_ppfd, flux_windows = None):
+        '''
+        Processing steps (1) - (3) of hsi_geom_crop for a single site: loading
+        of ICOS data, footprint modeling and cropping. Arguments as for
+        hsi_geom_crop.
+        
+        Returns:
+            flx_hsi_gdf_subset (geopandas.GeoDataFrame): Cropped data of the
+                site, None if all obs. have ICOS NA values.
+            flx_imgs (list): Cropped image cubes.
+            ql_flag (int): 1 if poor quality ICOS data flags occurred.
+            nna (int): Nr. of images with missing ICOS data.
+        '''
+        mp_subset = mask_params[mask_params.name == site].reset_index(drop=True)
+        if date == None:
+            datelist = self.img_db.loc[self.site_index.rows(site), 'startdate'].dt.date
         else:
-            sr_band_ix = [f'comp{str(x).zfill(2)}' for x in range(1, cubes[0].shape[2] + 1)]
-        geom_avg_df = pd.DataFrame([
-            pd.Series(vals, index=sr_band_ix) for vals in geom_px_avgs])
-        logger.debug(f'single geom_px_avgs: {geom_px_avgs[-1]}, band_cols in geom_avg_df: {sr_band_ix}')
-        logger.debug(f'cube shape after sr adjustment: {np.shape(geom_cube)}')
-        flx_hsi_gdf = pd.concat([flx_geom_gdf, geom_avg_df], axis=1)
+            datelist = self.img_db.loc[self.site_index.rows(site, date), 'startdate'].dt.date
+        dtakes = self.img_db.loc[datelist.index, 'dataTakeID']
+        
+        if self.sensor == 'DESIS':
+            img_paths = [list((self.img_dir).glob(f'*{dt}*SPECTRAL*.tif'))\
+                         for i,dt in enumerate(dtakes)]
+            # Only 1 image is used for getting CRS info as all images at one ICOS location share the same CRS!
+        elif self.sensor == 'PRISMA':
+            img_paths = [list((self.img_dir).glob(f'*{dt}*6km_crop'))\
+                         for i,dt in enumerate(dtakes)]
+    
+        ip_check = pd.Series([len(x) > 1 for x in img_paths])
+        if ip_check.any():
+            raise ValueError('More than 1 matching img for dataTakeID {}'\
+                             .format(dtakes.iloc[ip_check[ip_check == True].index]))
+        
+        # (1) Load FF model parameters
+        icos_subset, ZM, fluxvars = self._load_icos_subset(
+            site, datelist, fluxvars0, aggr, no_ppfd, zonal, flux_windows)
+        
+        # (2) Footprint modeling and geometry generation
+        flx_geom_gdf_subset, ql_flag, nna = self._model_geoms(
+                site, datelist, icos_subset, response, ZM, fluxvars, zonal, upw,
+                ff_weights)
+        logger.debug(f'{site}: CRS of gdf after GEOMETRY (2): {flx_geom_gdf_subset.crs}')
+        
+        if len(flx_geom_gdf_subset) == 0: # Skip if all obs. of a site have ICOS NA values
+            return None, 0, ql_flag, nna
+
+        # (3) Crop of hyperspectral imagery to footprint
+        # 'zonal' arg not needed as cropping is identical for FF & zonal
+        flx_hsi_gdf_subset, flx_imgs = self._crop_data_2_geoms(
+            site, flx_geom_gdf_subset, mp_subset, None, sr, upw, save_plot,
+            ff_members, simplify)
+        logger.debug(f'{site}: CRS of gdf after CROPPING (3): {flx_hsi_gdf_subset.crs}')
+        
+        return flx_hsi_gdf_subset, flx_imgs, ql_flag, nna
+
+    def _gdf_prep_site(self, site, response, zonal, ff_weights, fluxvars0, no_ppfd,
+                       flux_windows = None):
+        '''
+        Processing steps (1) & (2) of hsi_gdf_prep for a single site: loading
+        of ICOS data and footprint modeling. Arguments as for hsi_gdf_prep.
+        
+        Returns:
+            flx_geom_gdf (geopandas.GeoDataFrame): Geometries and flux data.
+            ql_flag (int): 1 if poor quality ICOS data flags occurred.
+            nna (int): Nr. of images with missing ICOS data.
+        '''
+        datelist = self.img_db.loc[self.site_index.rows(site), 'startdate'].dt.date
+
+        # (1) Load FF model parameters
+        icos_subset, ZM, fluxvars = self._load_icos_subset(
+            site, datelist, fluxvars0, 'na', no_ppfd, zonal, # hardcoded "no aggregation"
+            flux_windows)
         
-        return flx_hsi_gdf, cube_list
+        # (2) Footprint modeling and geometry generation
+        return self._model_geoms(site, datelist, icos_subset, response, ZM,
+                                 fluxvars, zonal, ff_weights=ff_weights)
 
+    def _set_img_status(self, icos_site, dtake, status):
+        '''
+        Sets the status ('clouds' column, e.g. 'icos_na' or 'hsi_na') of an
+        image in img_db. In worker processes of _map_sites, img_db is a copy
+        and the updates are recorded to be merged into img_db of the parent
+        process.
+        '''
+        self.site_index.set_img(icos_site, dtake, 'clouds', status)
+        if self._img_updates is not None:
+            self._img_updates.append((icos_site, dtake, status))
+
+    def _site_task(self, method, site, kwargs, profile = False):
+        # Runs a per-site method and returns its result, img_db status updates
+        # & profiling records of the worker process
+        self._img_updates = []
+        if profile:
+            profiling.enable()
+        else:
+            profiling.disable()
+        start = profiling.mark()
+        with profiling.scope(site):
+            res = getattr(self, method)(site, **kwargs)
+        updates, self._img_updates = self._img_updates, None
+        return res, updates, profiling.records(start, thread_only=True).values.tolist()
+
+    def _map_sites(self, method, icos_list, workers = 1, kwargs = {}):
+        '''
+        Runs a per-site method (e.g. '_geom_crop_site') for all sites, either
+        serially or in a pool of worker processes. Results are returned in
+        the order of icos_list. Workers return their img_db status updates
+        which are merged into self.img_db, and their profiling records.
+        
+        Args:
+            method (string): Name of the per-site method.
+            icos_list (list of strings): Abbreviations of the ICOS sites.
+            workers (int, optional): Number of worker processes. Sites are
+                processed serially in this process if workers <= 1.
+            kwargs (dict, optional): Keyword arguments of the method.
+        Returns:
+            list of method results per site.
+        '''
+        results = [None]*len(icos_list)
+        if workers <= 1 or len(icos_list) <= 1:
+            for i,site in enumerate(pbar := tqdm(icos_list)):
+                pbar.set_description(f'Processing {site}')
+                with profiling.scope(site):
+                    results[i] = getattr(self, method)(site, **kwargs)
+            return results
+        
+        with ProcessPoolExecutor(max_workers=min(workers, len(icos_list))) as ex:
+            futures = [ex.submit(self._site_task, method, site, kwargs,
+                                 profiling.enabled()) for site in icos_list]
+            for i,fut in enumerate(pbar := tqdm(futures)):
+                pbar.set_description(f'Processing {icos_list[i]}')
+                results[i], updates, records = fut.result()
+                for site, dtake, status in updates:
+                    self._set_img_status(site, dtake, status)
+                profiling.extend(records)
+        return results
+
+    @profiling.profiled
     def hsi_geom_crop(self, icos_list, mask_params, response, date = None, sr = 'vnir',
-                      zonal = False, upw = False, aggr = 'na', save = False, save_plot = False):
+                      zonal = False, upw = False, aggr = 'na', save = False, save_plot = False,
+                      ff_weights = False, ff_members = 0, simplify = 0., workers = 1,
+                      flux_windows = None):
         '''
         Crops hyperspectral imagery to flux footprints derived from the 30-min
         interval of EC measurements at ICOS flux towers during or before the DESIS
@@ -2014,6 +2568,21 @@ class HSICOS():
                 GeoPackage.
             save_plot (bool, optional): If true, ICOS site surroundings will be
                 mapped with the geometry superimposed and saved.
+            ff_weights (bool, optional): If true, pixel values are averaged
+                with footprint weights evaluated on the image grid instead
+                of within the 80% footprint polygon. Ignored if zonal is true.
+            ff_members (int, optional): Number of Monte Carlo members of
+                perturbed FFP inputs per observation. If > 0 (and ff_weights),
+                pixels are weighted with the ensemble mean footprint and the
+                member spread of the averages is added ('<band>_sd' columns).
+            simplify (float, optional): Simplification tolerance of the
+                footprint polygons as a fraction of the pixel size (0 = none).
+            workers (int, optional): Number of worker processes. If > 1,
+                sites are processed in parallel.
+            flux_windows (dict, optional): Multi-day aggregation windows of
+                the flux variables, e.g. {'pm3d': {'days': 3}, '8dc': {'days':
+                8, 'kind': 'composite', 'how': 'sum', 'daytime': True}} (see
+                FLUX_WINDOW_DEFAULTS). Added as columns '<var>_<name>'.
         '''
         if (upw == True) & (sr != 'vis'):
             logger.info('upw is true but sr is not "vis". Since UPW ' +
@@ -2038,58 +2607,188 @@ class HSICOS():
             icos_list = [x for x in icos_list if not x in no_rad]
         # TODO: Remove or separate check for NAs in SW_IN_F?
         
+        if date != None:
+            try:
+                dt.datetime.strptime(date, '%Y-%m-%d')
+            except ValueError:
+                raise ValueError('Incorrect date format, should be YYYY-MM-DD')
+        
+        site_res = self._map_sites('_geom_crop_site', icos_list, workers, dict(
+            mask_params=mask_params, response=response, date=date, sr=sr,
+            zonal=zonal, upw=upw, aggr=aggr, save_plot=save_plot,
+            ff_weights=ff_weights, ff_members=ff_members, simplify=simplify,
+            fluxvars0=fluxvars0, no_ppfd=no_ppfd, flux_windows=flux_windows))
+        flx_hsi_gdf, flx_hsi_gdf_c, flx_imgs_l, icos_list = self._combine_sites(
+            icos_list, site_res, self.ptype, save)
+        if len(icos_list) == 1:
+            return flx_hsi_gdf, flx_imgs_l[0], icos_list
+        flx_imgs_c = [y for x in flx_imgs_l for y in x]
+        self.flx_hsi_gdf = flx_hsi_gdf_c
+        self.flx_imgs = flx_imgs_c
+        return flx_hsi_gdf, flx_imgs_c, icos_list
+    
+    def _geom_crop_variants_site(self, site, mask_params, response, date, variants,
+                                 aggr, save_plot, ff_weights, ff_members, simplify,
+                                 fluxvars0, no_ppfd, flux_windows = None):
+        '''
+        Processing steps (1) - (3) of hsi_geom_crop_variants for a single site:
+        ICOS data are loaded once, geometries are modeled once per geometry
+        type and the imagery is read, masked and cropped once for all
+        variants. Arguments as for hsi_geom_crop_variants.
+        
+        Returns:
+            results (dict): (flx_hsi_gdf_subset, flx_imgs) per variant
+                (sr, upw, zonal), (None, 0) if all obs. have ICOS NA values.
+            ql_flag (int): 1 if poor quality ICOS data flags occurred.
+            nna (int): Nr. of images with missing ICOS data.
+        '''
+        if date == None:
+            datelist = self.img_db.loc[self.site_index.rows(site), 'startdate'].dt.date
+        else:
+            datelist = self.img_db.loc[self.site_index.rows(site, date), 'startdate'].dt.date
+        
+        # (1) Load FF model parameters (FF inputs are only loaded if needed)
+        icos_subset, ZM, fluxvars = self._load_icos_subset(
+            site, datelist, fluxvars0, aggr, no_ppfd, all(v[2] for v in variants),
+            flux_windows)
+        
+        results = {}
+        ql_flag, nna = 0, 0
+        cube_cache = {} # read & masked images, shared by footprints & buffers
+        # Buffers first: images without FF are flagged as 'icos_na' in img_db
+        for zonal in sorted({v[2] for v in variants}, reverse=True):
+            mask_v = [v for v in variants if v[2] == zonal]
+            # (2) Footprint modeling and geometry generation (UPW rows are
+            # selected after cropping, so that mask_params match all variants)
+            flx_geom_gdf_subset, ql, n = self._model_geoms(
+                site, datelist, icos_subset, response, ZM, fluxvars, zonal,
+                False, ff_weights)
+            ql_flag, nna = max(ql_flag, ql), max(nna, n)
+            if len(flx_geom_gdf_subset) == 0: # Skip if all obs. of a site have ICOS NA values
+                results.update({v: (None, 0) for v in mask_v})
+                continue
+            
+            # (3) Crop of hyperspectral imagery to geometries, all spectral
+            # ranges & radiance types at once
+            mp_subset = mask_params[mask_params.name == site]
+            if 'dataTakeID' in mp_subset.columns:
+                mp_subset = mp_subset.set_index('dataTakeID', drop=False).loc[
+                    flx_geom_gdf_subset.dataTakeID.values]
+            mp_subset = mp_subset.reset_index(drop=True)
+            self.ptype = {**self.ptype, 'mask': 'bg' if zonal else 'ff'}
+            crops = self._crop_data_2_geoms(
+                site, flx_geom_gdf_subset, mp_subset, save_plot=save_plot,
+                ff_members=ff_members, simplify=simplify,
+                variants=sorted({v[:2] for v in mask_v}), cube_cache=cube_cache)
+            for v in mask_v:
+                flx_hsi_gdf_subset, flx_imgs = crops[v[:2]]
+                if v[1]: # UPW requires PAR
+                    keep = (flx_hsi_gdf_subset.PAR != -9999).values
+                    flx_hsi_gdf_subset = flx_hsi_gdf_subset[keep].reset_index(drop=True)
+                    flx_imgs = [img for img, k in zip(flx_imgs, keep) if k]
+                results[v] = (flx_hsi_gdf_subset, flx_imgs)
+        
+        return results, ql_flag, nna
+    
+    @profiling.profiled
+    def hsi_geom_crop_variants(self, icos_list, mask_params, response, variants,
+                               date = None, aggr = 'na', save = False, save_plot = False,
+                               ff_weights = False, ff_members = 0, simplify = 0.,
+                               workers = 1, flux_windows = None):
+        '''
+        Batch version of hsi_geom_crop for several processing variants, e.g.
+        all spectral ranges of reflectance and UPW for footprints and buffers.
+        Per site, ICOS data are loaded once, the geometries are modeled once
+        per geometry type and each image is read and masked once. Pixels are
+        averaged over the full spectral range once, the spectral ranges and
+        UPW of all variants are derived from these averages. Results equal
+        those of separate hsi_geom_crop calls.
+        
+        Args:
+            icos_list (string or list of strings): Abbreviation of the ICOS
+                site(s) for which hyperspectral imagery will be evaluated.
+            mask_params (pandas.DataFrame): Parameters for masking non-
+                vegetation pixels. Rows must either match the geometries of
+                hsi_geom_crop with upw=False (ICOS NA obs. removed) or contain
+                a column 'dataTakeID', which is used for matching.
+            response (string): Name of the relevant ICOS (productivity) variable.
+            variants (list of tuples): Processing variants (sr, upw, zonal),
+                e.g. [('vnir', False, False), ('vis', True, False), ('vnir',
+                False, True)]. sr is set to 'vis' for UPW variants.
+            Other args as for hsi_geom_crop.
+        Returns:
+            dict: (flx_hsi_gdf, flx_imgs, icos_list) per variant (sr, upw,
+                zonal) as returned by hsi_geom_crop. If save is true, one
+                GeoPackage per variant is saved.
+        '''
+        variants = list(dict.fromkeys(
+            ('vis' if upw else sr, bool(upw), bool(zonal)) for sr, upw, zonal in variants))
+        if isinstance(icos_list, str):
+            icos_list = [icos_list]
+        self.ptype = {'rad': 'ref', 'mask': 'ff', 'sr': variants[0][0]} # plots only
+        
+        # seletion of productivity variables to be extracted (percentiles, partitioning)
+        fluxvars0 = ['GPP_DT_VUT_05', 'GPP_DT_VUT_50', 'GPP_DT_VUT_95', 'GPP_NT_VUT_05',
+                    'GPP_NT_VUT_50', 'GPP_NT_VUT_95', 'NEE_VUT_05', 'NEE_VUT_50',
+                    'NEE_VUT_95', 'NEE_VUT_50_QC', 'PPFD_IN', 'SW_IN_F', 'SW_IN_F_QC']
+        no_ppfd, no_rad = self._ppfd_check(icos_list)
+        if len(no_rad) > 0:
+            icos_list = [x for x in icos_list if not x in no_rad]
+        
+        if date != None:
+            try:
+                dt.datetime.strptime(date, '%Y-%m-%d')
+            except ValueError:
+                raise ValueError('Incorrect date format, should be YYYY-MM-DD')
+        
+        site_res = self._map_sites('_geom_crop_variants_site', icos_list, workers, dict(
+            mask_params=mask_params, response=response, date=date, variants=variants,
+            aggr=aggr, save_plot=save_plot, ff_weights=ff_weights,
+            ff_members=ff_members, simplify=simplify, fluxvars0=fluxvars0,
+            no_ppfd=no_ppfd, flux_windows=flux_windows))
+        
+        results = {}
+        for v in variants:
+            ptype = {'rad': 'upw' if v[1] else 'ref', 'mask': 'bg' if v[2] else 'ff',
+                     'sr': v[0]}
+            flx_hsi_gdf, _, flx_imgs_l, v_list = self._combine_sites(
+                list(icos_list), [res[v] + (ql, nna) for res, ql, nna in site_res],
+                ptype, save)
+            if len(v_list) == 1:
+                results[v] = (flx_hsi_gdf, flx_imgs_l[0], v_list)
+            else:
+                results[v] = (flx_hsi_gdf, [y for x in flx_imgs_l for y in x], v_list)
+        return results
+    
+    def _combine_sites(self, icos_list, site_res, ptype, save = False):
+        '''
+        Combines the cropping results of all sites (step (4) of hsi_geom_crop).
+        Sites without valid ICOS data are removed from icos_list and images
+        with NA pixels from the output geodataframe.
+        
+        Args:
+            icos_list (list of strings): Abbreviations of the ICOS sites.
+            site_res (list): (flx_hsi_gdf_subset, flx_imgs, ql_flag, nna) per
+                site of icos_list.
+            ptype (dict): Processing info ('sr', 'mask', 'rad'), used for the
+                name of the GeoPackage.
+            save (bool, optional): If true, the output is saved as GeoPackage.
+        Returns:
+            flx_hsi_gdf (geopandas.GeoDataFrame): Valid obs. of all sites.
+            flx_hsi_gdf_c (geopandas.GeoDataFrame): All obs. of all sites.
+            flx_imgs_l (list): Cropped image cubes per site.
+            icos_list (list of strings): Sites with valid obs.
+        '''
         flx_hsi_gdf_l = [pd.DataFrame(columns=['a'], index=range(0))]*len(icos_list)
         flx_imgs_l = [0]*len(icos_list)
         ql_list = [0]*len(icos_list)
         nnal = [0]*len(icos_list)
         na_sites = []
         
-        for i,site in enumerate(pbar := tqdm(icos_list)):
-            pbar.set_description(f'Processing {site}')
-            mp_subset = mask_params[mask_params.name == site].reset_index(drop=True)
-            if date == None:
-                datelist = self.img_db.loc[self.img_db.name == site, 'startdate'].dt.date
-            else:
-                try:
-                    dt.datetime.strptime(date, '%Y-%m-%d')
-                except ValueError:
-                    raise ValueError('Incorrect date format, should be YYYY-MM-DD')
-                datelist = self.img_db.loc[(self.img_db.name == site) & \
-                                                 (self.img_db.date == date), 'startdate'].dt.date
-            dtakes = self.img_db.loc[datelist.index, 'dataTakeID']
-            
-            if self.sensor == 'DESIS':
-                img_paths = [list((self.img_dir).glob(f'*{dt}*SPECTRAL*.tif'))\
-                             for i,dt in enumerate(dtakes)]
-                # Only 1 image is used for getting CRS info as all images at one ICOS location share the same CRS!
-            elif self.sensor == 'PRISMA':
-                img_paths = [list((self.img_dir).glob(f'*{dt}*6km_crop'))\
-                             for i,dt in enumerate(dtakes)]
-        
-            ip_check = pd.Series([len(x) > 1 for x in img_paths])
-            if ip_check.any():
-                raise ValueError('More than 1 matching img for dataTakeID {}'\
-                                 .format(dtakes.iloc[ip_check[ip_check == True].index]))
-            
-            # (1) Load FF model parameters
-            icos_subset, ZM, fluxvars, missd = self._load_icos_subset(
-                site, datelist, fluxvars0, aggr, no_ppfd, zonal)
-            
-            # (2) Footprint modeling and geometry generation
-            flx_geom_gdf_subset, ql_list[i], nnal[i] = self._model_geoms(
-                    site, datelist, icos_subset, response, ZM, fluxvars, missd, zonal, upw)
-            logger.debug(f'{site}: CRS of gdf after GEOMETRY (2): {flx_geom_gdf_subset.crs}')
-            
-            if len(flx_geom_gdf_subset) == 0: # Skip if all obs. of a site have ICOS NA values
-                na_sites.append(site)
+        for i, (flx_hsi_gdf_subset, flx_imgs, ql_list[i], nnal[i]) in enumerate(site_res):
+            if flx_hsi_gdf_subset is None: # all obs. of a site have ICOS NA values
+                na_sites.append(icos_list[i])
                 continue
-
-            # (3) Crop of hyperspectral imagery to footprint
-            # 'zonal' arg not needed as cropping is identical for FF & zonal
-            flx_hsi_gdf_subset, flx_imgs = self._crop_data_2_geoms(
-                site, flx_geom_gdf_subset, mp_subset, None, sr, upw, save_plot)
-            logger.debug(f'{site}: CRS of gdf after CROPPING (3): {flx_hsi_gdf_subset.crs}')
-            
             flx_hsi_gdf_l[i] = flx_hsi_gdf_subset
             flx_imgs_l[i] = flx_imgs
         if sum(ql_list) > 0:
@@ -2104,8 +2803,7 @@ class HSICOS():
         flx_hsi_gdf_c = pd.concat(flx_hsi_gdf_l).reset_index(drop=True)
         flx_hsi_gdf = flx_hsi_gdf_c[flx_hsi_gdf_c.clouds != 'hsi_na'].reset_index(drop=True)
         if len(icos_list) == 1:
-            return flx_hsi_gdf, flx_imgs_l[0], icos_list
-        flx_imgs_c = [y for x in flx_imgs_l for y in x]
+            return flx_hsi_gdf, flx_hsi_gdf_c, flx_imgs_l, icos_list
         
         # missing data is counted in _model_geoms (ICOS NAs, removed in method) and _crop_data_2_geoms (img NAs, removed here!)
         self._nna_icos = sum(nnal)
@@ -2115,25 +2813,26 @@ class HSICOS():
         logger.debug('NA obs: {}'.format(self.img_db.loc[self.img_db.clouds.isin(
             ['icos_na', 'hsi_na']), ['name', 'date', 'clouds']]))
         
-        self.flx_hsi_gdf = flx_hsi_gdf_c
-        self.flx_imgs = flx_imgs_c
-        
         if save == True:
-            fpath = self.out_dir / (f'HSI_gdf_{self.sensor}_{self.ptype["sr"]}_'
-                f'{self.ptype["mask"]}_{self.ptype["rad"]}.gpkg')
+            fpath = self.out_dir / (f'HSI_gdf_{self.sensor}_{ptype["sr"]}_'
+                f'{ptype["mask"]}_{ptype["rad"]}.gpkg')
             if fpath.exists():
                 fpath.unlink() # delete to prevent creation of multilayer gpkg
             logger.info(f'Saving file: {fpath.name}')
-            flx_hsi_gdf.to_file(fpath, driver='GPKG')
+            with profiling.timer('gpkg_write') as t:
+                flx_hsi_gdf.to_file(fpath, driver='GPKG')
+                t.add(bytes=fpath.stat().st_size if profiling.enabled() else 0)
         no_ppi = len(flx_hsi_gdf[flx_hsi_gdf.ppi_file == ''])
         if no_ppi > 0:
             logger.warning(f'No S2 PPI images available for {no_ppi} data takes')
             logger.debug(f'No PPI data takes:\n{flx_hsi_gdf.loc[flx_hsi_gdf.ppi_file == "", "dataTakeID"]}')
-        return flx_hsi_gdf, flx_imgs_c, icos_list
+        return flx_hsi_gdf, flx_hsi_gdf_c, flx_imgs_l, icos_list
     
 ### DIMRED FUNCTIONS ##########################################################
     
-    def hsi_gdf_prep(self, icos_list, response, upw = False, zonal = False):
+    @profiling.profiled
+    def hsi_gdf_prep(self, icos_list, response, upw = False, zonal = False,
+                     ff_weights = False, workers = 1, flux_windows = None):
         '''
         Loads ICOS data and generates geometries of interest for dimension
         reduction. In case of FFs, the geometries are calculated using level 2
@@ -2148,6 +2847,13 @@ class HSICOS():
                 radiation (UPW). Only possible for 400-700nm.
             zonal (bool, optional): If true, zonal statistics (buffer value
                 depending on ecosystem) will be calculated instead of FFs.
+            ff_weights (bool, optional): If true, FFP inputs are kept in the
+                output so that dimred_geom_crop averages components with
+                footprint weights on the image grid.
+            workers (int, optional): Number of worker processes. If > 1,
+                sites are processed in parallel.
+            flux_windows (dict, optional): Multi-day aggregation windows of
+                the flux variables, see hsi_geom_crop.
         
         [1] Kljun, N. et al. (2015): A simple two‐dimensional parameterisation
         for Flux Footprint Prediction (FFP). Geosci. Model Dev., 8, 3695‐3713.
@@ -2175,22 +2881,13 @@ class HSICOS():
         nnal = [0]*len(icos_list)
         na_sites = []
         
-        for i,site in enumerate(pbar := tqdm(icos_list)):
-            pbar.set_description(f'Processing {site}')
-            datelist = self.img_db.loc[self.img_db.name == site, 'startdate'].dt.date
-
-            # (1) Load FF model parameters
-            icos_subset, ZM, fluxvars, missd = self._load_icos_subset(
-                site, datelist, fluxvars0, 'na', no_ppfd, zonal) # hardcoded "no aggregation"
-            
-            # (2) Footprint modeling and geometry generation
-            flx_geom_gdf, ql_list[i], nnal[i] = self._model_geoms(
-                    site, datelist, icos_subset, response, ZM, fluxvars, missd, zonal)
-            
+        site_res = self._map_sites('_gdf_prep_site', icos_list, workers, dict(
+            response=response, zonal=zonal, ff_weights=ff_weights,
+            fluxvars0=fluxvars0, no_ppfd=no_ppfd, flux_windows=flux_windows))
+        for i, (flx_geom_gdf, ql_list[i], nnal[i]) in enumerate(site_res):
             if len(flx_geom_gdf) == 0: # Skip if all obs. of a site have ICOS NA values
-                na_sites.append(site)
+                na_sites.append(icos_list[i])
             flx_geom_gdf_l[i] = flx_geom_gdf
-            
             # LOOP END: step (3a) is performed for all dataTakes at once
         self._nna_icos = sum(nnal)
         if sum(ql_list) > 0:
@@ -2335,6 +3032,7 @@ class HSICOS():
 
         return veg_mask, rgb2
     
+    @profiling.profiled
     def hsi_dimred_prep(self, flx_geom_gdf, mask_params, plot = False,
                         save_plot = False):
         '''
@@ -2372,13 +3070,15 @@ class HSICOS():
             prev_site = site
             
             img_name = f'PRS_L2D_STD_{row["dataTakeID"]}_{row["name"]}_6km_crop.tif'
-            epsg = self.flx_loc.loc[self.flx_loc.name == row['name'], 'sensorcrs'].item()
+            epsg = self.site_index.epsg(row['name'])
             crs_utm = proj.CRS.from_epsg(epsg)
             # Local UTM coordinates used for cropping, modeled geoms are in LAEA
-            flx_loc = self.flx_loc.loc[self.flx_loc.name == row['name'], 'geometry'].to_crs(crs_utm)
+            flx_loc = self.site_index.geom(row['name'], crs_utm)
             
-            with rio.open(self.img_dir / img_name) as src:
+            with profiling.timer('img_read', site=row['name'], dtake=row['dataTakeID']) as t, \
+                    rio.open(self.img_dir / img_name) as src:
                 cube = src.read()
+                t.add(bytes=cube.nbytes, pixels=cube.shape[1] * cube.shape[2])
                 crow, ccol = src.index(flx_loc.x.item(), flx_loc.y.item())
                 wls = [float(w) for w in list(src.descriptions)]
                 itrans = src.meta['transform']
@@ -2387,9 +3087,11 @@ class HSICOS():
             wls = wls[:-4]
             out_ext = riop.plotting_extent(cube, itrans)
         
-            veg_mask, _ = self._mask_px(mask_param=mask_params.iloc[ix], cube=cube,
-                                        wls=wls, row=row, loc=flx_loc, ext=out_ext,
-                                        plot=plot, save_plot=save_plot)
+            with profiling.timer('mask', site=row['name'], dtake=row['dataTakeID'],
+                                 pixels=cube.shape[0] * cube.shape[1]):
+                veg_mask, _ = self._mask_px(mask_param=mask_params.iloc[ix], cube=cube,
+                                            wls=wls, row=row, loc=flx_loc, ext=out_ext,
+                                            plot=plot, save_plot=save_plot)
             
             ## LOOKUPS
             #1 create giant samples x bands table of all obs.
@@ -2469,6 +3171,7 @@ class HSICOS():
                 return {int(k):v for k,v in x.items()}
         return x
 
+    @profiling.profiled
     def dimred_backtransform(self, dr_file, flx_geom_gdf):
         '''
         Back-transform dimension-reduced 2D (non-spatial) hyperspectral data
@@ -2518,7 +3221,9 @@ class HSICOS():
             add += len(valid_rows[ix]) # add += i+1 would also be possible
         return
     
-    def dimred_geom_crop(self, dr_file, flx_geom_gdf, mask_params, upw = False, save = False):
+    @profiling.profiled
+    def dimred_geom_crop(self, dr_file, flx_geom_gdf, mask_params, upw = False, save = False,
+                         ff_members = 0, simplify = 0.):
         '''
         After dimension reduction and backtransform of hyperspectral pixel
         values, this method is used to crop latent component data around the
@@ -2540,6 +3245,11 @@ class HSICOS():
                 radiation (UPW). Only possible for 400-700nm.
             save (bool, optional): If true, footprint geometries are saved as
                 GeoPackage.
+            ff_members (int, optional): Number of Monte Carlo members of
+                perturbed FFP inputs per observation for footprint weights
+                (requires FFP inputs from hsi_gdf_prep with ff_weights).
+            simplify (float, optional): Simplification tolerance of the
+                footprint polygons as a fraction of the pixel size (0 = none).
         '''
         dr_fp = dr_file.split('_')
         icos_list = flx_geom_gdf.name.unique().tolist()
@@ -2554,7 +3264,8 @@ class HSICOS():
             # (3b) Crop of hyperspectral imagery to footprint
             # VNIR hardcoded for now
             flx_comp_gdf_subset, flx_imgs = self._crop_data_2_geoms(
-                site, flx_geom_gdf_subset, mp_subset, dr_fp[1], 'vnir', upw, False)
+                site, flx_geom_gdf_subset, mp_subset, dr_fp[1], 'vnir', upw, False,
+                ff_members, simplify)
             nna = len(flx_comp_gdf_subset[flx_comp_gdf_subset.clouds == 'hsi_na'])
             if nna == len(flx_comp_gdf_subset):
                 logger.warning(f'{site}: All imagery acquisition dates have no'
@@ -2588,7 +3299,9 @@ class HSICOS():
             if fpath.exists():
                 fpath.unlink()
             logger.info(f'Saving file: {fpath.name}')
-            flx_comp_gdf.to_file(fpath, driver='GPKG')
+            with profiling.timer('gpkg_write') as t:
+                flx_comp_gdf.to_file(fpath, driver='GPKG')
+                t.add(bytes=fpath.stat().st_size if profiling.enabled() else 0)
 
         return flx_comp_gdf, flx_imgs_c
     
@@ -2622,6 +3335,7 @@ class HSICOS():
             
 ### INCLUDE COVARIATES ########################################################
 
+    @profiling.profiled
     def icos_ppi_get(self, icos_list, dataset = 'VI', day_range = 12,
                      datelist = None, save = True):
         '''
@@ -2657,9 +3371,10 @@ class HSICOS():
 
         for site in icos_list:
             if datelist == None:
-                datetimes = self.img_db.loc[(self.img_db.name == site) &
-                                            (self.img_db.ppi_file == ''), 'startdate']
-                n_hsi = len(self.img_db[self.img_db.name == site])
+                rows = self.site_index.rows(site)
+                datetimes = self.img_db.loc[rows, 'startdate']
+                datetimes = datetimes[(self.img_db.loc[rows, 'ppi_file'] == '').values]
+                n_hsi = len(rows)
                 if len(datetimes) == 0:
                     logger.info('{}: PPI data for all HSI data takes '.format(site) +
                                  'have already been downloaded. Site will be skipped.')
@@ -2678,10 +3393,10 @@ class HSICOS():
             odir = self.img_dir.parent / 'Copernicus/S2PPI'
             odir.mkdir(parents=True, exist_ok=True)
             
-            epsg = self.flx_loc.loc[self.flx_loc.name == site, 'sensorcrs'].item()
+            epsg = self.site_index.epsg(site)
             crs_utm = proj.CRS.from_epsg(epsg)
             utm_zone = 'T' + crs_utm.utm_zone[:2] # target CRS
-            flx_loc = self.icos_db.loc[self.icos_db.name == site, 'geometry']
+            flx_loc = self.site_index.geom(site)
             
             ext = flx_loc.buffer(0.0001).bounds.squeeze(axis=0).round(4) # 0.0001 deg to get 1 tile only
             flx_loc = flx_loc.to_crs(crs_utm)
@@ -2697,8 +3412,7 @@ class HSICOS():
                                     .format(site, dtakes.iloc[i]))
                         ppi_files[i] = ''
                         datetimes.iloc[i] = 0
-                        self.img_db.loc[(self.img_db.name == site) & (self.img_db.startdate == ts),
-                                        'ppi_file'] = ppi_exp.name
+                        self.img_db.loc[datetimes.index[i], 'ppi_file'] = ppi_exp.name
                         continue
                 except StopIteration:
                     pass # continue processing only if PPI TIF is not found
@@ -2740,24 +3454,25 @@ class HSICOS():
                     if all(matches_exist):
                         pass # skip download if all files are already present
                     else:
-                        try:
-                            matches.download(download_dir=odir) # download all "candidates" to have alternatives for NA check
-                        except requests.exceptions.HTTPError as err:
-                            logger.error('encountered HTTP error. Reconnecting after 30 seconds.')
-                            logger.error(err.response.status_code)
-                            logger.error(err.response.text)
-                            sleep(60)
+                        with profiling.timer('download', site=site):
                             try:
-                                matches.download(download_dir=odir)
-                            except requests.exceptions.HTTPError as err1:
-                                print(type(err.response.status_code))
-                                if err1.response.status_code == 403 or err1.response.status_code == '403':
-                                    logger.error('encountered HTTP 403 FORBIDDEN. Reconnecting after 300 seconds.')
-                                    sleep(360)
-                                    matches.download(download_dir=odir)
-                                else:
-                                    sleep(60)
+                                matches.download(download_dir=odir) # download all "candidates" to have alternatives for NA check
+                            except requests.exceptions.HTTPError as err:
+                                logger.error('encountered HTTP error. Reconnecting after 30 seconds.')
+                                logger.error(err.response.status_code)
+                                logger.error(err.response.text)
+                                sleep(60)
+                                try:
                                     matches.download(download_dir=odir)
+                                except requests.exceptions.HTTPError as err1:
+                                    print(type(err.response.status_code))
+                                    if err1.response.status_code == 403 or err1.response.status_code == '403':
+                                        logger.error('encountered HTTP 403 FORBIDDEN. Reconnecting after 300 seconds.')
+                                        sleep(360)
+                                        matches.download(download_dir=odir)
+                                    else:
+                                        sleep(60)
+                                        matches.download(download_dir=odir)
                         
                     matches_dates = pd.to_datetime(pd.Series([x[3:18] for x in matches_filenames]))
                     matches_datediffs = abs(matches_dates - ts).sort_values().drop_duplicates()
@@ -2841,9 +3556,7 @@ class HSICOS():
                 raise RuntimeError('Length of datetimes and ppi_files for site {} does not align.'.format(site))
     
             ppi_files_new = ['{}_{}_PPI_{}_{}.tif'.format(f[3:18], dataset, site, dtakes.iloc[i]) for i,f in enumerate(ppi_files)]
-            for i, ts in enumerate(datetimes):
-                self.img_db.loc[(self.img_db.name == site) & (self.img_db.startdate == ts),
-                                'ppi_file'] = ppi_files_new[i]
+            self.img_db.loc[datetimes.index, 'ppi_file'] = ppi_files_new
             # crop & save PPI rasters
             flx_loc_pb = flx_loc.buffer(1000)
             box_geom = geometry.box(*flx_loc_pb.total_bounds)
@@ -2869,6 +3582,7 @@ class HSICOS():
         
         return
     
+    @profiling.profiled
     def hsi_add_spei_ppi(self, flx_geom_gdf, mask_params, dimred = True,
                          zonal = False, rm_missing = False, rm_sites = [], save = False):
         '''
@@ -2918,15 +3632,16 @@ class HSICOS():
             dtakes = flx_geom_gdf.loc[flx_geom_gdf.name == site, 'dataTakeID']
             #site_spei = spei.loc[spei.date_str.isin(datelist), ['date_str', 'SPEI365_{}'.format(site)]]
             
-            epsg = self.flx_loc.loc[self.flx_loc.name == site, 'sensorcrs'].item()
+            epsg = self.site_index.epsg(site)
             crs_utm = proj.CRS.from_epsg(epsg)
-            #flx_loc = self.icos_db.loc[self.icos_db.name == site, 'geometry'].to_crs(crs_utm)
+            #flx_loc = self.site_index.geom(site, crs_utm)
             crs_lam = proj.CRS.from_epsg('3035')
             transf = proj.Transformer.from_crs(crs_lam, crs_utm, always_xy=True)
+            with profiling.timer('reproject', site=site):
+                ppi_geoms = _reproject_geoms(flx_geom_gdf.loc[datelist.index, 'geometry'], transf)
 
             for i, date in enumerate(datelist):
-                lam_poly = flx_geom_gdf.loc[datelist.index[i], 'geometry']
-                ppi_geom = stransform(transf.transform, lam_poly)
+                ppi_geom = ppi_geoms[i]
                 fname = flx_geom_gdf.loc[(flx_geom_gdf.name == site) &
                                          (flx_geom_gdf.date == date), 'ppi_file'].item()
                 if len(fname) == 0:
@@ -3000,7 +3715,9 @@ class HSICOS():
             if fpath.exists():
                 fpath.unlink()
             logger.info(f'Saving file {fpath.name}')
-            flx_geom_gdf.to_file(fpath, driver='GPKG')
+            with profiling.timer('gpkg_write') as t:
+                flx_geom_gdf.to_file(fpath, driver='GPKG')
+                t.add(bytes=fpath.stat().st_size if profiling.enabled() else 0)
             mask_params.to_csv(self.out_dir / 'updated_mask_params.csv', index=False)
         
         return flx_geom_gdf, mask_params
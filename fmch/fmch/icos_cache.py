@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar Parquet cache of ICOS L2 half-hourly CSV files (FLUXNET_HH, FLUXES,
+METEO, ...).
+
+    ingest_icos_csv(): Converts a CSV once into typed, compressed Parquet
+        partitioned by year. The cache is rebuilt if mtime or size of the
+        CSV change.
+    read_icos_csv(): Reads selected columns of the records of selected dates
+        (date of TIMESTAMP_END) with partition pruning and predicate pushdown
+        on the row group statistics.
+
+Requires pyarrow.
+
+@author: hermanns
+"""
+import json
+import shutil
+import datetime as dt
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+__all__ = ['ingest_icos_csv', 'read_icos_csv']
+
+DATE_FORMAT = '%Y%m%d%H%M'
+TS_COLS = ['TIMESTAMP_START', 'TIMESTAMP_END']
+# ~1 month of half-hourly records per row group
+ROWS_PER_GROUP = 1488
+
+
+def _source_key(csv_path):
+    st = Path(csv_path).stat()
+    return {'file': Path(csv_path).name, 'mtime_ns': st.st_mtime_ns, 'size': st.st_size}
+
+
+def ingest_icos_csv(csv_path, cache_dir, force = False):
+    '''
+    Converts an ICOS half-hourly CSV file into a Parquet dataset in
+    cache_dir/<file stem>/YEAR=<year>/ (year of TIMESTAMP_END). Timestamps
+    are parsed once, all other columns keep the types inferred by pandas.
+    Nothing is done if the cache was built from a CSV with identical mtime
+    and size.
+
+    Args:
+        csv_path (string / pathlib.Path): ICOS CSV with TIMESTAMP_END column.
+        cache_dir (string / pathlib.Path): Root directory of the cache.
+        force (bool, optional): If true, the cache is rebuilt in any case.
+    Returns:
+        pathlib.Path of the Parquet dataset.
+    '''
+    out = Path(cache_dir) / Path(csv_path).stem
+    manifest = out / '_source.json'
+    key = _source_key(csv_path)
+    if not force and manifest.exists():
+        with open(manifest) as f:
+            if json.load(f) == key:
+                return out
+
+    header = pd.read_csv(csv_path, nrows=0).columns
+    if 'TIMESTAMP_END' not in header:
+        raise ValueError(f'{Path(csv_path).name}: No TIMESTAMP_END column, '
+                         'only half-hourly ICOS files can be cached.')
+    df = pd.read_csv(csv_path, date_format=DATE_FORMAT,
+                     parse_dates=[c for c in TS_COLS if c in header])
+    df['YEAR'] = df.TIMESTAMP_END.dt.year.astype('int16')
+
+    if out.exists():
+        shutil.rmtree(out)
+    ds.write_dataset(pa.Table.from_pandas(df, preserve_index=False), out,
+                     format='parquet', partitioning=['YEAR'],
+                     partitioning_flavor='hive',
+                     file_options=ds.ParquetFileFormat().make_write_options(
+                         compression='zstd'),
+                     min_rows_per_group=ROWS_PER_GROUP,
+                     max_rows_per_group=ROWS_PER_GROUP)
+    # manifest is written last, an interrupted ingestion is repeated
+    with open(manifest, 'w') as f:
+        json.dump(key, f)
+    return out
+
+
+def read_icos_csv(csv_path, cache_dir, columns = None, dates = None):
+    '''
+    Reads an ICOS half-hourly CSV file from the Parquet cache (ingested on
+    first use). The result equals pd.read_csv with parsed timestamps and
+    usecols=columns, reduced to the records whose TIMESTAMP_END date is in
+    dates, but only the required columns, years and row groups are read.
+
+    Args:
+        csv_path (string / pathlib.Path): ICOS CSV with TIMESTAMP_END column.
+        cache_dir (string / pathlib.Path): Root directory of the cache.
+        columns (list of strings, optional): Columns to read (missing
+            columns are ignored). All columns if None.
+        dates (iterable of datetime.date, optional): Dates of interest. All
+            records if None.
+    Returns:
+        pandas.DataFrame
+    '''
+    dset = ds.dataset(ingest_icos_csv(csv_path, cache_dir), format='parquet',
+                      partitioning='hive')
+    cols = [c for c in dset.schema.names if c != 'YEAR' and
+            (columns is None or c in columns)]
+
+    filt = None
+    if dates is not None:
+        dates = sorted({pd.Timestamp(d).date() for d in dates})
+        ts_type = dset.schema.field('TIMESTAMP_END').type
+        filt = ds.field('YEAR').isin(sorted({d.year for d in dates}))
+        in_dates = None
+        for d in dates:
+            t0 = pa.scalar(dt.datetime.combine(d, dt.time()), type=ts_type)
+            t1 = pa.scalar(dt.datetime.combine(d + dt.timedelta(days=1), dt.time()),
+                           type=ts_type)
+            sel = (ds.field('TIMESTAMP_END') >= t0) & (ds.field('TIMESTAMP_END') < t1)
+            in_dates = sel if in_dates is None else in_dates | sel
+        filt = filt & in_dates if in_dates is not None else filt
+
+    df = dset.to_table(columns=cols, filter=filt).to_pandas()
+    if 'TIMESTAMP_END' in df.columns:
+        df = df.sort_values('TIMESTAMP_END', kind='stable').reset_index(drop=True)
+    return df
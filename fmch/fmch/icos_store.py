@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-process store of ICOS L2 site data shared by all HSICOS methods.
+
+    IcosSiteStore: LRU of parsed, time-indexed half-hourly frames, memoized
+        file lookups, header probes and metadata tables (ANCILLARY, INST,
+        canopy & sensor height tables)
+
+@author: hermanns
+"""
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from pathlib import Path
+
+from fmch import profiling
+
+__all__ = ['IcosSiteStore']
+
+
+class IcosSiteStore(object):
+    '''
+    Store of ICOS L2 site data. Every file is parsed at most once per process:
+    half-hourly frames (FLUXNET_HH, FLUXES, METEO) are kept in an LRU with
+    a DatetimeIndex (TIMESTAMP_END) and requests for subsets of cached
+    columns / dates are served from memory. File lookups, headers and
+    metadata tables are memoized without size limit (they are small).
+    Without Parquet cache, requests for selected dates scan the CSV in
+    chunks and only keep the records of these dates, so that memory use
+    does not grow with the length of the time series.
+
+    Args:
+        icos_dir (string / pathlib.Path): Directory of the ICOS L2 CSVs.
+        cache_dir (string / pathlib.Path, optional): Parquet cache directory
+            (see fmch.icos_cache, requires pyarrow). If given, half-hourly
+            files are read from the cache with date filters.
+        maxsize (int, optional): Maximum number of half-hourly frames in
+            the LRU.
+        chunksize (int, optional): Number of CSV rows per chunk of date
+            filtered scans (default: ~1 year). If None, the complete time
+            series is parsed and filtered in memory.
+        date_format (string, optional): Format of ICOS timestamps.
+
+    Attributes:
+        hits, misses: Number of half-hourly frame requests served from / not
+            found in the LRU.
+    '''
+    DC = ['TIMESTAMP_START', 'TIMESTAMP_END']
+
+    def __init__(self, icos_dir, cache_dir = None, maxsize = 16,
+                 chunksize = 17568, date_format = '%Y%m%d%H%M'):
+        self.icos_dir = Path(icos_dir)
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        self.maxsize = maxsize
+        self.chunksize = chunksize
+        self.date_format = date_format
+        self.hits = 0
+        self.misses = 0
+        self._frames = OrderedDict() # (path, columns, dates) -> (frame, days)
+        self._memo = {}
+
+    def __getstate__(self):
+        # worker processes start with an empty store
+        state = self.__dict__.copy()
+        state['_frames'] = OrderedDict()
+        state['_memo'] = {}
+        return state
+
+    def clear(self):
+        '''
+        Empties the LRU and all memoized results.
+        '''
+        self._frames.clear()
+        self._memo.clear()
+
+    def memo(self, key, func):
+        '''
+        Returns the memoized result of func() for key, e.g. derived tables
+        such as canopy and sensor heights of a site.
+        '''
+        if key not in self._memo:
+            self._memo[key] = func()
+        return self._memo[key]
+
+    def icos_file(self, site, var):
+        '''
+        Path of the ICOS L2 file of a site and variable group (e.g.
+        'FLUXNET_HH', 'FLUXES', 'METEO', 'ANCILLARY', 'INST'). Interim files
+        are preferred. None if no file exists.
+        '''
+        def find():
+            for suffix in ['_INTERIM_L2.csv', '_L2.csv']:
+                fpath = self.icos_dir / f'ICOSETC_{site}_{var}{suffix}'
+                if fpath.exists():
+                    return fpath
+            return None
+        return self.memo(('file', site, var), find)
+
+    def fluxnet_file(self, site):
+        '''
+        Path of the half-hourly flux file of a site in ICOS format or, if
+        not available, in FLUXNET format (FLX_*). None if no file exists.
+        '''
+        def find():
+            fpath = self.icos_file(site, 'FLUXNET_HH')
+            if fpath is None:
+                fpath = next(self.icos_dir.glob(f'FLX_{site}_FLUXNET*.csv'), None)
+            return fpath
+        return self.memo(('fluxnet', site), find)
+
+    def header(self, fpath):
+        '''
+        Column names of a CSV file.
+        '''
+        return self.memo(('header', Path(fpath)),
+                         lambda: pd.read_csv(fpath, nrows=0).columns.tolist())
+
+    def table(self, fpath, **kwargs):
+        '''
+        Complete (metadata) table, e.g. ANCILLARY or INST files. kwargs are
+        passed to pd.read_csv. The returned frame is shared, do not modify.
+        '''
+        key = ('table', Path(fpath), tuple(sorted(kwargs.items())))
+        return self.memo(key, lambda: pd.read_csv(fpath, **kwargs))
+
+    def hh(self, fpath, columns = None, dates = None, window = 0):
+        '''
+        Half-hourly records of an ICOS CSV with parsed timestamps.
+
+        Args:
+            fpath (string / pathlib.Path): CSV with TIMESTAMP_END column.
+            columns (list of strings, optional): Columns to return (missing
+                columns are ignored). All columns if None.
+            dates (iterable of datetime.date, optional): Only records whose
+                TIMESTAMP_END date is in dates are returned. All if None.
+            window (int, optional): Records of +-window days around dates
+                are included, e.g. for multi-day aggregation.
+        Returns:
+            pandas.DataFrame (copy with RangeIndex, columns in file order)
+        '''
+        fpath = Path(fpath)
+        cols = [c for c in self.header(fpath) if columns is None or c in columns]
+        # TIMESTAMP_END (index & date filter) is read in any case
+        read = [c for c in self.header(fpath) if c in cols or c == 'TIMESTAMP_END']
+        days = None if dates is None else \
+            np.unique(np.array([np.datetime64(pd.Timestamp(d).date(), 'D') for d in dates],
+                               dtype='datetime64[D]')[:, None] +
+                      np.arange(-window, window + 1).astype('timedelta64[D]'))
+
+        entry = self._lookup(fpath, read, days)
+        if entry is None:
+            self.misses += 1
+            with profiling.timer('icos_parse') as t:
+                entry = self._load(fpath, read, days)
+                t.add(bytes=fpath.stat().st_size if profiling.enabled() else 0)
+        else:
+            self.hits += 1
+            profiling.count('icos_store_hit')
+        frame, fdays = entry
+
+        if days is not None:
+            frame = frame.loc[np.isin(fdays, days)]
+        return frame.loc[:, cols].reset_index(drop=True)
+
+    def _lookup(self, fpath, cols, days):
+        for key in reversed(self._frames):
+            kpath, kcols, kdays = key
+            if kpath != fpath or not set(cols) <= kcols:
+                continue
+            if kdays is None or (days is not None and set(days.tolist()) <= kdays):
+                self._frames.move_to_end(key)
+                return self._frames[key]
+        return None
+
+    def _load(self, fpath, cols, days):
+        if self.cache_dir is not None:
+            from fmch.icos_cache import read_icos_csv
+            frame = read_icos_csv(fpath, self.cache_dir, columns=cols,
+                                  dates=None if days is None else days.astype(object))
+            kdays = None if days is None else frozenset(days.tolist())
+        elif days is not None and self.chunksize:
+            frame = self._scan(fpath, cols, days)
+            kdays = frozenset(days.tolist())
+        else:
+            # without cache, the complete time series is parsed once. Cached
+            # columns of the same file are merged into the new entry, so that
+            # alternating column requests do not parse the file repeatedly.
+            for key in [k for k in self._frames if k[0] == fpath and k[2] is None]:
+                cols = cols + [c for c in key[1] if c not in cols]
+                del self._frames[key]
+            cols = [c for c in self.header(fpath) if c in cols]
+            frame = pd.read_csv(fpath, date_format=self.date_format,
+                                parse_dates=[x for x in self.DC if x in cols],
+                                usecols=lambda x: x in cols)
+            kdays = None
+        frame = frame.set_index(frame.TIMESTAMP_END.rename(None), drop=False)
+        entry = (frame, frame.index.values.astype('datetime64[D]'))
+
+        self._frames[(fpath, frozenset(cols), kdays)] = entry
+        while len(self._frames) > self.maxsize:
+            self._frames.popitem(last=False)
+        return entry
+
+    def _scan(self, fpath, cols, days):
+        # date key of TIMESTAMP_END (YYYYMMDD) is compared before parsing
+        keys = {d.replace('-', '') for d in np.datetime_as_string(days, unit='D')}
+        last = max(keys)
+        parts = []
+        with pd.read_csv(fpath, usecols=lambda x: x in cols, chunksize=self.chunksize,
+                         dtype={x: str for x in self.DC}) as reader:
+            for chunk in reader:
+                day = chunk.TIMESTAMP_END.str[:8]
+                parts.append(chunk.loc[day.isin(keys)])
+                if day.iloc[-1] > last: # ICOS files are sorted by time
+                    break
+        frame = pd.concat(parts, ignore_index=True)
+        for x in self.DC:
+            if x in cols:
+                frame[x] = pd.to_datetime(frame[x], format=self.date_format)
+        return frame
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stage runner for the preprocessing workflow (01_hsi_gpp_preproc_main.py).
+
+    Stage: Declaration of a processing step (e.g. a HSICOS method) with its
+        upstream stages, input files, parameters and output files. Stages
+        can be split into one task per key (e.g. per ICOS site).
+    Pipeline: Runs the stages in dependency order. Every task is
+        fingerprinted (input file hashes, parameters, fingerprints of the
+        upstream tasks) and skipped if its fingerprint is unchanged and its
+        outputs exist. Independent tasks run concurrently.
+
+After a small change (e.g. one new scene or one changed mask parameter row)
+only the tasks depending on it are recomputed, e.g.
+
+    pl = Pipeline(hsi.out_dir / '_pipeline', workers=4)
+    pl.add(Stage('crop', lambda site: hsi.hsi_geom_crop([site], ...),
+                 keys=sites, params=lambda site: mp[mp.name == site],
+                 inputs=lambda site: list(hsi.img_dir.glob(f'*{site}*crop.tif'))))
+    res = pl.run()
+
+@author: hermanns
+"""
+import json
+import pickle
+import hashlib
+import logging
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import pandas as pd
+
+__all__ = ['Stage', 'Pipeline', 'fingerprint']
+
+logger = logging.getLogger(__name__)
+
+_CHUNK = 1 << 20 # bytes per read when hashing files
+
+
+def _encode(obj):
+    # JSON encoding of parameters: tables are hashed by content
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return {'shape': list(obj.shape), 'columns': [str(c) for c in getattr(obj, 'columns', [])],
+                'hash': hashlib.sha256(pd.util.hash_pandas_object(
+                    obj, index=True).values.tobytes()).hexdigest()}
+    if isinstance(obj, np.ndarray):
+        return {'dtype': str(obj.dtype), 'shape': list(obj.shape),
+                'hash': hashlib.sha256(np.ascontiguousarray(obj).tobytes()).hexdigest()}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj, key=repr)
+    if isinstance(obj, Path):
+        return str(obj)
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    return repr(obj)
+
+
+def fingerprint(*objs):
+    '''
+    SHA-256 of parameters (JSON-serializable objects, pandas objects, numpy
+    arrays, paths, dates). Equal parameters result in equal fingerprints
+    across sessions.
+    '''
+    return hashlib.sha256(json.dumps(objs, sort_keys=True, default=_encode)
+                          .encode()).hexdigest()
+
+
+class Stage(object):
+    '''
+    Processing step of a Pipeline.
+
+    Args:
+        name (string): Unique name of the stage.
+        func (callable): Runs the stage. Called with the results of the
+            upstream stages as keyword arguments (names of deps), keyed
+            stages additionally with the key as first argument.
+        deps (list of strings, optional): Names of upstream stages. If the
+            upstream stage is keyed with the same key, only the result of
+            that key is passed (and only its changes cause a rerun), other-
+            wise a dict {key: result}.
+        inputs (list or callable, optional): Input files / directories
+            (hashed by content), or a function key -> list for keyed stages.
+            Missing files are fingerprinted as missing.
+        params (object or callable, optional): Parameters of the stage (e.g.
+            a dict of method arguments or the mask parameter rows of a
+            site), or a function key -> parameters.
+        outputs (list or callable, optional): Output files, or a function
+            key -> list. A task is rerun if one of them is missing.
+        keys (list or callable, optional): The stage is run as one task per
+            key (e.g. per ICOS site). A callable is called with the results
+            of the upstream stages (as func) and returns the keys.
+        load (callable, optional): Returns the result of a skipped task
+            (e.g. a load_*_db method of HSICOS), called without arguments
+            (keyed stages: with the key). By default, results are pickled
+            by the Pipeline.
+        exclusive (bool or string, optional): If true, tasks of the stage do
+            not run concurrently with each other (e.g. methods that modify
+            img_db). A string names a lock shared across stages: tasks of all
+            stages with the same lock do not run concurrently (e.g. stages
+            that modify img_db and stages that read it).
+        fingerprint_deps (list of strings, optional): Upstream stages whose
+            fingerprints enter the fingerprint of the tasks. All deps by
+            default. Deps whose relevant state is already part of params
+            (e.g. the img_db rows of a site) can be excluded, so that
+            changes for other keys do not cause a rerun.
+    '''
+    def __init__(self, name, func, deps = [], inputs = [], params = None,
+                 outputs = [], keys = None, load = None, exclusive = False,
+                 fingerprint_deps = None):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.inputs = inputs
+        self.params = params
+        self.outputs = outputs
+        self.keys = keys
+        self.load = load
+        self.exclusive = exclusive
+        self.fingerprint_deps = self.deps if fingerprint_deps is None else list(fingerprint_deps)
+
+    @property
+    def lock(self):
+        # name of the lock held by running tasks, None if not exclusive
+        if isinstance(self.exclusive, str):
+            return self.exclusive
+        return self.name if self.exclusive else None
+
+    def _arg(self, attr, key):
+        value = getattr(self, attr)
+        return value(key) if (callable(value) and self.keys is not None) else value
+
+
+class Pipeline(object):
+    '''
+    Runs Stages in dependency order and skips tasks whose fingerprint is
+    unchanged and whose outputs exist. Fingerprints, hashes of input files
+    (cached by mtime & size) and pickled results are stored in state_dir.
+
+    Args:
+        state_dir (string / pathlib.Path): Directory of the pipeline state.
+        workers (int, optional): Number of threads. Tasks whose upstream
+            tasks are finished run concurrently; tasks of stages that
+            modify shared state (e.g. img_db of a HSICOS instance) must
+            therefore be ordered via deps or share a lock (Stage.exclusive).
+
+    Attributes:
+        ran, skipped (lists): Task ids (stage or stage[key]) of the last run.
+    '''
+    def __init__(self, state_dir, workers = 1):
+        self.state_dir = Path(state_dir)
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        self.workers = workers
+        self.stages = {}
+        self.ran = []
+        self.skipped = []
+        self._state_file = self.state_dir / 'state.json'
+        if self._state_file.exists():
+            with open(self._state_file) as f:
+                state = json.load(f)
+        else:
+            state = {}
+        self._fps = state.get('tasks', {})
+        self._hashes = state.get('files', {})
+
+    def add(self, stage):
+        '''
+        Adds a stage. Upstream stages must be added first.
+        '''
+        if stage.name in self.stages:
+            raise ValueError(f'Stage {stage.name} already exists.')
+        missing = [d for d in stage.deps if d not in self.stages]
+        if len(missing) > 0:
+            raise ValueError(f'{stage.name}: unknown upstream stage(s) {missing}.')
+        extra = [d for d in stage.fingerprint_deps if d not in stage.deps]
+        if len(extra) > 0:
+            raise ValueError(f'{stage.name}: fingerprint_deps {extra} are not in deps.')
+        self.stages[stage.name] = stage
+        return stage
+
+    def invalidate(self, name):
+        '''
+        Forces a rerun of all tasks of a stage, e.g. after changes of its
+        code (code is not fingerprinted).
+        '''
+        self._fps = {k: v for k, v in self._fps.items()
+                     if k != name and not k.startswith(name + '[')}
+        self._save_state()
+
+    def file_hash(self, path):
+        '''
+        SHA-256 of a file or of all files in a directory. Hashes are cached
+        and only recomputed if mtime or size changed.
+        '''
+        path = Path(path)
+        if path.is_dir():
+            return fingerprint([(str(p.relative_to(path)), self.file_hash(p))
+                                for p in sorted(path.rglob('*')) if p.is_file()])
+        if not path.exists():
+            return None
+        st = path.stat()
+        cached = self._hashes.get(str(path))
+        if cached is not None and cached[:2] == [st.st_mtime_ns, st.st_size]:
+            return cached[2]
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(_CHUNK), b''):
+                h.update(block)
+        self._hashes[str(path)] = [st.st_mtime_ns, st.st_size, h.hexdigest()]
+        return h.hexdigest()
+
+    def run(self, targets = None):
+        '''
+        Runs all stages (or the stages in targets and their upstream stages)
+        and returns their results {stage: result}. Results of keyed stages
+        are dicts {key: result}.
+        '''
+        names = list(self.stages) if targets is None else self._upstream(targets)
+        self.ran, self.skipped = [], []
+        fps, results, keys = {}, {}, {}
+        left = {} # nr. of unfinished tasks per stage
+        pending = {n: set(self.stages[n].deps) for n in names}
+        running, ready = {}, []
+        with ThreadPoolExecutor(max_workers=max(self.workers, 1)) as ex:
+            while pending or running or ready:
+                # expand stages whose upstream stages are finished into tasks
+                for name in [n for n, d in pending.items()
+                             if all(left.get(x) == 0 for x in d)]:
+                    del pending[name]
+                    stage = self.stages[name]
+                    if stage.keys is None:
+                        keys[name] = None
+                        tasks = [None]
+                    else:
+                        klist = stage.keys(**self._dep_args(stage, None, keys, results, fps)) \
+                            if callable(stage.keys) else stage.keys
+                        keys[name] = list(klist)
+                        tasks = keys[name]
+                    results[name] = None if keys[name] is None else dict.fromkeys(tasks)
+                    left[name] = len(tasks)
+                    for key in tasks:
+                        tid = _task_id(name, key)
+                        fps[tid] = self._fingerprint(stage, key, keys, fps)
+                        if self._current(stage, key, tid, fps[tid]):
+                            self.skipped.append(tid)
+                            self._store(results, name, key, _Lazy(self, stage, key, tid))
+                            left[name] -= 1
+                            continue
+                        args = self._dep_args(stage, key, keys, results, fps)
+                        args = args if key is None else dict(args, _key=key)
+                        ready.append((stage, key, tid, args))
+                busy = {s.lock for s, _, _ in running.values() if s.lock is not None}
+                for task in [t for t in ready]:
+                    stage, key, tid, args = task
+                    if stage.lock in busy:
+                        continue
+                    ready.remove(task)
+                    running[ex.submit(_call, stage.func, args)] = (stage, key, tid)
+                    if stage.lock is not None:
+                        busy.add(stage.lock)
+                if not running:
+                    continue # all tasks of the expanded stages were skipped
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    stage, key, tid = running.pop(fut)
+                    res = fut.result() # errors are raised after running tasks finished
+                    self._finish(stage, tid, fps[tid], res)
+                    self._store(results, stage.name, key, res)
+                    left[stage.name] -= 1
+                    self.ran.append(tid)
+                    logger.info(f'Pipeline: {tid} finished.')
+        logger.info(f'Pipeline: {len(self.ran)} tasks run, {len(self.skipped)} up to date.')
+        return {n: self._resolve(results[n]) for n in names}
+
+    def _upstream(self, targets):
+        if isinstance(targets, str):
+            targets = [targets]
+        names, stack = set(), list(targets)
+        while stack:
+            n = stack.pop()
+            if n not in names:
+                names.add(n)
+                stack.extend(self.stages[n].deps)
+        return [n for n in self.stages if n in names]
+
+    def _store(self, results, name, key, value):
+        if key is None:
+            results[name] = value
+        else:
+            results[name][key] = value
+
+    def _resolve(self, value):
+        if isinstance(value, dict):
+            return {k: self._resolve(v) for k, v in value.items()}
+        return value.get() if isinstance(value, _Lazy) else value
+
+    def _dep_args(self, stage, key, keys, results, fps):
+        args = {}
+        for d in stage.deps:
+            if key is not None and keys[d] is not None and key in keys[d]:
+                args[d] = self._resolve(results[d][key])
+            else:
+                args[d] = self._resolve(results[d])
+        return args
+
+    def _fingerprint(self, stage, key, keys, fps):
+        up = []
+        for d in stage.fingerprint_deps:
+            if key is not None and keys[d] is not None and key in keys[d]:
+                up.append(fps[_task_id(d, key)])
+            elif keys[d] is None:
+                up.append(fps[d])
+            else:
+                up.append([fps[_task_id(d, k)] for k in keys[d]])
+        inputs = stage._arg('inputs', key) or []
+        files = [(str(p), self.file_hash(p)) for p in inputs]
+        return fingerprint(stage.name, key, stage._arg('params', key), files, up)
+
+    def _current(self, stage, key, tid, fp):
+        if self._fps.get(tid) != fp:
+            return False
+        outputs = stage._arg('outputs', key) or []
+        if not all(Path(p).exists() for p in outputs):
+            return False
+        return stage.load is not None or self._result_path(tid).exists()
+
+    def _finish(self, stage, tid, fp, res):
+        if stage.load is None:
+            with open(self._result_path(tid), 'wb') as f:
+                pickle.dump(res, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._fps[tid] = fp
+        self._save_state()
+
+    def _result_path(self, tid):
+        return self.state_dir / f'{hashlib.sha1(tid.encode()).hexdigest()}.pkl'
+
+    def _save_state(self):
+        tmp = self._state_file.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'tasks': self._fps, 'files': self._hashes}, f)
+        tmp.replace(self._state_file)
+
+
+class _Lazy(object):
+    # Result of a skipped task, only loaded if a downstream task requires it
+    def __init__(self, pipeline, stage, key, tid):
+        self.pipeline, self.stage, self.key, self.tid = pipeline, stage, key, tid
+        self._value, self._loaded = None, False
+
+    def get(self):
+        if not self._loaded:
+            if self.stage.load is not None:
+                self._value = self.stage.load() if self.key is None else self.stage.load(self.key)
+            else:
+                with open(self.pipeline._result_path(self.tid), 'rb') as f:
+                    self._value = pickle.load(f)
+            self._loaded = True
+        return self._value
+
+
+def _task_id(name, key):
+    return name if key is None else f'{name}[{key}]'
+
+
+def _call(func, args):
+    key = args.pop('_key', None)
+    return func(**args) if key is None else func(key, **args)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runtime instrumentation of the HSICOS hot paths (zip decoding, image reads,
+masking, cropping, reprojection, footprint contours, zonal means, ICOS CSV
+parsing, GPKG writes, downloads).
+
+    timer(): Context manager that records the duration, bytes read and
+        pixels processed of a code section per site and data take
+    count(): Increments a counter (e.g. cache hits)
+    scope(): Sets the site / data take of all records within the block
+    profiled(): Decorator of HSICOS methods which writes a profile report
+        (JSON or CSV) to the output directory at the end of the method
+    enable(), disable(), summary(), report(), reset()
+
+Instrumentation is off by default (or switched on with the environment
+variable FMCH_PROFILE=1 / FMCH_PROFILE=csv). If off, timer() returns a
+shared no-op context manager, e.g.
+
+    from fmch import profiling
+    profiling.enable()
+    prisma_gpp.hsi_geom_crop(...) # -> out_dir/profile_hsi_geom_crop.json
+    profiling.summary()
+
+@author: hermanns
+"""
+import os
+import json
+import threading
+import functools
+from time import perf_counter
+from pathlib import Path
+
+import pandas as pd
+
+__all__ = ['enable', 'disable', 'enabled', 'timer', 'count', 'scope',
+           'profiled', 'records', 'summary', 'report', 'reset']
+
+FIELDS = ['name', 'site', 'dtake', 'seconds', 'calls', 'bytes', 'pixels']
+
+_env = os.environ.get('FMCH_PROFILE', '')
+_state = {'on': _env not in ['', '0'], 'format': 'csv' if _env == 'csv' else 'json'}
+_records = [] # (thread id, *FIELDS)
+_lock = threading.Lock()
+_local = threading.local() # site & data take of the current scope
+
+
+def enable(fmt = 'json'):
+    '''
+    Switches instrumentation on. fmt is the format of the reports of
+    profiled methods ('json' or 'csv').
+    '''
+    if fmt not in ['json', 'csv']:
+        raise ValueError('fmt must be "json" or "csv".')
+    _state.update(on=True, format=fmt)
+
+
+def disable():
+    '''
+    Switches instrumentation off (records are kept).
+    '''
+    _state['on'] = False
+
+
+def enabled():
+    return _state['on']
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, bytes = 0, pixels = 0):
+        pass
+
+_NULL = _NullTimer()
+
+
+class _Timer(object):
+    __slots__ = ('name', 'site', 'dtake', 'bytes', 'pixels', 't0')
+
+    def __init__(self, name, site, dtake, bytes, pixels):
+        self.name, self.site, self.dtake = name, site, dtake
+        self.bytes, self.pixels = bytes, pixels
+
+    def __enter__(self):
+        self.t0 = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _add(self.name, self.site, self.dtake, perf_counter() - self.t0, 1,
+             self.bytes, self.pixels)
+        return False
+
+    def add(self, bytes = 0, pixels = 0):
+        '''
+        Adds bytes / pixels that are only known within the block.
+        '''
+        self.bytes += int(bytes)
+        self.pixels += int(pixels)
+
+
+def _add(name, site, dtake, seconds, calls, nbytes, pixels):
+    if site is None:
+        site = getattr(_local, 'site', None)
+    if dtake is None:
+        dtake = getattr(_local, 'dtake', None)
+    with _lock:
+        _records.append((threading.get_ident(), name, site, dtake, seconds,
+                         calls, nbytes, pixels))
+
+
+def timer(name, site = None, dtake = None, bytes = 0, pixels = 0):
+    '''
+    Context manager that records the duration of a code section.
+
+    Args:
+        name (string): Name of the section, e.g. 'crop'.
+        site, dtake (string, optional): ICOS site & data take. By default,
+            those of the enclosing scope().
+        bytes, pixels (int, optional): Bytes read & pixels processed, can
+            also be added within the block (timer.add).
+    '''
+    if not _state['on']:
+        return _NULL
+    return _Timer(name, site, dtake, int(bytes), int(pixels))
+
+
+def count(name, n = 1, site = None, dtake = None, bytes = 0, pixels = 0):
+    '''
+    Increments the counter name by n.
+    '''
+    if _state['on']:
+        _add(name, site, dtake, 0., n, int(bytes), int(pixels))
+
+
+class scope(object):
+    '''
+    Context manager that sets the site (and data take) of all records of
+    the current thread within the block.
+    '''
+    def __init__(self, site = None, dtake = None):
+        self.site, self.dtake = site, dtake
+
+    def __enter__(self):
+        self.prev = (getattr(_local, 'site', None), getattr(_local, 'dtake', None))
+        if self.site is not None:
+            _local.site = self.site
+        if self.dtake is not None:
+            _local.dtake = self.dtake
+        return self
+
+    def __exit__(self, *exc):
+        _local.site, _local.dtake = self.prev
+        return False
+
+
+def records(start = 0, thread_only = False):
+    '''
+    Records (from index start) as a DataFrame with columns FIELDS. If
+    thread_only, only the records of the current thread are returned (e.g.
+    of a method call while other threads are recording as well).
+    '''
+    ident = threading.get_ident()
+    with _lock:
+        recs = [r[1:] for r in _records[start:] if not thread_only or r[0] == ident]
+    return pd.DataFrame(recs, columns=FIELDS)
+
+
+def mark():
+    '''
+    Current number of records, e.g. to select the records of a method call.
+    '''
+    return len(_records)
+
+
+def extend(recs):
+    '''
+    Adds records of another process (list of tuples as in FIELDS). They are
+    attributed to the current thread.
+    '''
+    ident = threading.get_ident()
+    with _lock:
+        _records.extend((ident,) + tuple(r) for r in recs)
+
+
+def reset():
+    '''
+    Deletes all records.
+    '''
+    with _lock:
+        del _records[:]
+
+
+def summary(recs = None, by = ['name']):
+    '''
+    Sums of durations, calls, bytes and pixels per group (e.g. ['site',
+    'name'] or ['site', 'dtake', 'name']), sorted by duration.
+    '''
+    recs = records() if recs is None else recs
+    out = recs.groupby(by, dropna=False)[FIELDS[3:]].sum()
+    out['ms_per_call'] = out.seconds / out.calls.where(out.calls > 0) * 1e3
+    return out.sort_values('seconds', ascending=False).reset_index()
+
+
+def report(fpath, recs = None):
+    '''
+    Writes a profile report: CSV of all records or JSON with totals per
+    section, per site & section and per data take & section.
+    '''
+    recs = records() if recs is None else recs
+    fpath = Path(fpath)
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    if fpath.suffix == '.csv':
+        recs.to_csv(fpath, index=False)
+        return fpath
+    rep = {'sections': summary(recs),
+           'sites': summary(recs, ['site', 'name']),
+           'data_takes': summary(recs, ['site', 'dtake', 'name'])}
+    with open(fpath, 'w') as f:
+        json.dump({k: v.astype(object).where(v.notna(), None).to_dict('records')
+                   for k, v in rep.items()}, f, indent=1)
+    return fpath
+
+
+def profiled(method):
+    '''
+    Decorator of HSICOS methods: if instrumentation is on, the total
+    duration of the method is recorded and the records of the call are
+    written to out_dir/profile_<method>.<json/csv>.
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not _state['on']:
+            return method(self, *args, **kwargs)
+        start = mark()
+        try:
+            with timer(method.__name__):
+                return method(self, *args, **kwargs)
+        finally:
+            fpath = Path(getattr(self, 'out_dir', '.')) / \
+                f'profile_{method.__name__}.{_state["format"]}'
+            report(fpath, records(start, thread_only=True))
+    return wrapper
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Keyed access to the per-site tables of HSICOS.
+
+    SiteIndex: Row labels of the imagery metadata (img_db) per site and per
+        (name, dataTakeID), cached ICOS station attributes, EPSG codes of
+        the sites (flx_loc) and projected site locations.
+
+@author: hermanns
+"""
+import numpy as np
+import pandas as pd
+
+__all__ = ['SiteIndex']
+
+
+class SiteIndex(object):
+    '''
+    Index of the HSICOS tables img_db, icos_db and flx_loc. Lookups of rows
+    by site or data take are dict / hash accesses instead of boolean scans
+    over all rows. Values of img_db can be updated in place (set_img); if
+    rows of a table change, the index has to be rebuilt (HSICOS does this
+    whenever img_db or flx_loc are reassigned).
+
+    Args:
+        img_db (pandas.DataFrame): Imagery metadata (columns 'name',
+            'dataTakeID', 'date', ...).
+        icos_db (geopandas.GeoDataFrame): ICOS station metadata (columns
+            'name', 'ecosystem', 'geometry', ...).
+        flx_loc (geopandas.GeoDataFrame, optional): CRS and location overview
+            of the sites (columns 'name', 'sensorcrs', ...).
+    '''
+    def __init__(self, img_db, icos_db, flx_loc = None):
+        self.img_db = img_db
+        self.icos_db = icos_db
+        self.flx_loc = flx_loc
+
+        # img_db row labels per site (categorical codes, stable order)
+        names = pd.Categorical(img_db.name)
+        order = np.argsort(names.codes, kind='stable')
+        bounds = np.searchsorted(names.codes[order], np.arange(len(names.categories) + 1))
+        self._site_rows = {site: img_db.index[order[bounds[k]:bounds[k+1]]]
+                           for k, site in enumerate(names.categories)}
+        # img_db row labels per (name, dataTakeID)
+        keys = pd.MultiIndex.from_arrays([img_db.name, img_db.dataTakeID])
+        first = ~keys.duplicated()
+        self._img_keys = pd.Series(img_db.index[first], index=keys[first])
+
+        self._icos_rows = dict(zip(icos_db.name, icos_db.index))
+        self._epsg = {} if flx_loc is None else dict(zip(flx_loc.name, flx_loc.sensorcrs))
+        self._geoms = {}
+
+    def rows(self, site, date = None):
+        '''
+        Row labels of img_db of a site (optionally of a date 'YYYY-MM-DD').
+        '''
+        rows = self._site_rows.get(site, self.img_db.index[:0])
+        if date is not None:
+            rows = rows[(self.img_db.loc[rows, 'date'] == date).values]
+        return rows
+
+    def labels(self, site, dtakes):
+        '''
+        Row labels of img_db of data takes of a site (unknown data takes are
+        ignored).
+        '''
+        if isinstance(dtakes, str):
+            dtakes = [dtakes]
+        ix = self._img_keys.index.get_indexer(
+            pd.MultiIndex.from_arrays([[site]*len(dtakes), list(dtakes)]))
+        return pd.Index(self._img_keys.values[ix[ix >= 0]])
+
+    def set_img(self, site, dtakes, column, values):
+        '''
+        Sets values of a column of img_db for data takes of a site in a
+        single update. values is a scalar or a list aligned with dtakes.
+        '''
+        if isinstance(dtakes, str):
+            dtakes = [dtakes]
+        ix = self._img_keys.index.get_indexer(
+            pd.MultiIndex.from_arrays([[site]*len(dtakes), list(dtakes)]))
+        ok = ix >= 0
+        if not np.isscalar(values):
+            values = [v for v, k in zip(values, ok) if k]
+        self.img_db.loc[self._img_keys.values[ix[ok]], column] = values
+
+    def icos(self, site, column):
+        '''
+        Attribute of an ICOS station from icos_db (e.g. 'ecosystem').
+        '''
+        return self.icos_db.at[self._icos_rows[site], column]
+
+    def epsg(self, site):
+        '''
+        EPSG code of the local (UTM) CRS of a site from flx_loc.
+        '''
+        if self.flx_loc is None:
+            raise RuntimeError('No CRS overview of ICOS sites available. '
+                               'Create with crs_and_cropping method.')
+        return int(self._epsg[site])
+
+    def geom(self, site, crs = None):
+        '''
+        Location of an ICOS station (GeoSeries of length 1), cached per CRS.
+        The returned GeoSeries is shared, do not modify.
+        '''
+        key = (site, crs)
+        if key not in self._geoms:
+            loc = self.icos_db.geometry.loc[[self._icos_rows[site]]]
+            self._geoms[key] = loc if crs is None else loc.to_crs(crs)
+        return self._geoms[key]
@@ -14,6 +14,7 @@ from .cnmf import *
 from .chnmf import *
 from .snmf import *
 from .aa import *
+from .saa import *
 
 from .laesa import *
 from .bnmf import *
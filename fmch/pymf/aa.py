@@ -90,11 +90,10 @@ class AA(PyMFBase):
         """ alternating least squares step, update H enforcing a convexity
         constraint.
         """
-        def update_single_h(i):
+        def update_single_h(i, FA):
             """ compute single H[:,i] """
             # optimize alpha using qp solver from cvxopt
-            FA = base.matrix(np.float64(np.dot(-self.W.T, self.data[:,i])))
-            al = solvers.qp(HA, FA, INQa, INQb, EQa, EQb)
+            al = solvers.qp(HA, base.matrix(FA), INQa, INQb, EQa, EQb)
             self.H[:,i] = np.array(al['x']).reshape((1, self._num_bases))
 
         EQb = base.matrix(1.0, (1,1))
@@ -104,8 +103,11 @@ class AA(PyMFBase):
         INQb = base.matrix(0.0, (self._num_bases,1))
         EQa = base.matrix(1.0, (1, self._num_bases))
         
-        for i in range(self._num_samples):
-            update_single_h(i)        
+        # read data in column blocks (h5py/memmap data is not loaded at once)
+        for sl in self._col_blocks():
+            FA = np.float64(np.dot(-self.W.T, self._data_block(sl)))
+            for j, i in enumerate(range(sl.start, sl.stop)):
+                update_single_h(i, FA[:, j])
 
     def _update_w(self):
         """ alternating least squares step, update W enforcing a convexity
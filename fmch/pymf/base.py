@@ -11,7 +11,13 @@ import scipy.sparse
 from numpy.linalg import eigh
 from scipy.special import factorial
 
-__all__ = ["PyMFBase", "PyMFBase3", "eighk", "cmdet", "simplex"]
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+__all__ = ["PyMFBase", "PyMFBase3", "TransposedData", "eighk", "cmdet",
+           "simplex"]
 _EPS = np.finfo(float).eps
 
 def eighk(M, k=0):
@@ -91,6 +97,57 @@ def simplex(d):
     return V
 
 
+def _out_of_core(data):
+    """ True if data lives on disk (h5py dataset, np.memmap or a
+    TransposedData view) and should only be read in column blocks.
+    """
+    if isinstance(data, (np.memmap, TransposedData)):
+        return True
+    return h5py is not None and isinstance(data, h5py.Dataset)
+
+
+class TransposedData():
+    """
+    TransposedData(data, dims=None)
+
+    Read-only "data_dimension x num_samples" view of a "num_samples x
+    data_dimension" array on disk, e.g. the pixel x band h5py datasets
+    written by HSICOS.hsi_dimred_prep. Selecting a block of samples reads
+    the corresponding rows only, thus the matrix can be factorized in place.
+
+    Parameters
+    ----------
+    data : h5py.Dataset, np.memmap or array_like, shape (num_samples, dims)
+    dims : slice or sorted list of ints, optional
+        Subset of the second axis (e.g. slice(0, 66) for VNIR bands only).
+
+    Example
+    -------
+    >>> import h5py
+    >>> f = h5py.File('DR_hsi_transp_PRISMA_bg_ref.h5', 'r')
+    >>> sivm_mdl = SIVM(TransposedData(f['ds1'], dims=slice(0, 66)))
+    """
+    ndim = 2
+
+    def __init__(self, data, dims=None):
+        self._data = data
+        self._dims = slice(None) if dims is None else dims
+        num_dims = len(np.arange(data.shape[1])[self._dims])
+        self.shape = (num_dims, data.shape[0])
+        self.dtype = data.dtype
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        dkey, skey = key
+        if isinstance(self._dims, slice):
+            block = self._data[skey, self._dims]
+        else:
+            block = self._data[skey][..., self._dims]
+        block = np.asarray(block).T
+        return block[dkey]
+
+
 class PyMFBase():
     """
     PyMF Base Class. Does nothing useful apart from providing some basic methods.
@@ -99,6 +156,12 @@ class PyMFBase():
 
     _EPS = _EPS
 
+    # number of samples processed at once when iterating over data columns
+    _block_size = 50000
+
+    # sorted sample indices for estimating the error (see factorize)
+    _err_cols = None
+
     def __init__(self, data, num_bases=4, **kwargs):
         """
         """
@@ -137,15 +200,100 @@ class PyMFBase():
         -------
         residual : float
         """
-        res = np.sum(np.abs(self.data - np.dot(self.W, self.H)))
-        total = 100.0*res/np.sum(np.abs(self.data))
-        return total
+        res = 0.0
+        total = 0.0
+        for sl in self._col_blocks():
+            data = self._data_block(sl)
+            if scipy.sparse.issparse(data):
+                data = data.toarray()
+            # H might be sparse (e.g. Kmeans)
+            res += np.sum(np.abs(data - self.H[:, sl].T.dot(self.W.T).T))
+            total += np.sum(np.abs(data))
+        return 100.0*res/total
+
+    def _col_blocks(self, cols=None):
+        """ Yields column selections of at most _block_size samples, either
+        as slices over all samples or as chunks of the (sorted) index array
+        cols.
+        """
+        if cols is None:
+            for idx_start in range(0, self._num_samples, self._block_size):
+                yield slice(idx_start, min(idx_start + self._block_size,
+                                           self._num_samples))
+        else:
+            for idx_start in range(0, len(cols), self._block_size):
+                yield cols[idx_start:idx_start + self._block_size]
+
+    def _data_block(self, sl):
+        """ Returns the columns data[:, sl] as an in-memory (dense or sparse)
+        matrix. Overwrite if data has to be transformed on the fly (e.g. mean
+        centering of out-of-core data in PCA).
+        """
+        data = self.data[:, sl]
+        if isinstance(data, np.memmap):
+            data = np.asarray(data)
+        return data
+
+    def _data_columns(self, idx):
+        """ Returns data[:, idx] for an arbitrary list of sample indices
+        (any order, repetitions allowed).
+        """
+        idx = np.asarray(idx)
+        if scipy.sparse.issparse(self.data):
+            return self.data[:, idx]
+        # sort indices, otherwise h5py won't work
+        uidx, inv = np.unique(idx, return_inverse=True)
+        return np.asarray(self.data[:, uidx])[:, inv.reshape(-1)]
+
+    def _data_dot(self, M):
+        """ Returns data * M for a "num_samples x n" matrix M, accumulated
+        over column blocks.
+        """
+        R = np.zeros((self._data_dimension, M.shape[1]))
+        for sl in self._col_blocks():
+            R += self._data_block(sl).dot(M[sl, :])
+        return R
+
+    def _data_tdot(self, M):
+        """ Returns data.T * M for a "data_dimension x n" matrix M, computed
+        over column blocks.
+        """
+        R = np.zeros((self._num_samples, M.shape[1]))
+        for sl in self._col_blocks():
+            R[sl, :] = self._data_block(sl).T.dot(M)
+        return R
+
+    def _data_sqnorm(self, cols=None):
+        """ Squared Frobenius norm ||data||^2 (of the selected columns). The
+        value is cached as data does not change during factorization.
+        """
+        cache = getattr(self, '_sqnorm_cache', None)
+        if cache is not None and cache[0] is self.data and cache[1] is cols:
+            return cache[2]
+
+        sqnorm = 0.0
+        for sl in self._col_blocks(cols):
+            data = self._data_block(sl)
+            if scipy.sparse.issparse(data):
+                sqnorm += data.multiply(data).sum()
+            else:
+                sqnorm += np.sum(np.square(data, dtype=np.float64))
+
+        self._sqnorm_cache = (self.data, cols, sqnorm)
+        return sqnorm
 
     def frobenius_norm(self):
         """ Frobenius norm (||data - WH||) of a data matrix and a low rank
         approximation given by WH. Minimizing the Fnorm ist the most common
         optimization criterion for matrix factorization methods.
 
+        The norm is evaluated via the trace expansion
+        ||data||^2 - 2 tr(H^T W^T data) + tr(H^T W^T W H)
+        over blocks of columns, i.e. the dense residual data - WH is never
+        built. ||data||^2 is cached. If ._err_cols holds a sorted index array
+        (see factorize(err_sample=...)), the error is estimated from these
+        columns only and scaled to the full number of samples.
+
         Returns:
         -------
         frobenius norm: F = ||data - WH||
@@ -153,12 +301,27 @@ class PyMFBase():
         """
         # check if W and H exist
         if hasattr(self,'H') and hasattr(self,'W'):
-            if scipy.sparse.issparse(self.data):
-                tmp = self.data[:,:] - (self.W * self.H)
-                tmp = tmp.multiply(tmp).sum()
-                err = np.sqrt(tmp)
-            else:
-                err = np.sqrt( np.sum((self.data[:,:] - np.dot(self.W, self.H))**2 ))
+            cols = self._err_cols
+            W = self.W if scipy.sparse.issparse(self.W) else np.asarray(self.W)
+            WtW = np.asarray(W.T.dot(W))
+            cross = 0.0
+            quad = 0.0
+            for sl in self._col_blocks(cols):
+                data = self._data_block(sl)
+                H = self.H[:, sl]
+                if scipy.sparse.issparse(data):
+                    WtX = np.asarray(data.T.dot(W)).T
+                else:
+                    WtX = np.asarray(W.T.dot(data))
+                cross += np.sum(WtX * H)
+                quad += np.sum(np.dot(WtW, H) * H)
+
+            # cancellation might give slightly negative values for (near)
+            # perfect reconstructions
+            err = max(self._data_sqnorm(cols) - 2.0*cross + quad, 0.0)
+            if cols is not None:
+                err *= self._num_samples / float(len(cols))
+            err = np.sqrt(err)
         else:
             err = None
 
@@ -186,7 +349,7 @@ class PyMFBase():
         """
         pass
 
-    def _converged(self, i):
+    def _converged(self, i, j=None):
         """
         If the optimization of the approximation is below the machine precision,
         return True.
@@ -194,12 +357,16 @@ class PyMFBase():
         Parameters
         ----------
             i   : index of the update step
+            j   : index of the previous step with a computed error, i-1 by
+                  default
 
         Returns
         -------
             converged : boolean
         """
-        derr = np.abs(self.ferr[i] - self.ferr[i-1])/self._num_samples
+        if j is None:
+            j = i - 1
+        derr = np.abs(self.ferr[i] - self.ferr[j])/self._num_samples
         if derr < self._EPS:
             return True
         else:
@@ -207,7 +374,7 @@ class PyMFBase():
 
     def factorize(self, niter=100, show_progress=False,
                   compute_w=True, compute_h=True, compute_err=True,
-                  epoch_hook=None):
+                  epoch_hook=None, err_every=1, err_sample=None):
         """ Factorize s.t. WH = data
 
         Parameters
@@ -225,6 +392,14 @@ class PyMFBase():
                 it to .ferr[k].
         epoch_hook : function
                 If this exists, evaluate it every iteration
+        err_every : int
+                compute the Frobenius norm only every err_every iterations
+                (and always after the last one). Skipped entries of .ferr
+                are set to NaN.
+        err_sample : int or float
+                if given, estimate the Frobenius norm from a random subset of
+                err_sample samples (or a fraction of all samples if < 1),
+                drawn once per call.
 
         Updated Values
         --------------
@@ -251,6 +426,15 @@ class PyMFBase():
         if compute_err:
             self.ferr = np.zeros(niter)
 
+            if err_sample is not None:
+                if err_sample < 1:
+                    err_sample = int(np.ceil(err_sample * self._num_samples))
+                err_sample = min(int(err_sample), self._num_samples)
+                # sort indices, otherwise h5py won't work
+                self._err_cols = np.sort(np.random.choice(
+                    self._num_samples, err_sample, replace=False))
+
+        last_err = None
         for i in range(niter):
             if compute_w:
                 self._update_w()
@@ -258,22 +442,26 @@ class PyMFBase():
             if compute_h:
                 self._update_h()
 
-            if compute_err:
+            if compute_err and ((i+1) % err_every == 0 or i == niter-1):
                 self.ferr[i] = self.frobenius_norm()
                 self._logger.info('FN: %s (%s/%s)'  %(self.ferr[i], i+1, niter))
             else:
+                if compute_err:
+                    self.ferr[i] = np.nan
                 self._logger.info('Iteration: (%s/%s)'  %(i+1, niter))
 
             if epoch_hook is not None:
                 epoch_hook(self)
 
-
             # check if the err is not changing anymore
-            if i > 1 and compute_err:
-                if self._converged(i):
+            if compute_err and not np.isnan(self.ferr[i]):
+                if i > 1 and last_err is not None and self._converged(i, last_err):
                     # adjust the error measure
                     self.ferr = self.ferr[:i]
                     break
+                last_err = i
+
+        self._err_cols = None
 
 
 class PyMFBase3():
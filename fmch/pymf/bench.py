@@ -0,0 +1,242 @@
+# Authors: Floris Hermanns
+# License: BSD 3 Clause
+"""
+PyMF benchmarks on synthetic hyperspectral mixtures.
+
+    synthetic_mixture(): Linear mixture of smooth endmember spectra
+    run_benchmark(): Time, profile and evaluate factorization methods
+
+Results (wall time, peak memory, reconstruction error) are written as JSON
+to track regressions and to choose methods/sizes for DR runs, e.g.
+
+    python -m pymf.bench --sizes 66x10000 66x100000 --bases 4 10 \\
+        --methods SIVM LAESA NMF PCA --out pymf_bench.json
+"""
+import numpy as np
+import json
+import time
+import platform
+import tracemalloc
+import cProfile
+import argparse
+import datetime as dt
+from pathlib import Path
+
+from .aa import AA
+from .saa import SAA
+from .nmf import NMF
+from .cnmf import CNMF
+from .pca import PCA
+from .svd import SVD
+from .cur import CUR
+from .kmeans import Kmeans
+from .sivm import SIVM
+from .laesa import LAESA
+from .sivm_sgreedy import SIVM_SGREEDY
+
+__all__ = ["synthetic_mixture", "run_benchmark", "METHODS", "DEFAULT_METHODS"]
+
+# method name -> (model factory(data, num_bases), factorize kwargs)
+METHODS = {
+    'SIVM': (lambda X, k: SIVM(X, num_bases=k), {}),
+    'LAESA': (lambda X, k: LAESA(X, num_bases=k), {}),
+    'SIVM_SGREEDY': (lambda X, k: SIVM_SGREEDY(X, num_bases=k), {}),
+    'AA': (lambda X, k: AA(X, num_bases=k), {'niter': 10}),
+    'SAA': (lambda X, k: SAA(X, num_bases=k), {'niter': 50}),
+    'NMF': (lambda X, k: NMF(X, num_bases=k), {'niter': 100}),
+    'CNMF': (lambda X, k: CNMF(X, num_bases=k), {'niter': 10}),
+    'PCA': (lambda X, k: PCA(X, num_bases=k), {}),
+    'SVD': (lambda X, k: SVD(X, k=k), {}),
+    'Kmeans': (lambda X, k: Kmeans(X, num_bases=k), {'niter': 10}),
+    'CUR': (lambda X, k: CUR(X, rrank=k, crank=k), {}),
+    }
+# Methods run by default. AA (full convex hull QP per iteration) takes minutes
+# at 66x10000 and is only run if requested explicitly; SAA covers AA.
+DEFAULT_METHODS = [m for m in METHODS if m != 'AA']
+
+
+def synthetic_mixture(bands=66, samples=10000, num_endmembers=4, noise=0.01,
+                      alpha=1.0, wl_range=(400., 1000.), seed=None):
+    '''
+    Generates a linear mixture of smooth, non-negative endmember spectra,
+    X = E*A + N, similar to reflectance spectra of vegetated pixels.
+
+    Args:
+        bands (int): Number of spectral bands (rows of X).
+        samples (int): Number of pixels (columns of X).
+        num_endmembers (int): Number of endmembers (columns of E).
+        noise (float): Standard deviation of additive Gaussian noise.
+        alpha (float): Dirichlet concentration of the abundances A. Small
+            values give almost pure pixels, large values strong mixing.
+        wl_range (tuple of floats): Wavelength range of the bands [nm].
+        seed (int, optional): Seed for the random number generator.
+
+    Returns:
+        X (numpy.ndarray): "bands x samples" data matrix, clipped to >= 0.
+        E (numpy.ndarray): "bands x num_endmembers" endmember spectra.
+        A (numpy.ndarray): "num_endmembers x samples" abundances.
+    '''
+    rng = np.random.default_rng(seed)
+    wls = np.linspace(wl_range[0], wl_range[1], bands)
+
+    # each endmember is a sum of a few Gaussian absorption/reflection features
+    E = np.zeros((bands, num_endmembers))
+    for j in range(num_endmembers):
+        E[:, j] = rng.uniform(0.02, 0.1)
+        for _ in range(rng.integers(2, 5)):
+            mu = rng.uniform(wl_range[0], wl_range[1])
+            sigma = rng.uniform(20., 150.)
+            E[:, j] += rng.uniform(0.05, 0.4) * np.exp(-0.5*((wls - mu)/sigma)**2)
+
+    A = rng.dirichlet(np.full(num_endmembers, alpha), size=samples).T
+    X = np.dot(E, A) + rng.normal(0.0, noise, (bands, samples))
+    np.maximum(X, 0.0, out=X)
+
+    return X, E, A
+
+
+def _run_single(method, X, num_bases, memory=False, profile=None):
+    '''
+    Builds and factorizes one model. Returns wall time [s], peak memory [MB]
+    (None if not traced) and the Frobenius norm of the reconstruction.
+    '''
+    factory, fkwargs = METHODS[method]
+    if memory:
+        tracemalloc.start()
+    prof = cProfile.Profile() if profile is not None else None
+
+    t0 = time.perf_counter()
+    if prof is not None:
+        prof.enable()
+    mdl = factory(X, num_bases)
+    mdl.factorize(**fkwargs)
+    if prof is not None:
+        prof.disable()
+    t1 = time.perf_counter()
+
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1] / 1024**2
+        tracemalloc.stop()
+    if prof is not None:
+        prof.dump_stats(str(profile))
+
+    return t1 - t0, peak, float(mdl.frobenius_norm())
+
+
+def run_benchmark(methods=None, sizes=None, bases=None,
+                  num_endmembers=None, noise=0.01, repeat=3, memory=True,
+                  profile_dir=None, out_file=None, seed=42):
+    '''
+    Times all methods for all data sizes and numbers of bases on synthetic
+    mixtures. Wall time is the minimum over repeat runs; peak memory is
+    traced in one extra run (tracemalloc slows down allocations).
+
+    Args:
+        methods (list of strings, optional): Keys of METHODS. Defaults to
+            DEFAULT_METHODS (all except AA).
+        sizes (list of tuples, optional): (bands, samples) combinations.
+            Defaults to [(66, 10000)].
+        bases (list of ints, optional): Numbers of bases to compute.
+            Defaults to [4].
+        num_endmembers (int, optional): Endmembers of the synthetic mixture.
+            Defaults to the number of bases.
+        noise (float): Noise level of the synthetic mixture.
+        repeat (int): Number of timed runs per configuration.
+        memory (bool): If true, trace peak memory in a separate run.
+        profile_dir (string / pathlib.Path, optional): If given, a cProfile
+            .prof file is written for the first run of each configuration.
+        out_file (string / pathlib.Path, optional): JSON output file.
+        seed (int): Seed for data generation and factorization.
+
+    Returns:
+        results (list of dicts): One entry per method & configuration.
+    '''
+    if methods is None:
+        methods = list(DEFAULT_METHODS)
+    if sizes is None:
+        sizes = [(66, 10000)]
+    if bases is None:
+        bases = [4]
+    if profile_dir is not None:
+        profile_dir = Path(profile_dir)
+        profile_dir.mkdir(parents=True, exist_ok=True)
+
+    results = []
+    for bands, samples in sizes:
+        for k in bases:
+            nem = k if num_endmembers is None else num_endmembers
+            X, _, _ = synthetic_mixture(bands, samples, nem, noise=noise, seed=seed)
+            xnorm = np.sqrt(np.sum(X**2))
+            for method in methods:
+                res = {'method': method, 'bands': bands, 'samples': samples,
+                       'num_bases': k, 'num_endmembers': nem, 'noise': noise,
+                       'repeat': repeat, 'time_s': None, 'times_s': [],
+                       'peak_mem_mb': None, 'ferr': None, 'rel_err': None,
+                       'status': 'ok', 'error': None}
+                try:
+                    for r in range(repeat):
+                        np.random.seed(seed + r)
+                        prof = None
+                        if profile_dir is not None and r == 0:
+                            prof = profile_dir / f'{method}_{bands}x{samples}_k{k}.prof'
+                        t, _, ferr = _run_single(method, X, k, profile=prof)
+                        res['times_s'].append(t)
+                    res['time_s'] = min(res['times_s'])
+                    res['ferr'] = ferr
+                    res['rel_err'] = ferr / xnorm
+                    if memory:
+                        np.random.seed(seed)
+                        _, res['peak_mem_mb'], _ = _run_single(method, X, k, memory=True)
+                except Exception as e:
+                    if tracemalloc.is_tracing():
+                        tracemalloc.stop()
+                    res['status'] = 'error'
+                    res['error'] = f'{type(e).__name__}: {e}'
+                results.append(res)
+                print('{method:>12s} {bands:4d}x{samples:<8d} k={num_bases:<3d} '
+                      'time={time_s} s  mem={peak_mem_mb} MB  rel_err={rel_err}  '
+                      '{status}'.format(**res))
+
+    if out_file is not None:
+        meta = {'created': dt.datetime.now().isoformat(),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'platform': platform.platform(),
+                'seed': seed}
+        with open(out_file, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=4)
+
+    return results
+
+
+def _parse_size(s):
+    bands, samples = s.lower().split('x')
+    return int(bands), int(samples)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark pymf methods on '
+                                     'synthetic hyperspectral mixtures.')
+    parser.add_argument('--methods', nargs='+', choices=list(METHODS.keys()),
+                        default=None)
+    parser.add_argument('--sizes', nargs='+', type=_parse_size,
+                        default=[(66, 10000)], help='BANDSxSAMPLES, e.g. 66x10000')
+    parser.add_argument('--bases', nargs='+', type=int, default=[4])
+    parser.add_argument('--endmembers', type=int, default=None)
+    parser.add_argument('--noise', type=float, default=0.01)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true')
+    parser.add_argument('--profile-dir', default=None)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--out', default='pymf_bench.json')
+    args = parser.parse_args(argv)
+
+    run_benchmark(methods=args.methods, sizes=args.sizes, bases=args.bases,
+                  num_endmembers=args.endmembers, noise=args.noise,
+                  repeat=args.repeat, memory=not args.no_memory,
+                  profile_dir=args.profile_dir, out_file=args.out,
+                  seed=args.seed)
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,7 @@ Plenum Press, New York 1981.
 """
 import numpy as np
 
-import pymf.dist
+from . import dist
 from .base import PyMFBase
 
 __all__ = ["Cmeans"]
@@ -22,7 +22,8 @@ class Cmeans(PyMFBase):
     F = | data - W*H | is minimal. H is restricted to convexity (columns
     sum to 1) W is simply the weighted mean over the corresponding samples in 
     data. Note that the objective function is based on distances (?), hence the
-    Frobenius norm is probably not a good quality measure.
+    Frobenius norm is probably not a good quality measure. Memberships and
+    centres are updated vectorized over column blocks of data.
     
     Parameters
     ----------
@@ -64,20 +65,16 @@ class Cmeans(PyMFBase):
 
     def _update_h(self):                    
         # assign samples to best matching centres ...
+        # H[i,:] = 1/sum_k (d_i/d_k)**p = d_i**-p / sum_k d_k**-p
         m = 1.75
-        tmp_dist = dist.pdist(self.W, self.data, metric='l2') + self._EPS
-        self.H[:,:] = 0.0
-        
-        for i in range(self._num_bases):
-            for k in range(self._num_bases):                
-                self.H[i,:] += (tmp_dist[i,:]/tmp_dist[k,:])**(2.0/(m-1))
-            
-        self.H = np.where(self.H>0, 1.0/self.H, 0)    
+        p = 2.0/(m-1)
+        for sl in self._col_blocks():
+            tmp_dist = dist.l2_pdist(self.W, self._data_block(sl)) + self._EPS
+            tmp_dist **= -p
+            self.H[:, sl] = tmp_dist/tmp_dist.sum(axis=0)
                     
     def _update_w(self):            
-        for i in range(self._num_bases):
-            tmp = (self.H[i:i+1,:] * self.data).sum(axis=1)
-            self.W[:,i] = tmp/(self.H[i,:].sum() + self._EPS)        
+        self.W = self._data_dot(self.H.T)/(self.H.sum(axis=1) + self._EPS)
 
 def _test():
     import doctest
@@ -70,7 +70,7 @@ class CNMF(PyMFBase):
             self.H = np.zeros((self._num_bases, self._num_samples))
             
             # initialize using k-means
-            km = Kmeans(self.data[:,:], num_bases=self._num_bases)        
+            km = Kmeans(self.data, num_bases=self._num_bases)        
             km.factorize(niter=10)
             assign = km.assigned
     
@@ -89,7 +89,7 @@ class CNMF(PyMFBase):
             self.G /= np.tile(np.reshape(num_i[assign],(-1,1)), self.G.shape[1])
             
         if not hasattr(self,'W'):
-            self.W = np.dot(self.data[:,:], self.G)
+            self.W = self._data_dot(self.G)
     
     def _init_w(self):
         pass
@@ -136,6 +136,14 @@ class CNMF(PyMFBase):
         else:
             self._logger.setLevel(logging.ERROR)                 
             
+        # For non-negative data, the negative part of data.T*data vanishes and
+        # all products with data.T*data can be evaluated in the projected
+        # (data_dimension x num_bases) form, i.e. without building the
+        # num_samples x num_samples Gram matrix.
+        if self._data_min() >= 0:
+            self._factorize_nonneg(niter, compute_w, compute_h, compute_err)
+            return
+
         XtX = np.dot(self.data[:,:].T, self.data[:,:])
         XtX_pos = separate_positive(XtX)
         XtX_neg = separate_negative(XtX)
@@ -174,6 +182,52 @@ class CNMF(PyMFBase):
                     self.ferr = self.ferr[:i]                    
                     break
 
+    def _data_min(self):
+        """ Minimum value of data, evaluated over column blocks. """
+        dmin = np.inf
+        for sl in self._col_blocks():
+            data = self._data_block(sl)
+            dmin = min(dmin, data.min())
+        return dmin
+
+    def _factorize_nonneg(self, niter, compute_w, compute_h, compute_err):
+        """ Update rules of .factorize() for non-negative data (XtX_neg = 0).
+        Products with XtX = data.T*data are computed as data.T*(data*M),
+        thus the cost of an iteration is linear in the number of samples.
+        """
+        self.ferr = np.zeros(niter)
+        XG = self._data_dot(self.G)
+
+        for i in range(niter):
+            # XtX_pos_x_W = data.T*data*G
+            XtX_pos_x_W = self._data_tdot(XG)
+
+            if compute_h:
+                # H_x_WT*XtX_pos_x_W = H.T*(G.T*data.T*data*G)
+                ha = XtX_pos_x_W
+                hb = np.dot(self.H.T, np.dot(XG.T, XG)) + 10**-9
+                self.H = (self.H.T*np.sqrt(ha/hb)).T
+
+            if compute_w:
+                HT_x_H = np.dot(self.H, self.H.T)
+                wa = self._data_tdot(self._data_dot(self.H.T))
+                wb = np.dot(XtX_pos_x_W, HT_x_H) + 10**-9
+
+                self.G *= np.sqrt(wa/wb)
+                XG = self._data_dot(self.G)
+                self.W = XG
+
+            if compute_err:
+                self.ferr[i] = self.frobenius_norm()
+                self._logger.info('FN: %s (%s/%s)'  %(self.ferr[i], i+1, niter))
+            else:
+                self._logger.info('Iteration: (%s/%s)'  %(i+1, niter))
+
+            if i > 1 and compute_err:
+                if self._converged(i):
+                    self.ferr = self.ferr[:i]
+                    break
+
 def _test():
     import doctest
     doctest.testmod()
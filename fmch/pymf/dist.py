@@ -8,6 +8,7 @@ PyMF several distance functions
     l2_distance(): L2 distance
     cosine_distance(): Cosine distance 
     pdist(): Pairwise distance computation
+    l2_pdist(): Pairwise (squared) l2 distance computation without loops
     vq(): Vector quantization
     
 """
@@ -15,7 +16,8 @@ import numpy as np
 import scipy.sparse
 
 __all__ = ["abs_cosine_distance", "kl_divergence", "l1_distance", "l2_distance", 
-           "weighted_abs_cosine_distance","cosine_distance","vq", "pdist"]
+           "weighted_abs_cosine_distance","cosine_distance","vq", "pdist",
+           "l2_pdist"]
 
 def kl_divergence(d, vec):    
     """
@@ -101,9 +103,27 @@ def weighted_abs_cosine_distance(d, vec):
     ret_val = abs_cosine_distance(d, vec, weighted=True)        
     return ret_val
 
+def l2_pdist(A, B, squared=False):
+    # compute pairwise l2 distance between a data matrix A (d x n) and B (d x m)
+    # as ||a||^2 + ||b||^2 - 2*a.T*b, i.e. with one matrix product instead of
+    # a loop over columns. Returns a distance matrix d (n x m).
+    A = np.asarray(A)
+    B = np.asarray(B)
+    d = -2.0*np.dot(A.T, B)
+    d += np.sum(A**2, axis=0).reshape((-1,1))
+    d += np.sum(B**2, axis=0).reshape((1,-1))
+    # cancellation might give slightly negative values for identical samples
+    np.maximum(d, 0.0, out=d)
+    if not squared:
+        np.sqrt(d, out=d)
+    return d
+
 def pdist(A, B, metric='l2' ):
     # compute pairwise distance between a data matrix A (d x n) and B (d x m).
     # Returns a distance matrix d (n x m).
+    if metric == 'l2' and not (scipy.sparse.issparse(A) or scipy.sparse.issparse(B)):
+        return l2_pdist(A, B)
+
     d = np.zeros((A.shape[1], B.shape[1]))
     if A.shape[1] <= B.shape[1]:
         for aidx in range(A.shape[1]):
@@ -123,8 +143,12 @@ def pdist(A, B, metric='l2' ):
 def vq(A, B, metric='l2'):
     # assigns data samples in B to cluster centers A and
     # returns an index list [assume n column vectors, d x n]
-    assigned = np.argmin(pdist(A,B, metric=metric), axis=0)
-    return assigned
+    if metric == 'l2' and not scipy.sparse.issparse(B):
+        # squared distances suffice for the argmin
+        assigned = np.argmin(l2_pdist(A, B, squared=True), axis=0)
+    else:
+        assigned = np.argmin(pdist(A,B, metric=metric), axis=0)
+    return assigned.astype(np.int32)
 
 def _test():
     import doctest
@@ -4,20 +4,23 @@
 PyMF K-means clustering (unary-convex matrix factorization).
 """
 import numpy as np
+import scipy.sparse
 import random
 
-import pymf.dist
+from . import dist
 from .base import PyMFBase
 
 __all__ = ["Kmeans"]
 
 class Kmeans(PyMFBase):
     """      
-    Kmeans(data, num_bases=4)
+    Kmeans(data, num_bases=4, batch_size=None)
     
     K-means clustering. Factorize a data matrix into two matrices s.t.
     F = | data - W*H | is minimal. H is restricted to unary vectors, W
     is simply the mean over the corresponding samples in "data".
+    Assignments are stored as a label vector, H is a sparse one-hot matrix
+    built from it. Data is processed in column blocks.
     
     Parameters
     ----------
@@ -26,12 +29,21 @@ class Kmeans(PyMFBase):
     num_bases: int, optional
         Number of bases to compute (column rank of W and row rank of H).
         4 (default)     
+    batch_size: int, optional
+        If given, W is updated by mini-batch k-means [1]: every iteration
+        streams once over the data in chunks of batch_size samples (in
+        random order) and moves the centers towards the chunk means.
+        None (default), i.e. standard (Lloyd) k-means.
     
     Attributes
     ----------
     W : "data_dimension x num_bases" matrix of basis vectors
-    H : "num bases x num_samples" matrix of coefficients
+    H : "num bases x num_samples" sparse (csc) matrix of coefficients
+    assigned : "num_samples" int32 vector of cluster labels
     ferr : frobenius norm (after calling .factorize()) 
+
+    [1] Sculley, D. (2010), Web-scale k-means clustering, Proc. 19th Int.
+    Conf. on World Wide Web, 1177-1178.
     
     Example
     -------
@@ -54,33 +66,92 @@ class Kmeans(PyMFBase):
     
     The result is a set of coefficients kmeans_mdl.H, s.t. data = W * kmeans_mdl.H.
     """        
+    def __init__(self, data, num_bases=4, batch_size=None, **kwargs):
+        PyMFBase.__init__(self, data, num_bases=num_bases)
+        self._batch_size = batch_size
+
     def _init_h(self):
         # W has to be present for H to be initialized  
-        self.H = np.zeros((self._num_bases, self._num_samples))
         self._update_h()
          
     def _init_w(self):
         # set W to some random data samples
         sel = random.sample(range(self._num_samples), self._num_bases)
-        
-        # sort indices, otherwise h5py won't work
-        self.W = self.data[:, np.sort(sel)]        
-       
+        self.W = np.float64(self._data_columns(sel))
+
+        # number of samples assigned to each center so far (mini-batch mode)
+        self._counts = np.zeros(self._num_bases)
+
+    def _onehot(self, labels):
+        """ Sparse "num_bases x len(labels)" one-hot matrix of labels. """
+        n = len(labels)
+        return scipy.sparse.csc_matrix((np.ones(n), labels, np.arange(n+1)),
+                                       shape=(self._num_bases, n))
+
+    def _cluster_sums(self, data, labels):
+        """ Per-cluster sums ("data_dimension x num_bases") and counts of the
+        samples in data (segmented sums via a sparse one-hot product).
+        """
+        S = self._onehot(labels).dot(data.T)
+        S = S.toarray().T if scipy.sparse.issparse(S) else S.T
+        n = np.bincount(labels, minlength=self._num_bases)
+        return S, n
         
     def _update_h(self):                    
-        # and assign samples to the best matching centers
-        self.assigned = dist.vq(self.W, self.data)
-        self.H = np.zeros(self.H.shape)
-        self.H[self.assigned, range(self._num_samples)] = 1.0
+        # and assign samples to the best matching centers (blockwise)
+        self.assigned = np.zeros(self._num_samples, dtype=np.int32)
+        for sl in self._col_blocks():
+            self.assigned[sl] = dist.vq(self.W, self._data_block(sl))
+        self.H = self._onehot(self.assigned)
                 
                     
-    def _update_w(self):            
-        for i in range(self._num_bases):
-            # cast to bool to use H as an index for data
-            idx = np.array(self.H[i,:], dtype=np.bool)
-            n = np.sum(idx)
-            if n > 0:
-                self.W[:,i] = np.sum(self.data[:, idx], axis=1)/n
+    def _update_w(self):
+        if self._batch_size is not None:
+            self._update_w_minibatch()
+            return
+
+        # sum up the samples of each cluster blockwise
+        W = np.zeros(self.W.shape)
+        for sl in self._col_blocks():
+            S, _ = self._cluster_sums(self._data_block(sl), self.assigned[sl])
+            W += S
+        n = np.bincount(self.assigned, minlength=self._num_bases)
+        idx = n > 0
+        self.W[:, idx] = W[:, idx]/n[idx]
+
+    def _update_w_minibatch(self):
+        if not hasattr(self, '_counts'):
+            self._counts = np.zeros(self._num_bases)
+
+        # contiguous chunks (h5py friendly) in random order
+        starts = np.random.permutation(
+            np.arange(0, self._num_samples, self._batch_size))
+        for idx_start in starts:
+            sl = slice(idx_start, min(idx_start + self._batch_size,
+                                      self._num_samples))
+            data = self._data_block(sl)
+            S, n = self._cluster_sums(data, dist.vq(self.W, data))
+
+            # running mean per center with learning rate 1/count
+            idx = n > 0
+            counts = self._counts[idx] + n[idx]
+            self.W[:, idx] = (self.W[:, idx]*self._counts[idx] + S[:, idx])/counts
+            self._counts[idx] = counts
+
+    def frobenius_norm(self):
+        """ Frobenius norm (||data - WH||), evaluated from the label vector
+        over column blocks.
+        """
+        if not (hasattr(self, 'W') and hasattr(self, 'assigned')):
+            return None
+
+        cols = self._err_cols
+        err = 0.0
+        for sl in self._col_blocks(cols):
+            err += np.sum((self._data_block(sl) - self.W[:, self.assigned[sl]])**2)
+        if cols is not None:
+            err *= self._num_samples / float(len(cols))
+        return np.sqrt(err)
 
 def _test():
     import doctest
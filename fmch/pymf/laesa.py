@@ -76,11 +76,8 @@ class LAESA(SIVM):
             self.select.append(np.argmax(distiter))
             self._logger.info('cur_nodes: ' + str(self.select))
 
-        # sort indices, otherwise h5py won't work
-        self.W = self.data[:, np.sort(self.select)]
-        
-        # but "unsort" it again to keep the correct order
-        self.W = self.W[:, np.argsort(np.argsort(self.select))]    
+        # read selected samples sorted (h5py) but keep the selection order
+        self.W = self._data_columns(self.select)
 
 def _test():
     import doctest
@@ -66,14 +66,17 @@ class NMF(PyMFBase):
        
     def _update_h(self):
         # pre init H1, and H2 (necessary for storing matrices on disk)
-        H2 = np.dot(np.dot(self.W.T, self.W), self.H) + 10**-9
-        self.H *= np.dot(self.W.T, self.data[:,:])
-        self.H /= H2
+        WtW = np.dot(self.W.T, self.W)
+        # update H blockwise -> data is only read in column blocks
+        for sl in self._col_blocks():
+            H2 = np.dot(WtW, self.H[:, sl]) + 10**-9
+            self.H[:, sl] *= np.dot(self.W.T, self._data_block(sl))
+            self.H[:, sl] /= H2
 
     def _update_w(self):
         # pre init W1, and W2 (necessary for storing matrices on disk)
-        W2 = np.dot(np.dot(self.W, self.H), self.H.T) + 10**-9
-        self.W *= np.dot(self.data[:,:], self.H.T)
+        W2 = np.dot(self.W, np.dot(self.H, self.H.T)) + 10**-9
+        self.W *= self._data_dot(self.H.T)
         self.W /= W2
         self.W /= np.sqrt(np.sum(self.W**2.0, axis=0))
 
@@ -7,7 +7,7 @@ PyMF Principal Component Analysis.
 """
 import numpy as np
 
-from .base import PyMFBase
+from .base import PyMFBase, eighk, _out_of_core
 from .svd import SVD
 
 
@@ -67,7 +67,16 @@ class PCA(PyMFBase):
         # center the data around the mean first
         self._center_mean = center_mean            
 
-        if self._center_mean:
+        if self._center_mean and _out_of_core(data):
+            # h5py/memmap data: compute the mean blockwise and center the
+            # data on the fly (see _data_block)
+            self._data_orig = data
+            self._meanv = np.zeros((self._data_dimension, 1))
+            for sl in self._col_blocks():
+                self._meanv += np.sum(data[:, sl], axis=1).reshape(-1,1)
+            self._meanv /= self._num_samples
+            self.data = data
+        elif self._center_mean:
             # copy the data before centering it
             self._data_orig = data            
             self._meanv = self._data_orig[:,:].mean(axis=1).reshape(-1,1)                
@@ -75,6 +84,12 @@ class PCA(PyMFBase):
         else:
             self.data = data
 
+    def _data_block(self, sl):
+        data = PyMFBase._data_block(self, sl)
+        if self._center_mean and _out_of_core(self.data):
+            data = data - self._meanv
+        return data
+
     def _init_h(self):
         pass
 
@@ -82,9 +97,22 @@ class PCA(PyMFBase):
         pass
     
     def _update_h(self):                    
-        self.H = np.dot(self.W.T, self.data[:,:])
+        self.H = np.zeros((self.W.shape[1], self._num_samples))
+        for sl in self._col_blocks():
+            self.H[:, sl] = np.dot(self.W.T, self._data_block(sl))
         
     def _update_w(self):
+        if _out_of_core(self.data):
+            # eigenvectors of data*data.T, accumulated over column blocks
+            AA = np.zeros((self._data_dimension, self._data_dimension))
+            for sl in self._col_blocks():
+                data = self._data_block(sl)
+                AA += np.dot(data, data.T)
+            values, vectors = eighk(AA, k=self._num_bases)
+            self.W = vectors
+            self.eigenvalues = np.sqrt(values)
+            return
+
         # compute eigenvectors and eigenvalues using SVD            
         svd_mdl = SVD(self.data)
         svd_mdl.factorize()
@@ -0,0 +1,195 @@
+# Authors: Floris Hermanns
+# License: BSD 3 Clause
+"""
+PyMF Scalable Archetypal Analysis [1,2]
+
+    SAA: class for Archetypal Analysis with per-iteration cost linear in the
+    number of samples
+
+[1] Cutler, A. Breiman, L. (1994), "Archetypal Analysis", Technometrics 36(4),
+338-347.
+
+[2] Morup, M. and Hansen, L. K. (2012), "Archetypal analysis for machine
+learning and data mining", Neurocomputing 80, 54-63.
+"""
+import numpy as np
+
+from .base import PyMFBase
+from .sivm import SIVM
+
+__all__ = ["SAA", "project_simplex"]
+
+
+def project_simplex(V):
+    """ Euclidean projection of each column of V onto the probability simplex
+    (v >= 0, sum(v) = 1), vectorized over all columns (Duchi et al. 2008).
+
+    Arguments
+    ---------
+    V - matrix (n x m), m vectors of length n
+
+    Returns
+    -------
+    P - matrix (n x m) with columns on the simplex
+    """
+    n = V.shape[0]
+    U = -np.sort(-V, axis=0)
+    css = np.cumsum(U, axis=0) - 1.0
+    ind = np.arange(1, n+1).reshape(-1, 1)
+    cond = U - css/ind > 0
+
+    # index of the last entry fulfilling the condition (entry 0 always does)
+    rho = n - 1 - np.argmax(cond[::-1, :], axis=0)
+    theta = css[rho, np.arange(V.shape[1])]/(rho + 1)
+    return np.maximum(V - theta, 0.0)
+
+
+class SAA(PyMFBase):
+    """
+    SAA(data, num_bases=4, init='sivm', h_steps=10)
+
+    Scalable Archetypal Analysis. Factorize a data matrix into two matrices
+    s.t. F = | data - W*H | = | data - data*beta.T*H| is minimal. H and beta
+    are restricted to convexity (beta >=0, sum(beta, axis=1) = [1 .. 1]).
+    In contrast to AA, the data Gram matrix (num_samples x num_samples) is
+    never built and no QP is solved per sample: all updates are batched
+    projected gradient steps in the (data_dimension x num_bases) projected
+    form, i.e. the cost of an iteration is linear in the number of samples
+    and data is only read in column blocks (h5py/memmap data is supported).
+
+    Parameters
+    ----------
+    data : array_like, shape (_data_dimension, _num_samples)
+        the input data
+    num_bases: int, optional
+        Number of bases to compute (column rank of W and row rank of H).
+        4 (default)
+    init : string (default: 'sivm')
+        'sivm' or 'random'. 'sivm' initializes beta with the samples
+        selected by SIVM (a coreset of num_bases extreme samples), 'random'
+        with random convex combinations of all samples.
+    h_steps : int, optional
+        Number of projected gradient steps for H per iteration.
+        10 (default)
+
+    Attributes
+    ----------
+    W : "data_dimension x num_bases" matrix of basis vectors
+    H : "num bases x num_samples" matrix of coefficients
+    beta : "num_bases x num_samples" matrix of basis vector coefficients
+        (for constructing W s.t. W = beta * data.T )
+    ferr : frobenius norm (after calling .factorize())
+
+    Example
+    -------
+    Applying SAA to some rather stupid data set:
+
+    >>> import numpy as np
+    >>> data = np.array([[1.0, 0.0, 2.0], [0.0, 1.0, 1.0]])
+    >>> saa_mdl = SAA(data, num_bases=2)
+    >>> saa_mdl.factorize(niter=10)
+
+    The basis vectors are now stored in saa_mdl.W, the coefficients in saa_mdl.H.
+    To compute coefficients for an existing set of basis vectors simply copy W
+    to saa_mdl.W, and set compute_w to False:
+
+    >>> data = np.array([[1.5], [1.2]])
+    >>> W = np.array([[1.0, 0.0], [0.0, 1.0]])
+    >>> saa_mdl = SAA(data, num_bases=2)
+    >>> saa_mdl.W = W
+    >>> saa_mdl.factorize(niter=1, compute_w=False)
+
+    The result is a set of coefficients saa_mdl.H, s.t. data = W * saa_mdl.H.
+    """
+
+    def __init__(self, data, num_bases=4, init='sivm', h_steps=10, **kwargs):
+        PyMFBase.__init__(self, data, num_bases=num_bases)
+        self._init = init
+        self._h_steps = h_steps
+
+    def _init_h(self):
+        """ Initialize H s.t. columns sum to 1.
+        """
+        self.H = np.random.random((self._num_bases, self._num_samples))
+        self.H /= self.H.sum(axis=0)
+
+    def _init_w(self):
+        """ Initialize beta from a SIVM selection or randomly, W = data*beta.T
+        """
+        self.beta = np.zeros((self._num_bases, self._num_samples))
+        if self._init == 'sivm':
+            sivm_mdl = SIVM(self.data, num_bases=self._num_bases)
+            sivm_mdl.factorize(compute_h=False, compute_err=False)
+            self.beta[range(self._num_bases), sivm_mdl.select] = 1.0
+            self.W = sivm_mdl.W.astype(np.float64)
+        else:
+            self.beta[:, :] = np.random.random(self.beta.shape)
+            self.beta /= self.beta.sum(axis=1).reshape(-1, 1)
+            self.W = self._data_dot(self.beta.T)
+
+        # step size for beta, adapted during the updates
+        self._mu = None
+
+    def _update_h(self):
+        """ projected gradient steps for H (batched over all samples of a
+        column block), enforcing a convexity constraint.
+        """
+        WtW = np.dot(self.W.T, self.W)
+        # 1/L with the Lipschitz constant L of the gradient
+        step = 1.0/(np.linalg.eigvalsh(WtW)[-1] + self._EPS)
+
+        for sl in self._col_blocks():
+            WtX = self._data_block(sl).T.dot(self.W).T
+            H = self.H[:, sl]
+            for i in range(self._h_steps):
+                H = project_simplex(H - step*(np.dot(WtW, H) - WtX))
+            self.H[:, sl] = H
+
+    def _update_w(self):
+        """ projected gradient step for beta with exact line search, enforcing
+        a convexity constraint. Only "data_dimension x num_bases" and
+        "num_samples x num_bases" matrices are built.
+        """
+        if not hasattr(self, 'beta'):
+            # W was set manually without beta -> (re-)initialize both
+            self._init_w()
+
+        HHt = np.dot(self.H, self.H.T)
+        XHt = self._data_dot(self.H.T)
+        WHHt = np.dot(self.W, HHt)
+
+        # gradient w.r.t. beta.T: data.T * (W*H*H.T - data*H.T)
+        G = self._data_tdot(WHHt - XHt)
+
+        if self._mu is None:
+            # ||data||^2 * ||H*H.T|| bounds the Lipschitz constant
+            self._mu = 1.0/(self._data_sqnorm() * np.linalg.eigvalsh(HHt)[-1]
+                            + self._EPS)
+
+        D = project_simplex(self.beta.T - self._mu*G) - self.beta.T
+        E = self._data_dot(D)
+
+        # exact line search along D, alpha in [0,1] keeps beta convex
+        denom = np.sum(np.dot(E.T, E) * HHt)
+        if denom > 0:
+            alpha = (np.sum(E * XHt) - np.sum(E * WHHt))/denom
+        else:
+            alpha = 0.0
+        alpha = min(max(alpha, 0.0), 1.0)
+
+        # increase the step size if the full step was taken, otherwise reduce
+        if alpha >= 1.0:
+            self._mu *= 1.5
+        else:
+            self._mu *= 0.5
+
+        self.beta += alpha*D.T
+        self.W = self.W + alpha*E
+
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    _test()
@@ -99,11 +99,6 @@ class SIVM(AA):
     def _distance(self, idx):
         """ compute distances of a specific data point to all other samples"""
             
-        if scipy.sparse.issparse(self.data):
-            step = self.data.shape[1]
-        else:    
-            step = 50000    
-                
         d = np.zeros((self.data.shape[1]))        
         if idx == -1:
             # set vec to origin if idx=-1
@@ -111,21 +106,20 @@ class SIVM(AA):
             if scipy.sparse.issparse(self.data):
                 vec = scipy.sparse.csc_matrix(vec)
         else:
-            vec = self.data[:, idx:idx+1]    
+            vec = self._data_block(slice(idx, idx+1))
             
         self._logger.info('compute distance to node ' + str(idx))
                                                 
         # slice data into smaller chunks
-        for idx_start in range(0, self.data.shape[1], step):                    
-            if idx_start + step > self.data.shape[1]:
-                idx_end = self.data.shape[1]
-            else:
-                idx_end = idx_start + step
+        if scipy.sparse.issparse(self.data):
+            blocks = [slice(0, self.data.shape[1])]
+        else:
+            blocks = self._col_blocks()
 
-            d[idx_start:idx_end] = self._distfunc(
-                self.data[:,idx_start:idx_end], vec)
+        for sl in blocks:
+            d[sl] = self._distfunc(self._data_block(sl), vec)
             self._logger.info('completed:' + 
-                str(idx_end/(self.data.shape[1]/100.0)) + "%")    
+                str(sl.stop/(self.data.shape[1]/100.0)) + "%")    
         return d
        
     def _init_h(self):
@@ -186,11 +180,8 @@ class SIVM(AA):
         
             self._logger.info('cur_nodes: ' + str(self.select))
 
-        # sort indices, otherwise h5py won't work
-        self.W = self.data[:, np.sort(self.select)]
-            
-        # "unsort" it again to keep the correct order
-        self.W = self.W[:, np.argsort(np.argsort(self.select))]
+        # read selected samples sorted (h5py) but keep the selection order
+        self.W = self._data_columns(self.select)
     
     def factorize(self, show_progress=False, compute_w=True, compute_h=True,
                   compute_err=True, niter=1):
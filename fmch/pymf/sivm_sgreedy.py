@@ -84,7 +84,7 @@ class SIVM_SGREEDY(SIVM_SEARCH):
 
     def _update_w(self):        
         # compute distance matrix -> requiresd for the volume
-        self.init_sivm()
+        self._init_sivm()
         next_sel = list([self.select[0]])
         self.select = []
         
@@ -0,0 +1,68 @@
+import numpy as np
+
+from fmch import ffp
+
+
+def _grid(n=201, half=10.):
+    x = np.linspace(-half, half, n)
+    return np.meshgrid(x, x, indexing='xy')
+
+
+def _inside(xr, yr, px, py):
+    return ffp._point_in_polygon(px, py, np.asarray(xr), np.asarray(yr))
+
+
+def test_contour_vertices_two_lobes():
+    # the secondary lobe is wider and has the longer isoline
+    x, y = _grid()
+    f = np.exp(-((x + 4)**2 + y**2) / 0.5) + 0.6 * np.exp(-((x - 4)**2 + y**2) / 4.)
+    xr, yr = ffp.get_contour_vertices(x, y, f, 0.3)
+    assert xr is not None
+    assert _inside(xr, yr, -4., 0.)
+    assert not _inside(xr, yr, 4., 0.)
+
+
+def test_contour_vertices_hole():
+    # f >= lev everywhere except for a hole: the only closed isoline does
+    # not enclose the region around the peak, which reaches the domain edge
+    x, y = _grid()
+    f = 1. + np.exp(-(x**2 + y**2)) - 0.9 * np.exp(-((x - 5.)**2 + y**2) / 2.)
+    assert len(ffp.isolines(x, y, f, 0.5)) == 1
+    assert ffp.get_contour_vertices(x, y, f, 0.5) == [None, None]
+
+
+def test_contour_vertices_domain_edge():
+    # region f >= lev reaches the domain edge
+    x, y = _grid()
+    f = np.exp(-(x**2 + y**2) / 200.)
+    assert ffp.get_contour_vertices(x, y, f, 0.5) == [None, None]
+
+
+def _levels_sorted(f, dx, dy, rs):
+    # levels by a full sort (original implementation)
+    sf = np.sort(f, axis=None)[::-1]
+    csf = np.cumsum(sf) * dx * dy
+    i = [np.argmin(np.abs(csf - r)) for r in rs]
+    return csf[i], sf[i]
+
+
+def test_contour_levels_above_domain_mass():
+    # uniform field with 7.5% of the mass inside the domain
+    f = np.full((40, 40), 0.075 / 1600)
+    levs = ffp.get_contour_levels(f, 1., 1., [0.5, 0.8])
+    ars, pclevs = _levels_sorted(f, 1., 1., [0.5, 0.8])
+    np.testing.assert_allclose([l[1] for l in levs], ars)
+    np.testing.assert_allclose([l[2] for l in levs], pclevs)
+
+
+def test_contour_levels_match_sort():
+    # truncated peak with zeros, r below and above the mass in the domain
+    x, y = _grid(200, 3.)
+    f = np.exp(-(x**2 + y**2) * 8.)
+    f /= f.sum() * 2.
+    f[f < 1e-30] = 0.
+    rs = [0.1, 0.3, 0.45, 0.6]
+    levs = ffp.get_contour_levels(f, 1., 1., rs)
+    ars, pclevs = _levels_sorted(f, 1., 1., rs)
+    np.testing.assert_allclose([l[1] for l in levs], ars, rtol=1e-12)
+    np.testing.assert_allclose([l[2] for l in levs], pclevs, rtol=1e-12)
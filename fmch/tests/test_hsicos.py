@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+hsicos = pytest.importorskip('fmch.hsicos')
+
+WINDOWS = {'c3': {'days': 3},
+           'comp8': {'days': 8, 'kind': 'composite', 'how': 'sum'}}
+
+
+def _records(start='2020-06-01 00:30', end='2020-06-20'):
+    t = pd.date_range(start, end, freq='30min')
+    return pd.DataFrame({'TIMESTAMP_END': t, 'PAR': 1., 'GPP': 1.})
+
+
+def test_window_aggregates():
+    dates = pd.to_datetime(['2020-06-05', '2020-07-10']).date
+    agg = hsicos._window_aggregates(_records(), ['GPP'], dates, WINDOWS)
+    assert list(agg.columns) == ['GPP_c3', 'GPP_comp8']
+    assert agg.GPP_c3[0] == 1.
+    # block of June 1-8, first record of June 1 is missing
+    assert agg.GPP_comp8[0] == 8 * 48 - 1
+    assert agg.iloc[1].isna().all()
+
+
+def test_window_aggregates_empty_records():
+    dates = pd.to_datetime(['2020-06-05', '2020-07-10']).date
+    agg = hsicos._window_aggregates(_records().iloc[:0], ['GPP'], dates, WINDOWS)
+    assert agg.shape == (2, 2)
+    assert agg.isna().all().all()
+
+
+def test_window_aggregates_no_dates():
+    agg = hsicos._window_aggregates(_records(), ['GPP'], [], WINDOWS)
+    assert agg.shape == (0, 2)